@@ -1,68 +1,112 @@
+import asyncio
 import tempfile
 import os
-import logging
-from typing import List, Union, Optional
 import uuid
+import logging
+from typing import Callable, Dict, List, Union, Optional, Tuple
 from dotenv import load_dotenv as _load_dotenv
 _load_dotenv()
 
 
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.document_loaders import WebBaseLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_qdrant import QdrantVectorStore
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 
 from qdrant_client import QdrantClient
 from qdrant_client.http.models import Distance, VectorParams
 from qdrant_client.http import models as rest
 
+from .Embedder import EmbeddingPipeline
+from .Crawler import SiteCrawler
+from .Fetcher import AsyncFetcher
+from .FileLoader import iter_files
+from .Manifest import IngestManifest
+from .Pipeline import IngestionPipeline
+from .VectorStore import (VectorStoreService, get_active_index, get_collection_name, get_embeddings, get_mode,
+                          get_qdrant_client, resolve_collection)
+
 class DocumentProcessor:
     """用于处理和向量化不同类型文档的类"""
     
     def __init__(self, 
-                 collection_name: str = os.getenv("COLLECTION_NAME", "xiaolang_documents"),
-                 embedding_model: str = os.getenv("EMBEDDING_MODEL", "Pro/BAAI/bge-m3"),
-                 chunk_size: int = 800, 
-                 chunk_overlap: int = 50,
-                 persist_directory: Optional[str] = None) -> None:
+                 collection_name: Optional[str] = None,
+                 embedding_model: Optional[str] = None,
+                 chunk_size: Optional[int] = None, 
+                 chunk_overlap: Optional[int] = None,
+                 persist_directory: Optional[str] = None,
+                 embeddings: Optional[Embeddings] = None,
+                 client: Optional[QdrantClient] = None,
+                 vector_size: Optional[int] = None,
+                 hnsw_config: Optional[rest.HnswConfigDiff] = None,
+                 quantization_config: Optional[rest.QuantizationConfig] = None,
+                 manifest: Optional[IngestManifest] = None) -> None:
         """
         初始化文档处理器
         
         Args:
-            collection_name: Qdrant集合名称
-            embedding_model: OpenAI嵌入模型名称
-            chunk_size: 文档分片大小
-            chunk_overlap: 文档分片重叠大小
+            collection_name: Qdrant集合名称，None则使用 EMBEDDING_COLLECTION 配置
+            embedding_model: OpenAI嵌入模型名称，None则使用当前索引版本的模型或 EMBEDDING_MODEL
+            chunk_size: 文档分片大小，None则使用当前索引版本的配置或800
+            chunk_overlap: 文档分片重叠大小，None则使用当前索引版本的配置或50
             persist_directory: 永久存储目录，None则使用临时目录
+            embeddings: 自定义嵌入模型，None则使用OpenAI兼容接口
+            client: 外部传入的Qdrant客户端，None则使用进程内共享客户端
+            vector_size: 向量维度，需与嵌入模型输出一致，None则使用当前索引版本的配置或1024
+            hnsw_config: 新建集合时使用的HNSW参数，None则使用默认值
+            quantization_config: 新建集合时使用的量化配置，None则不量化
+            manifest: 增量入库清单，None则使用 INGEST_STATE_DIR 下的默认清单
         """
         # 配置日志
         logging.basicConfig(level=logging.INFO, 
                            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         self.logger = logging.getLogger("DocumentProcessor")
         
-        # 初始化嵌入模型
-        self.embeddings = OpenAIEmbeddings(
-            model=embedding_model,
-            api_key=os.getenv("EMBEDDING_API_KEY"),
-            base_url=os.getenv("EMBEDDING_API_BASE")
-            )
+        # 重建过索引时，未显式指定的参数沿用当前生效版本的配置
+        self.collection_name = collection_name or get_collection_name()
+        active = get_active_index(self.collection_name)
+        if embedding_model is None:
+            embedding_model = active.embedding_model if active else os.getenv("EMBEDDING_MODEL", "Pro/BAAI/bge-m3")
+        chunk_size = chunk_size or (active.chunk_size if active else 800)
+        chunk_overlap = chunk_overlap if chunk_overlap is not None else (active.chunk_overlap if active else 50)
+        vector_size = vector_size or (active.vector_size if active else 1024)
+        self.embedding_model = embedding_model
+
+        # 初始化嵌入模型：同一模型在进程内共享客户端和连接池
+        self.embeddings = embeddings or get_embeddings(embedding_model)
         
-        # 配置文本分割器
+        # 并发网页抓取器
+        self.fetcher = AsyncFetcher()
+
+        # 配置文本分割器，本地文件在子进程中按相同参数分割
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
         self.splitter = RecursiveCharacterTextSplitter(
             chunk_size=chunk_size, 
             chunk_overlap=chunk_overlap,
             length_function=len
         )
         
-        # 设置向量存储目录
-        self.is_temp_dir = persist_directory is None
-        self.storage_dir = persist_directory or tempfile.mkdtemp(prefix="qdrant_")
-        self.logger.info(f"使用存储目录: {self.storage_dir}")
+        # 设置向量存储目录：只有未注入客户端的本地模式才需要临时目录，随实例销毁删除
+        self.is_temp_dir = persist_directory is None and client is None and get_mode() != "server"
+        self.storage_dir = tempfile.mkdtemp(prefix="qdrant_") if self.is_temp_dir else persist_directory
+        if self.storage_dir:
+            self.logger.info(f"使用存储目录: {self.storage_dir}")
         
         # 初始化Qdrant客户端和集合
-        self.collection_name = collection_name
-        self.client = QdrantClient(path=self.storage_dir)
+        self.vector_size = vector_size
+        self.hnsw_config = hnsw_config or rest.HnswConfigDiff(
+            m=16,  # 提高检索精度的HNSW图参数
+            ef_construct=128,  # 提高构建质量
+        )
+        self.quantization_config = quantization_config
+        if client is not None:
+            self.client = client
+        elif self.is_temp_dir:
+            self.client = QdrantClient(path=self.storage_dir)
+        else:
+            # 与检索共用进程内唯一的客户端，避免重复打开本地库
+            self.client = get_qdrant_client(self.storage_dir)
         
         # 检查并创建集合
         self._ensure_collection_exists()
@@ -73,23 +117,31 @@ class DocumentProcessor:
             collection_name=self.collection_name,
             embedding=self.embeddings,
         )
+        # 分批写入与批量检索的访问层
+        self.store = VectorStoreService(self.client, self.collection_name, self.embeddings, follow_active_index=True)
+        # 批量并发嵌入，写入前给进行中的检索让路
+        self.embedder = EmbeddingPipeline(
+            self.store, yield_to_reads=float(os.getenv("INGEST_YIELD_TO_READS", "0.5"))
+        )
+        # 增量入库清单
+        self.manifest = manifest or IngestManifest()
+        # 抓取到写入的流式流水线
+        self.pipeline = IngestionPipeline(self)
     
     def _ensure_collection_exists(self) -> None:
         """确保Qdrant集合存在，不存在则创建"""
         try:
-            collections = self.client.get_collections().collections
-            if not any(collection.name == self.collection_name for collection in collections):
+            # 集合名也可能是指向某个版本集合的别名
+            if resolve_collection(self.client, self.collection_name) is None:
                 self.logger.info(f"创建新集合: {self.collection_name}")
                 self.client.create_collection(
                     collection_name=self.collection_name,
-                    vectors_config=VectorParams(size=1024, distance=Distance.COSINE),
+                    vectors_config=VectorParams(size=self.vector_size, distance=Distance.COSINE),
                     optimizers_config=rest.OptimizersConfigDiff(
                         indexing_threshold=10000,  # 优化索引阈值
                     ),
-                    hnsw_config=rest.HnswConfigDiff(
-                        m=16,  # 提高检索精度的HNSW图参数
-                        ef_construct=128,  # 提高构建质量
-                    )
+                    hnsw_config=self.hnsw_config,
+                    quantization_config=self.quantization_config,
                 )
             else:
                 self.logger.info(f"使用已有集合: {self.collection_name}")
@@ -97,35 +149,134 @@ class DocumentProcessor:
             self.logger.error(f"创建集合时出错: {e}")
             raise
     
-    async def add_urls(self, urls: List[str]) -> dict:
+    def use_index(self, other: "DocumentProcessor") -> None:
+        """重建索引切换别名后，沿用新版本处理器的嵌入模型与分片参数继续入库"""
+        self.embedding_model = other.embedding_model
+        self.embeddings = other.embeddings
+        self.chunk_size = other.chunk_size
+        self.chunk_overlap = other.chunk_overlap
+        self.splitter = other.splitter
+        self.vector_size = other.vector_size
+        self.store.use_embeddings(other.collection_name, other.embeddings)
+        self.vector_store = QdrantVectorStore(
+            client=self.client,
+            collection_name=self.collection_name,
+            embedding=self.embeddings,
+        )
+    
+    async def add_urls(self, urls: List[str],
+                       on_progress: Optional[Callable[[int, int], None]] = None) -> dict:
         """
         从URL加载文档并添加到向量存储
         
+        抓取、解析、分割、嵌入、写入以流水线方式进行，内存占用不随URL数量增长。
+        已入库的URL会带上 ETag/Last-Modified 发送条件请求，未变化的页面不再下载和嵌入。
+        
         Args:
             urls: 要加载的URL列表
+            on_progress: 嵌入进度回调 (已写入块数, 已发现待写入块数)
             
         Returns:
             包含状态信息的字典
         """
         try:
-            self.logger.info(f"正在加载URLs: {urls}")
-            loader = WebBaseLoader(urls)
-            docs = loader.load()
-            print("-----------docs------------")
-            print(docs)
-            self.logger.info(f"已加载 {len(docs)} 个文档")
-            return await self._process_documents(docs)
+            self.logger.info(f"正在加载 {len(urls)} 个URL")
+            validators = {
+                source: (record.etag, record.last_modified)
+                for source, record in self.manifest.get_validators(urls).items()
+            }
+            result = await self.pipeline.run_urls(urls, validators=validators, on_progress=on_progress)
+            self.logger.info(
+                f"已加载 {result['document_count']} 个文档，{result['not_modified_count']} 个未变化，"
+                f"{len(result.get('failed_urls', {}))} 个失败"
+            )
+            return result
         except Exception as e:
             self.logger.error(f"处理URL时出错: {e}")
             return {"error": str(e)}
     
     
-    async def _process_documents(self, docs: List[Document]) -> dict:
+    async def crawl(self, seed: Optional[str] = None, sitemap: Optional[str] = None,
+                    max_depth: Optional[int] = None, path_prefix: Optional[str] = None,
+                    max_pages: Optional[int] = None, crawl_id: Optional[str] = None,
+                    on_progress: Optional[Callable[[int, int], None]] = None) -> dict:
+        """
+        从sitemap或种子URL抓取同站页面并添加到向量存储
+        
+        Args:
+            seed: 种子页面URL，与 sitemap 二选一
+            sitemap: sitemap.xml 地址
+            max_depth: 跟随链接的层数，默认种子为2、sitemap为0
+            path_prefix: 只抓取路径以此开头的页面
+            max_pages: 最多抓取的页面数
+            crawl_id: 抓取ID，传入已有ID时从上次中断处继续
+            on_progress: 嵌入进度回调 (已写入块数, 已发现待写入块数)
+            
+        Returns:
+            包含状态信息和抓取队列统计的字典
+        """
+        try:
+            crawler = SiteCrawler(
+                crawl_id or uuid.uuid4().hex, seed=seed, sitemap=sitemap, max_depth=max_depth,
+                path_prefix=path_prefix, manifest=self.manifest,
+                **({"max_pages": max_pages} if max_pages else {}),
+            )
+            self.logger.info(f"开始抓取 {seed or sitemap}（crawl_id={crawler.crawl_id}）")
+            return await self.pipeline.run_crawl(crawler, on_progress=on_progress)
+        except Exception as e:
+            self.logger.error(f"抓取站点时出错: {e}")
+            return {"error": str(e)}
+    
+    async def add_files(self, paths: List[str],
+                        on_progress: Optional[Callable[[int, int], None]] = None) -> dict:
+        """
+        解析本地文件并添加到向量存储
+        
+        支持 PDF、Markdown、Word(docx) 和纯文本，修改时间与内容哈希都未变化的文件直接跳过。
+        
+        Args:
+            paths: 文件路径列表
+            on_progress: 嵌入进度回调 (已写入块数, 已发现待写入块数)
+            
+        Returns:
+            包含状态信息和吞吐（文件/秒、块/秒）的字典
+        """
+        try:
+            self.logger.info(f"正在加载 {len(paths)} 个文件")
+            return await self.pipeline.run_files([os.path.abspath(p) for p in paths], on_progress=on_progress)
+        except Exception as e:
+            self.logger.error(f"处理文件时出错: {e}")
+            return {"error": str(e)}
+    
+    async def add_directory(self, path: str, recursive: bool = True,
+                            on_progress: Optional[Callable[[int, int], None]] = None) -> dict:
+        """
+        遍历目录并添加其中支持的文件
+        
+        Args:
+            path: 目录路径
+            recursive: 是否进入子目录
+            on_progress: 嵌入进度回调 (已写入块数, 已发现待写入块数)
+        """
+        files = await asyncio.to_thread(lambda: list(iter_files(path, recursive=recursive)))
+        if not files:
+            return {"status": "warning", "message": "目录中没有支持的文件"}
+        return await self.add_files(files, on_progress=on_progress)
+    
+    
+    async def _process_documents(self, docs: List[Document],
+                                 validators: Optional[Dict[str, Tuple[Optional[str], Optional[str]]]] = None,
+                                 on_progress: Optional[Callable[[int, int], None]] = None) -> dict:
         """
-        处理文档并添加到向量存储
+        处理文档并增量写入向量存储
+        
+        分片ID由来源和内容哈希决定：已存在的分片跳过，新分片嵌入写入，
+        来源中已不存在的旧分片从集合中删除。
         
         Args:
             docs: 文档列表
+            validators: 来源 -> (ETag, Last-Modified)，随清单保存供下次条件请求使用
+            on_progress: 嵌入进度回调 (已写入块数, 已发现待写入块数)
             
         Returns:
             包含状态信息的字典
@@ -134,24 +285,16 @@ class DocumentProcessor:
             return {"status": "warning", "message": "没有文档需要处理"}
             
         try:
-            # 分割文档
-            print("-----------docs------------")
-            print(docs)
-            chunks = self.splitter.split_documents(docs)
-            print("-----------chunks------------")
-            print(chunks)
-            self.logger.info(f"文档已分割为 {len(chunks)} 个块")
-            
-            # 生成 UUID 格式的 ID
-            ids = [str(uuid.uuid4()) for _ in range(len(chunks))]
-            self.vector_store.add_documents(documents=chunks, ids=ids)
-            
-            return {
-                "status": "success", 
-                "message": f"成功添加 {len(chunks)} 个文档块",
-                "document_count": len(docs),
-                "chunk_count": len(chunks)
-            }
+            # 同一来源的文档需相邻，流水线按相邻来源分组
+            by_source: Dict[str, List[Document]] = {}
+            for doc in docs:
+                by_source.setdefault(doc.metadata.get("source", ""), []).append(doc)
+            ordered = [doc for source_docs in by_source.values() for doc in source_docs]
+            result = await self.pipeline.run_documents(ordered, validators=validators, on_progress=on_progress)
+            self.logger.info(
+                f"共 {result['chunk_count']} 个块，写入 {result['added_count']} 个，删除 {result['deleted_count']} 个过期分片"
+            )
+            return result
         except Exception as e:
             self.logger.error(f"处理文档时出错: {e}")
             return {"error": str(e)}
@@ -161,6 +304,9 @@ class DocumentProcessor:
         if hasattr(self, 'is_temp_dir') and self.is_temp_dir and hasattr(self, 'storage_dir'):
             try:
                 import shutil
+                # 先关闭占用目录的本地客户端再删除
+                if hasattr(self, 'client'):
+                    self.client.close()
                 shutil.rmtree(self.storage_dir, ignore_errors=True)
                 self.logger.info(f"已清理临时目录: {self.storage_dir}")
             except Exception as e:
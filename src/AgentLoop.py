@@ -0,0 +1,239 @@
+"""
+带并发工具执行和单轮预算的 Agent 循环
+
+在 AgentExecutor 的基础上：
+- 模型在同一步里请求的多个只读工具并发执行（例如同时 web_search 和 get_info_from_local），
+  创建、修改、删除数据的工具按模型给出的顺序逐个执行，观察结果按原顺序返回；
+- 每轮对话有墙钟时间、迭代次数和 token 三项预算，任一耗尽即停止，用已拿到的工具结果给出部分答复，
+  不再返回 "Agent stopped due to iteration limit or time limit."；
+- 结果中附带每次工具调用的耗时（tool_timings）和预算使用情况（budget）。
+"""
+import contextvars
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from langchain.agents import AgentExecutor
+from langchain_core.agents import AgentAction, AgentFinish, AgentStep
+from langchain_core.callbacks import CallbackManagerForChainRun
+from langchain_core.utils.input import get_color_mapping
+
+from .Embedder import estimate_tokens
+
+logger = logging.getLogger("AgentLoop")
+
+# 工具在线程池中执行：超出预算的工具不阻塞本轮回复，在后台自行结束
+_tool_pool = ThreadPoolExecutor(max_workers=int(os.getenv("AGENT_TOOL_WORKERS", "8")),
+                                thread_name_prefix="agent-tool")
+
+# 停止原因 -> 日志中的说明
+_STOP_LABELS = {"iterations": "迭代次数", "time": "时间预算", "tokens": "token预算"}
+
+# 工具没有正常完成时的观察结果
+_FAILED_OBSERVATIONS = {
+    "timeout": "工具 {tool} 在本轮时间预算内没有完成",
+    "skipped": "本轮时间预算已用完，工具 {tool} 没有执行",
+    "error": "工具 {tool} 执行失败: {error}",
+}
+
+
+@dataclass
+class _Turn:
+    """一轮对话的预算使用情况"""
+    started: float
+    tokens: int = 0
+    stopped: Optional[str] = None
+    timings: List[Dict[str, Any]] = field(default_factory=list)
+    # 超时或失败的动作，部分答复中不展示它们的观察结果
+    failed: set = field(default_factory=set)
+    _counted: set = field(default_factory=set)
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def add_tokens(self, messages: List[Any], observations: List[Any] = ()) -> None:
+        """累计模型用量：有 usage_metadata 时用实际值，否则按模型输出和工具结果长度估算"""
+        for message in messages:
+            # 同一步并发的多个动作共享同一条模型消息，只计一次
+            if id(message) in self._counted:
+                continue
+            self._counted.add(id(message))
+            usage = getattr(message, "usage_metadata", None)
+            if usage:
+                self.tokens += usage.get("total_tokens", 0)
+            else:
+                self.tokens += estimate_tokens(str(message.content)) + \
+                    estimate_tokens(json.dumps(getattr(message, "tool_calls", []), ensure_ascii=False))
+        self.tokens += sum(estimate_tokens(str(observation)) for observation in observations)
+
+
+class _PendingAction:
+    """父类逐个执行动作时只登记，由 _iter_next_step 统一并发执行"""
+
+    def __init__(self, action: AgentAction) -> None:
+        self.action = action
+
+
+_current_turn: contextvars.ContextVar[Optional[_Turn]] = contextvars.ContextVar("agent_turn", default=None)
+
+
+class BudgetedAgentExecutor(AgentExecutor):
+    """并发执行同一步的工具调用，并按单轮时间、迭代次数和 token 预算停止"""
+
+    # 单轮 token 预算，None 表示不限制；时间和迭代次数沿用 max_execution_time / max_iterations
+    max_turn_tokens: Optional[int] = None
+    # 同一步最多并发执行的工具数
+    max_parallel_tools: int = 4
+    # 可以并发执行的只读工具名，其余工具视为写工具，按顺序执行且不受时间预算打断
+    read_only_tools: Set[str] = set()
+
+    def _stop_reason(self, turn: _Turn, iterations: int) -> Optional[str]:
+        if self.max_iterations is not None and iterations >= self.max_iterations:
+            return "iterations"
+        if self.max_execution_time is not None and turn.elapsed() >= self.max_execution_time:
+            return "time"
+        if self.max_turn_tokens is not None and turn.tokens >= self.max_turn_tokens:
+            return "tokens"
+        return None
+
+    def _call(self, inputs: Dict[str, str],
+              run_manager: Optional[CallbackManagerForChainRun] = None) -> Dict[str, Any]:
+        turn = _Turn(started=time.monotonic())
+        token = _current_turn.set(turn)
+        try:
+            name_to_tool_map = {tool.name: tool for tool in self.tools}
+            color_mapping = get_color_mapping([tool.name for tool in self.tools], excluded_colors=["green", "red"])
+            intermediate_steps: List[Tuple[AgentAction, str]] = []
+            iterations = 0
+            while True:
+                turn.stopped = self._stop_reason(turn, iterations)
+                if turn.stopped:
+                    break
+                next_step_output = self._take_next_step(
+                    name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager=run_manager
+                )
+                if isinstance(next_step_output, AgentFinish):
+                    turn.add_tokens(next_step_output.messages)
+                    return self._finish(next_step_output, intermediate_steps, turn, run_manager)
+                intermediate_steps.extend(next_step_output)
+                turn.add_tokens([m for action, _ in next_step_output for m in getattr(action, "message_log", [])],
+                                [observation for _, observation in next_step_output])
+                if len(next_step_output) == 1:
+                    tool_return = self._get_tool_return(next_step_output[0])
+                    if tool_return is not None:
+                        return self._finish(tool_return, intermediate_steps, turn, run_manager)
+                iterations += 1
+
+            logger.warning(f"本轮对话因{_STOP_LABELS[turn.stopped]}耗尽而停止，"
+                           f"已迭代 {iterations} 次，耗时 {turn.elapsed():.1f}s，约 {turn.tokens} tokens")
+            output = AgentFinish({"output": self._partial_answer(intermediate_steps, turn)}, turn.stopped)
+            return self._finish(output, intermediate_steps, turn, run_manager)
+        finally:
+            _current_turn.reset(token)
+
+    def _finish(self, output: AgentFinish, intermediate_steps: list, turn: _Turn,
+                run_manager: Optional[CallbackManagerForChainRun]) -> Dict[str, Any]:
+        result = self._return(output, intermediate_steps, run_manager=run_manager)
+        result["tool_timings"] = turn.timings
+        result["budget"] = {"seconds": round(turn.elapsed(), 3), "tokens": turn.tokens, "stopped": turn.stopped}
+        return result
+
+    @staticmethod
+    def _partial_answer(intermediate_steps: List[Tuple[AgentAction, Any]], turn: _Turn) -> str:
+        """预算耗尽时，用已经拿到的工具结果给出部分答复"""
+        found = [(action.tool, str(observation)) for action, observation in intermediate_steps
+                 if id(action) not in turn.failed and not action.tool.startswith("_")]
+        if not found:
+            return "抱歉，这个问题处理得有点久，我暂时还没有查到结果，请稍后再问我一次或者把问题说得更具体些。"
+        lines = [f"- {tool}: {observation[:300]}" for tool, observation in found[-3:]]
+        return "抱歉，这个问题处理得有点久，我先把目前查到的信息告诉你：\n" + "\n".join(lines)
+
+    # ---- 并发执行工具 ----
+
+    def _perform_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager=None):
+        return _PendingAction(agent_action)
+
+    def _iter_next_step(self, name_to_tool_map, color_mapping, inputs, intermediate_steps,
+                        run_manager=None) -> Iterator[Union[AgentFinish, AgentAction, AgentStep]]:
+        pending: List[AgentAction] = []
+        for item in super()._iter_next_step(name_to_tool_map, color_mapping, inputs, intermediate_steps,
+                                            run_manager):
+            if isinstance(item, _PendingAction):
+                pending.append(item.action)
+            else:
+                yield item
+        if pending:
+            yield from self._run_actions(name_to_tool_map, color_mapping, pending, run_manager)
+
+    def _run_actions(self, name_to_tool_map, color_mapping, actions: List[AgentAction],
+                     run_manager) -> List[AgentStep]:
+        turn = _current_turn.get()
+        perform = super()._perform_agent_action
+
+        def run(action: AgentAction) -> Tuple[AgentStep, float]:
+            started = time.monotonic()
+            step = perform(name_to_tool_map, color_mapping, action, run_manager)
+            return step, time.monotonic() - started
+
+        # 按模型给出的顺序分组：相邻的只读工具一组并发执行，写工具单独一组，
+        # 前一组结束后才开始下一组，读写之间不会互相穿插
+        groups: List[List[AgentAction]] = []
+        for action in actions:
+            read_only = action.tool in self.read_only_tools
+            if (read_only and groups and groups[-1][0].tool in self.read_only_tools
+                    and len(groups[-1]) < self.max_parallel_tools):
+                groups[-1].append(action)
+            else:
+                groups.append([action])
+
+        # 动作 -> (状态, (步骤, 耗时) 或异常)
+        outcomes: Dict[int, Tuple[str, Any]] = {}
+        for group in groups:
+            timeout = None
+            if self.max_execution_time is not None and turn is not None:
+                timeout = self.max_execution_time - turn.elapsed()
+                # 时间预算已用完，不再开始新的工具
+                if timeout <= 0:
+                    outcomes.update((id(action), ("skipped", None)) for action in group)
+                    continue
+            if group[0].tool not in self.read_only_tools:
+                # 写工具在当前线程执行完为止：超时放弃后它仍可能在后台写入，回复却说没有完成
+                try:
+                    outcomes[id(group[0])] = ("ok", run(group[0]))
+                except Exception as e:
+                    outcomes[id(group[0])] = ("error", e)
+                continue
+            # 每个工具复制一份上下文，当前用户等 contextvars 在线程中仍然可见
+            futures = [_tool_pool.submit(contextvars.copy_context().run, run, action) for action in group]
+            wait(futures, timeout=timeout)
+            for action, future in zip(group, futures):
+                if not future.done():
+                    outcomes[id(action)] = ("timeout", None)
+                elif future.exception() is not None:
+                    outcomes[id(action)] = ("error", future.exception())
+                else:
+                    outcomes[id(action)] = ("ok", future.result())
+
+        steps = []
+        for action in actions:
+            status, value = outcomes[id(action)]
+            if status == "ok":
+                step, seconds = value
+                steps.append(step)
+                timing = {"tool": action.tool, "seconds": round(seconds, 3), "status": "ok"}
+            else:
+                observation = _FAILED_OBSERVATIONS[status].format(tool=action.tool, error=value)
+                steps.append(AgentStep(action=action, observation=observation))
+                timing = {"tool": action.tool, "seconds": None, "status": status}
+            if turn is not None:
+                turn.timings.append(timing)
+                if status != "ok":
+                    turn.failed.add(id(action))
+            logger.info(f"工具 {action.tool}: {timing['status']} {timing['seconds'] or ''}")
+        if any(len(group) > 1 for group in groups):
+            logger.info(f"并发执行只读工具: {[[a.tool for a in group] for group in groups if len(group) > 1]}")
+        return steps
@@ -1,14 +1,23 @@
 from langchain.agents import AgentExecutor,create_tool_calling_agent,create_structured_chat_agent
-from langchain_openai import ChatOpenAI
+from langchain.agents.format_scratchpad.tools import format_to_tool_messages
+from langchain.agents.output_parsers.tools import ToolsAgentOutputParser
+from langchain_core.runnables import RunnablePassthrough
 from langchain_deepseek import ChatDeepSeek
-from langchain_core.runnables import ConfigurableField
 from .Prompt import PromptClass
 from .Memory import MemoryClass
 from .Emotion import EmotionClass
-from langchain_core.caches import InMemoryCache
 from .Storage import get_user
+from .ModelRouter import get_model, get_router
+from .HedgedModel import HedgedChatModel
+from .HttpPool import http_clients
+from .IntentRouter import CHITCHAT, FULL_AGENT, get_intent_router
+from .ToolSelector import ToolSelector
+from .AgentLoop import BudgetedAgentExecutor
+import threading
+import time
+from collections import OrderedDict
 
-from .Tools import web_search,get_info_from_local,create_todo,checkSchedule,SetSchedule,SearchSchedule,ModifySchedule,DelSchedule,ConfirmDelSchedule
+from .Tools import READ_ONLY_TOOLS,web_search,get_info_from_local,create_todo,checkSchedule,FindFreeSlots,SetSchedule,SearchSchedule,ModifySchedule,DelSchedule,ConfirmDelSchedule
 from dotenv import load_dotenv as _load_dotenv
 _load_dotenv()
 import os
@@ -16,40 +25,101 @@ os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
 os.environ["OPENAI_API_BASE"] = os.getenv("OPENAI_API_BASE")
 os.environ["DEEPSEEK_API_KEY"] = os.getenv("DEEPSEEK_API_KEY")
 os.environ["DEEPSEEK_API_BASE"] = os.getenv("DEEPSEEK_API_BASE")
-#添加缓存
-from langchain_core.globals import set_llm_cache
-set_llm_cache(InMemoryCache())
+# 不设置全局缓存：对话轮次不缓存，情绪识别、记忆摘要、日程匹配等阶段在 ModelRouter 中启用 get_llm_cache()
+
+_agent_model = None
+
+def get_agent_model() -> HedgedChatModel:
+    """进程内共享的主备对冲模型，首 token 耗时统计与熔断状态在所有对话间共享；流式调用也返回token用量"""
+    global _agent_model
+    if _agent_model is None:
+        _agent_model = HedgedChatModel(get_model("agent"), ChatDeepSeek(model=os.getenv("BACKUP_MODEL"), stream_usage=True, **http_clients()))
+    return _agent_model
+
+# 按工具子集缓存绑定好工具的模型，常用子集不必每条消息重新转换工具描述
+_bound_models = OrderedDict()
+_bound_models_lock = threading.Lock()
+
+def get_bound_model(tools):
+    """返回绑定了这组工具的共享模型，最多缓存 TOOL_AGENT_CACHE_SIZE 个子集"""
+    key = tuple(t.name for t in tools)
+    with _bound_models_lock:
+        bound = _bound_models.get(key)
+        if bound is None:
+            bound = _bound_models[key] = get_agent_model().bind_tools(tools)
+            while len(_bound_models) > int(os.getenv("TOOL_AGENT_CACHE_SIZE", "32")):
+                _bound_models.popitem(last=False)
+        _bound_models.move_to_end(key)
+        return bound
+
+_tool_selector = None
+
+def get_tool_selector(tools) -> ToolSelector:
+    """进程内共享的工具选择器，工具描述只嵌入一次"""
+    global _tool_selector
+    if _tool_selector is None:
+        _tool_selector = ToolSelector(tools)
+    return _tool_selector
 
 
 class AgentClass:
     def __init__(self):
-        fallback_llm = ChatDeepSeek(model=os.getenv("BACKUP_MODEL"))
-        self.modelname = os.getenv("BASE_MODEL")
-        self.chatmodel = ChatOpenAI(model=self.modelname).with_fallbacks([fallback_llm])
-        self.tools = [web_search,get_info_from_local,create_todo,checkSchedule,SetSchedule,SearchSchedule,ModifySchedule,DelSchedule,ConfirmDelSchedule]
+        # 各阶段的模型由 MODEL_ROUTES 配置，客户端进程内共享，每条消息新建 AgentClass 不再重复创建
+        self.modelname = get_router().config("agent").model
+        # 主模型首 token 过慢时并行启动备用模型，主模型持续异常时熔断直接使用备用模型
+        self.chatmodel = get_agent_model()
+        self.tools = [web_search,get_info_from_local,create_todo,checkSchedule,FindFreeSlots,SetSchedule,SearchSchedule,ModifySchedule,DelSchedule,ConfirmDelSchedule]
         self.memorykey = os.getenv("MEMORY_KEY")
         self.feeling = {"feeling":"default","score":5}
         self.prompt = PromptClass(memorykey=self.memorykey,feeling=self.feeling).Prompt_Structure()
-        self.memory = MemoryClass(memorykey=self.memorykey,model=self.modelname)
-        self.emotion = EmotionClass(model=self.modelname)
-        self.agent = create_tool_calling_agent(
-            self.chatmodel,
-            self.tools,
-            self.prompt,
-        )
-        self.agent_chain = AgentExecutor(
-            agent=self.agent,
-            tools=self.tools,
-            memory=self.memory.set_memory(),
-            verbose=True
-        ).configurable_fields(
-            memory=ConfigurableField(
-                id="agent_memory",
-                name="Agent Memory",
-                description="The memory of the agent",
+        self.memory = MemoryClass(memorykey=self.memorykey)
+        self.emotion = EmotionClass()
+
+    def _build_executor(self, tools, prompt, memory):
+        """用给定的工具、提示词和用户记忆创建 Agent 执行器"""
+        # 与 create_tool_calling_agent 相同的结构，绑定工具的模型取自缓存
+        agent = (
+            RunnablePassthrough.assign(
+                agent_scratchpad=lambda x: format_to_tool_messages(x["intermediate_steps"])
             )
+            | prompt
+            | get_bound_model(tools)
+            | ToolsAgentOutputParser()
+        )
+        # 同一步的只读工具调用并发执行，写工具按顺序执行；每轮对话按迭代次数、时间和token预算停止，结果带 tool_timings 与 budget
+        max_tokens = int(os.getenv("AGENT_MAX_TOKENS", "12000"))
+        return BudgetedAgentExecutor(
+            agent=agent,
+            tools=tools,
+            memory=memory,
+            return_intermediate_steps=True,
+            max_iterations=int(os.getenv("AGENT_MAX_ITERATIONS", "6")),
+            max_execution_time=float(os.getenv("AGENT_MAX_SECONDS", "60")),
+            max_turn_tokens=max_tokens if max_tokens > 0 else None,
+            max_parallel_tools=int(os.getenv("AGENT_PARALLEL_TOOLS", "4")),
+            read_only_tools=READ_ONLY_TOOLS,
+            verbose=os.getenv("AGENT_VERBOSE", "0") == "1"
         )
 
+    def _chat(self, input, memory):
+        """闲聊：不带工具直接调用一次模型，对话照常写入记忆"""
+        history = memory.load_memory_variables({})[memory.memory_key]
+        message = (self.prompt | self.chatmodel).invoke({
+            "input": input,
+            memory.memory_key: history,
+            "agent_scratchpad": [],
+        })
+        memory.save_context({"input": input}, {"output": message.content})
+        return {"input": input, "output": message.content}
+
+    @staticmethod
+    def _last_reply(memory):
+        """记忆中最近一条助手回复，没有时返回 None"""
+        for message in reversed(memory.chat_memory.messages):
+            if message.type == "ai":
+                return message.content
+        return None
+
     def run_agent(self, input, user_id=None):
         # run emotion sensing
         self.feeling = self.emotion.Emotion_Sensing(input)
@@ -58,10 +128,28 @@ class AgentClass:
         
         # 使用传入的user_id
         current_user_id = user_id
-        res = self.agent_chain.with_config({
-            "agent_memory": self.memory.set_memory(session_id=current_user_id)
-        }).invoke(
-            {"input": input}
-        )
+        memory = self.memory.set_memory(session_id=current_user_id)
+
+        # 闲聊直接回复，意图明确时只挂相关工具，其余走完整 Agent
+        router = get_intent_router()
+        decision = router.route(input)
+        started = time.perf_counter()
+        if decision.route == CHITCHAT:
+            res = self._chat(input, memory)
+        else:
+            # 规则已确定意图时用对应工具，否则结合上一条回复和上一轮的工具从嵌入索引中选择工具
+            selector = get_tool_selector(self.tools)
+            session = current_user_id or "session1"
+            if decision.tools:
+                names = decision.tools
+                selector.remember(session, names)
+            else:
+                names = selector.select(input, context=self._last_reply(memory), session=session)
+            tools = [t for t in self.tools if t.name in names]
+            # 每条消息按本轮的提示词（含情绪）和用户记忆创建执行器，绑定工具的模型取自缓存
+            res = self._build_executor(tools, self.prompt, memory).invoke({"input": input})
+            if decision.route == FULL_AGENT:
+                selector.record(names, res.get("intermediate_steps"))
+        router.record(decision, time.perf_counter() - started)
         return res    
         
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+"""
+检索基准测试
+
+使用确定性的本地嵌入模型构建合成语料，通过 DocumentProcessor 入库，
+然后遍历 k / fetch_k / 检索类型 / HNSW 参数 / 量化配置，统计：
+入库吞吐、查询延迟 p50/p95/p99、相对精确检索的 recall@k 以及进程常驻内存。
+结果以 JSON 输出，便于在不同版本之间对比。
+
+用法示例：
+    python -m src.Benchmark --sizes 1k --output bench.json
+    python -m src.Benchmark --sizes 100k 1m --qdrant-url http://localhost:6333
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, asdict, field
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from qdrant_client import QdrantClient
+from qdrant_client.http import models as rest
+
+from .AddDoc import DocumentProcessor
+from .Manifest import IngestManifest
+
+logger = logging.getLogger("Benchmark")
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+class HashingEmbeddings(Embeddings):
+    """确定性的特征哈希嵌入，不依赖任何外部API
+
+    相同文本总是得到相同向量，共享词越多的文本余弦相似度越高，
+    足以模拟真实嵌入模型的近邻结构。
+    """
+
+    def __init__(self, size: int = 1024, seed: int = 0) -> None:
+        self.size = size
+        self.seed = seed
+        self._buckets: Dict[str, Tuple[int, float]] = {}
+
+    def _bucket(self, token: str) -> Tuple[int, float]:
+        bucket = self._buckets.get(token)
+        if bucket is None:
+            digest = hashlib.blake2b(f"{self.seed}:{token}".encode("utf-8"), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "little") % self.size
+            sign = 1.0 if digest[4] & 1 else -1.0
+            bucket = self._buckets[token] = (index, sign)
+        return bucket
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.size, dtype=np.float32)
+        for token in _TOKEN_RE.findall(text.lower()):
+            index, sign = self._bucket(token)
+            vector[index] += sign
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            vector[0] = 1.0
+        else:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class SyntheticCorpus:
+    """按主题聚簇生成的合成语料，每个文档都小于一个分片，入库后一文档对应一块"""
+
+    def __init__(self, size: int, seed: int = 42, vocab_size: int = 20000,
+                 words_per_topic: int = 40, words_per_chunk: int = 60) -> None:
+        self.size = size
+        self.seed = seed
+        self.words_per_chunk = words_per_chunk
+        rng = random.Random(seed)
+        syllables = ["ba", "ko", "ri", "mu", "te", "sa", "lo", "ne", "xi", "pa", "du", "ve", "zo", "hi", "qu", "ma"]
+        vocab = set()
+        while len(vocab) < vocab_size:
+            vocab.add("".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+        self.vocab = sorted(vocab)
+        self.topic_count = max(10, size // 100)
+        self._topic_rng_seed = rng.randint(0, 2 ** 31)
+        self.words_per_topic = words_per_topic
+
+    def _topic_words(self, topic: int) -> List[str]:
+        rng = random.Random(self._topic_rng_seed + topic)
+        return rng.sample(self.vocab, self.words_per_topic)
+
+    def _topic_of(self, index: int) -> int:
+        return index % self.topic_count
+
+    def document(self, index: int) -> Document:
+        rng = random.Random(self.seed * 1_000_003 + index)
+        topic = self._topic_of(index)
+        topic_words = self._topic_words(topic)
+        words = [
+            rng.choice(topic_words) if rng.random() < 0.7 else rng.choice(self.vocab)
+            for _ in range(self.words_per_chunk)
+        ]
+        return Document(
+            page_content=" ".join(words),
+            metadata={"source": f"synthetic://{self.size}/{index}", "topic": topic},
+        )
+
+    def batches(self, batch_size: int):
+        for start in range(0, self.size, batch_size):
+            end = min(start + batch_size, self.size)
+            yield [self.document(i) for i in range(start, end)]
+
+    def queries(self, count: int) -> List[str]:
+        rng = random.Random(self.seed + 7)
+        queries = []
+        for _ in range(count):
+            doc = self.document(rng.randrange(self.size))
+            words = doc.page_content.split()
+            queries.append(" ".join(rng.sample(words, min(8, len(words)))))
+        return queries
+
+
+@dataclass
+class BenchmarkResult:
+    corpus_size: int
+    hnsw_m: int
+    hnsw_ef_construct: int
+    quantization: str
+    search_type: str
+    k: int
+    fetch_k: Optional[int]
+    hnsw_ef: Optional[int]
+    ingest_seconds: float
+    ingest_chunks_per_sec: float
+    query_count: int
+    latency_ms: Dict[str, float] = field(default_factory=dict)
+    recall_at_k: float = 0.0
+    rss_mb: float = 0.0
+    peak_rss_mb: float = 0.0
+
+
+def parse_size(value: str) -> int:
+    """解析 1k / 100k / 1m 形式的语料规模"""
+    value = value.strip().lower()
+    multiplier = 1
+    if value.endswith("k"):
+        multiplier, value = 1_000, value[:-1]
+    elif value.endswith("m"):
+        multiplier, value = 1_000_000, value[:-1]
+    return int(float(value) * multiplier)
+
+
+def current_rss_mb() -> float:
+    """当前常驻内存，无法读取/proc时退回峰值"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 以字节为单位，Linux 以KB为单位
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    arr = np.asarray(samples) * 1000
+    return {
+        "p50": round(float(np.percentile(arr, 50)), 3),
+        "p95": round(float(np.percentile(arr, 95)), 3),
+        "p99": round(float(np.percentile(arr, 99)), 3),
+        "mean": round(float(arr.mean()), 3),
+    }
+
+
+def quantization_config(name: str) -> Optional[rest.QuantizationConfig]:
+    if name == "none":
+        return None
+    if name == "scalar":
+        return rest.ScalarQuantization(
+            scalar=rest.ScalarQuantizationConfig(type=rest.ScalarType.INT8, always_ram=True)
+        )
+    if name == "binary":
+        return rest.BinaryQuantization(binary=rest.BinaryQuantizationConfig(always_ram=True))
+    if name == "product":
+        return rest.ProductQuantization(
+            product=rest.ProductQuantizationConfig(compression=rest.CompressionRatio.X16, always_ram=True)
+        )
+    raise ValueError(f"未知的量化类型: {name}")
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class RetrievalBenchmark:
+    """对单个语料规模执行完整参数扫描"""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.embeddings = HashingEmbeddings(size=args.dim, seed=args.seed)
+
+    def _make_client(self) -> QdrantClient:
+        if self.args.qdrant_url:
+            return QdrantClient(url=self.args.qdrant_url, timeout=300)
+        return QdrantClient(location=":memory:")
+
+    def _wait_for_index(self, client: QdrantClient, collection_name: str) -> None:
+        """服务端模式下索引是异步构建的，等集合变绿再开始查询"""
+        while client.get_collection(collection_name).status != rest.CollectionStatus.GREEN:
+            time.sleep(0.5)
+
+    def ingest(self, corpus: SyntheticCorpus, hnsw_m: int, ef_construct: int,
+               quantization: str) -> Tuple[DocumentProcessor, float]:
+        collection_name = f"bench_{corpus.size}_m{hnsw_m}_ef{ef_construct}_{quantization}"
+        client = self._make_client()
+        if client.collection_exists(collection_name):
+            client.delete_collection(collection_name)
+        processor = DocumentProcessor(
+            collection_name=collection_name,
+            embeddings=self.embeddings,
+            client=client,
+            vector_size=self.args.dim,
+            hnsw_config=rest.HnswConfigDiff(m=hnsw_m, ef_construct=ef_construct),
+            quantization_config=quantization_config(quantization),
+            # 每次测量都从空集合开始，清单只放在内存里
+            manifest=IngestManifest(":memory:"),
+        )
+        started = time.perf_counter()
+        for batch in corpus.batches(self.args.batch_size):
+            result = asyncio.run(processor._process_documents(batch))
+            if "error" in result:
+                raise RuntimeError(f"入库失败: {result['error']}")
+        if self.args.qdrant_url:
+            self._wait_for_index(client, collection_name)
+        return processor, time.perf_counter() - started
+
+    def exact_top_k(self, processor: DocumentProcessor, query_vectors: List[List[float]], k: int) -> List[set]:
+        truth = []
+        for vector in query_vectors:
+            points = processor.client.search(
+                collection_name=processor.collection_name,
+                query_vector=vector,
+                limit=k,
+                with_payload=False,
+                search_params=rest.SearchParams(exact=True),
+            )
+            truth.append({str(point.id) for point in points})
+        return truth
+
+    def run_queries(self, processor: DocumentProcessor, queries: List[str], search_type: str,
+                    k: int, fetch_k: Optional[int], hnsw_ef: Optional[int]) -> Tuple[List[float], List[set]]:
+        search_params = rest.SearchParams(hnsw_ef=hnsw_ef) if hnsw_ef else None
+        latencies, found = [], []
+        for query in queries:
+            started = time.perf_counter()
+            if search_type == "mmr":
+                docs = processor.vector_store.max_marginal_relevance_search(
+                    query, k=k, fetch_k=fetch_k, search_params=search_params
+                )
+            else:
+                docs = processor.vector_store.similarity_search(query, k=k, search_params=search_params)
+            latencies.append(time.perf_counter() - started)
+            found.append({str(doc.metadata.get("_id")) for doc in docs})
+        return latencies, found
+
+    def run_size(self, size: int) -> List[BenchmarkResult]:
+        args = self.args
+        corpus = SyntheticCorpus(size, seed=args.seed)
+        queries = corpus.queries(args.queries)
+        query_vectors = self.embeddings.embed_documents(queries)
+        results = []
+        for hnsw_m, ef_construct, quantization in itertools.product(args.hnsw_m, args.ef_construct, args.quantization):
+            logger.info(f"入库: size={size} m={hnsw_m} ef_construct={ef_construct} quantization={quantization}")
+            processor, ingest_seconds = self.ingest(corpus, hnsw_m, ef_construct, quantization)
+            truth_cache: Dict[int, List[set]] = {}
+            for search_type, k, fetch_k, hnsw_ef in itertools.product(
+                    args.search_types, args.k, args.fetch_k, args.hnsw_ef or [None]):
+                if search_type == "mmr" and fetch_k < k:
+                    continue
+                if search_type == "similarity" and fetch_k != args.fetch_k[0]:
+                    # fetch_k 只影响 MMR，相似度检索不必重复测量
+                    continue
+                if k not in truth_cache:
+                    truth_cache[k] = self.exact_top_k(processor, query_vectors, k)
+                latencies, found = self.run_queries(processor, queries, search_type, k, fetch_k, hnsw_ef)
+                recall = float(np.mean([
+                    len(hit & expected) / max(len(expected), 1)
+                    for hit, expected in zip(found, truth_cache[k])
+                ]))
+                result = BenchmarkResult(
+                    corpus_size=size,
+                    hnsw_m=hnsw_m,
+                    hnsw_ef_construct=ef_construct,
+                    quantization=quantization,
+                    search_type=search_type,
+                    k=k,
+                    fetch_k=fetch_k if search_type == "mmr" else None,
+                    hnsw_ef=hnsw_ef,
+                    ingest_seconds=round(ingest_seconds, 3),
+                    ingest_chunks_per_sec=round(size / ingest_seconds, 1) if ingest_seconds else 0.0,
+                    query_count=len(queries),
+                    latency_ms=percentiles(latencies),
+                    recall_at_k=round(recall, 4),
+                    rss_mb=round(current_rss_mb(), 1),
+                    peak_rss_mb=round(peak_rss_mb(), 1),
+                )
+                logger.info(
+                    f"{search_type} k={k} fetch_k={result.fetch_k} ef={hnsw_ef} "
+                    f"p95={result.latency_ms.get('p95')}ms recall={result.recall_at_k}"
+                )
+                results.append(result)
+            processor.client.delete_collection(processor.collection_name)
+            processor.client.close()
+        return results
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="知识库检索基准测试")
+    parser.add_argument("--sizes", nargs="+", default=["1k", "100k", "1m"], help="语料规模，例如 1k 100k 1m")
+    parser.add_argument("--k", nargs="+", type=int, default=[5, 10])
+    parser.add_argument("--fetch-k", nargs="+", type=int, default=[10, 20, 50])
+    parser.add_argument("--search-types", nargs="+", choices=["mmr", "similarity"], default=["mmr", "similarity"])
+    parser.add_argument("--hnsw-m", nargs="+", type=int, default=[16])
+    parser.add_argument("--ef-construct", nargs="+", type=int, default=[128])
+    parser.add_argument("--hnsw-ef", nargs="+", type=int, default=None, help="查询时的hnsw_ef，不填则使用服务端默认值")
+    parser.add_argument("--quantization", nargs="+", choices=["none", "scalar", "binary", "product"], default=["none"])
+    parser.add_argument("--queries", type=int, default=200, help="每组参数的查询次数")
+    parser.add_argument("--dim", type=int, default=1024, help="向量维度")
+    parser.add_argument("--batch-size", type=int, default=5000, help="每次入库的文档数")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--qdrant-url", default=os.getenv("BENCH_QDRANT_URL"),
+                        help="Qdrant服务地址；不填则使用内存模式（不构建HNSW索引，仅适合小规模语料）")
+    parser.add_argument("--output", default="bench_output.json", help="结果输出路径")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = build_parser().parse_args(argv)
+    benchmark = RetrievalBenchmark(args)
+    results: List[BenchmarkResult] = []
+    for size in map(parse_size, args.sizes):
+        results.extend(benchmark.run_size(size))
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "qdrant_mode": "server" if args.qdrant_url else "memory",
+            "args": vars(args),
+        },
+        "results": [asdict(result) for result in results],
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.info(f"共 {len(results)} 组结果，已写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,542 @@
+"""
+日历本地镜像
+
+为日历在本地sqlite中维护一份日程索引：首次全量拉取，之后用飞书的 sync_token 增量同步，
+并订阅日历变更事件，收到变更通知后在后台立即补一次增量同步。
+查询日程、冲突检查和日程匹配都直接读本地索引，写操作仍然调用飞书接口，成功后把结果写回镜像。
+日程工具以应用（tenant）身份调用飞书，没有用户访问令牌，所有用户操作的都是应用的主日历，
+镜像和主日历ID缓存因此都按日历而不是按用户区分；主日历ID在进程内缓存，飞书返回日历不存在时失效。
+
+命令行查看各日历的新鲜度与同步延迟：
+    python -m src.CalendarMirror
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("CalendarMirror")
+
+# 日程工具统一使用 Asia/Shanghai
+LOCAL_TZ = timezone(timedelta(hours=8))
+
+# 飞书日历接口中表示日历不存在、已删除或无权访问的错误码，出现时缓存的日历ID失效
+CALENDAR_NOT_FOUND_CODES = {191000, 191001, 191002}
+
+# 查询日程未指定时间范围时，默认查看过去几天到未来几天
+SEARCH_LOOKBACK_DAYS = int(os.getenv("SCHEDULE_LOOKBACK_DAYS", "7"))
+SEARCH_LOOKAHEAD_DAYS = int(os.getenv("SCHEDULE_LOOKAHEAD_DAYS", "30"))
+
+
+def get_calendar_state_dir() -> str:
+    """日历镜像所在目录"""
+    path = os.getenv("CALENDAR_STATE_DIR", "./calendar_state")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def to_timestamp(value: Any) -> Optional[int]:
+    """
+    把秒级时间戳、ISO-8601 时间或 yyyy-MM-dd 日期统一转换为秒级时间戳
+
+    没有时区的时间按 Asia/Shanghai 处理
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip()
+    if text.isdigit():
+        return int(text)
+    moment = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=LOCAL_TZ)
+    return int(moment.timestamp())
+
+
+def format_timestamp(ts: int) -> str:
+    return datetime.fromtimestamp(ts, LOCAL_TZ).isoformat()
+
+
+def format_range(start: int, end: Optional[int]) -> str:
+    """格式化为 "2024-06-01 10:00~11:00"，跨天时结束部分带日期"""
+    begin = format_timestamp(start)
+    if end is None:
+        return f"{begin[:10]} {begin[11:16]}"
+    finish = format_timestamp(end)
+    return f"{begin[:10]} {begin[11:16]}~{finish[11:16] if finish[:10] == begin[:10] else finish[:10] + ' ' + finish[11:16]}"
+
+
+def default_window(time_min: Any = None, time_max: Any = None) -> Tuple[int, int]:
+    """
+    补全查询时间范围，缺省的一端按当前时间前后 SEARCH_LOOKBACK_DAYS / SEARCH_LOOKAHEAD_DAYS 天取值
+
+    Returns:
+        (开始, 结束) 秒级时间戳
+    """
+    now = int(time.time())
+    lower = to_timestamp(time_min)
+    upper = to_timestamp(time_max)
+    if lower is None:
+        lower = min(now, upper if upper is not None else now) - SEARCH_LOOKBACK_DAYS * 86400
+    if upper is None:
+        upper = max(now, lower) + SEARCH_LOOKAHEAD_DAYS * 86400
+    return lower, upper
+
+
+class CalendarSyncError(RuntimeError):
+    """调用飞书日程接口失败"""
+
+    def __init__(self, code: int, msg: str) -> None:
+        super().__init__(f"{code}: {msg}")
+        self.code = code
+        self.msg = msg
+
+
+@dataclass
+class MirroredEvent:
+    calendar_id: str
+    event_id: str
+    summary: str = ""
+    description: str = ""
+    # 秒级时间戳，全天日程为当天零点
+    start: Optional[int] = None
+    end: Optional[int] = None
+    is_all_day: bool = False
+    status: str = "confirmed"
+    free_busy: str = "busy"
+    updated_at: float = 0.0
+
+    def matches(self, keyword: Optional[str]) -> bool:
+        return not keyword or keyword in self.summary or keyword in self.description
+
+    def to_compact(self) -> Dict[str, Any]:
+        """
+        转换为返回给模型的紧凑结构
+
+        时间合并为一个字符串，空描述省略，长描述截断，减少写入提示词的token
+        """
+        item: Dict[str, Any] = {"id": self.event_id, "summary": self.summary, "time": self.time_range()}
+        if self.is_all_day:
+            item["isAllDay"] = True
+        if self.description:
+            item["description"] = self.description[:100] + ("…" if len(self.description) > 100 else "")
+        return item
+
+    def time_range(self) -> str:
+        if self.start is None:
+            return ""
+        start = format_timestamp(self.start)
+        if self.is_all_day:
+            # 全天日程的结束日期是开区间
+            last = format_timestamp(self.end - 86400)[:10] if self.end and self.end - self.start > 86400 else None
+            return start[:10] + (f"~{last}" if last else "")
+        return format_range(self.start, self.end)
+
+
+def _time_of(info: Any) -> Tuple[Optional[int], bool]:
+    if info is None:
+        return None, False
+    date = getattr(info, "date", None)
+    if date:
+        return to_timestamp(date), True
+    return to_timestamp(getattr(info, "timestamp", None)), False
+
+
+def event_from_feishu(calendar_id: str, event: Any) -> MirroredEvent:
+    """把飞书SDK返回的日程对象转换为镜像记录"""
+    start, all_day = _time_of(event.start_time)
+    end, _ = _time_of(event.end_time)
+    return MirroredEvent(
+        calendar_id=calendar_id,
+        event_id=event.event_id,
+        summary=event.summary or "",
+        description=event.description or "",
+        start=start,
+        end=end,
+        is_all_day=all_day,
+        status=event.status or "confirmed",
+        free_busy=getattr(event, "free_busy_status", None) or "busy",
+        updated_at=time.time(),
+    )
+
+
+def _row_to_event(row: tuple) -> MirroredEvent:
+    return MirroredEvent(row[0], row[1], row[2] or "", row[3] or "", row[4], row[5], bool(row[6]), row[7], row[8], row[9])
+
+
+def iter_event_pages(client: Any, calendar_id: str, time_min: Any = None, time_max: Any = None,
+                     sync_token: Optional[str] = None, page_size: int = 500) -> Iterator[Any]:
+    """
+    按页拉取日程，惰性跟随 page_token，调用方停止迭代后不再请求后续页
+
+    Args:
+        time_min: 服务端按时间过滤的开始时间，不能与 sync_token 同时使用
+        time_max: 服务端按时间过滤的结束时间
+        sync_token: 增量同步 token，None 表示全量
+
+    Yields:
+        每页的响应数据，包含 items、sync_token 等字段
+    """
+    from lark_oapi.api.calendar.v4 import ListCalendarEventRequest
+
+    page_token = None
+    while True:
+        builder = ListCalendarEventRequest.builder().calendar_id(calendar_id).page_size(page_size)
+        if time_min is not None:
+            builder.start_time(str(to_timestamp(time_min)))
+        if time_max is not None:
+            builder.end_time(str(to_timestamp(time_max)))
+        if sync_token:
+            builder.sync_token(sync_token)
+        if page_token:
+            builder.page_token(page_token)
+        response = client.calendar.v4.calendar_event.list(builder.build())
+        if not response.success():
+            raise CalendarSyncError(response.code, response.msg)
+        yield response.data
+        if not response.data.has_more or not response.data.page_token:
+            return
+        page_token = response.data.page_token
+
+
+def iter_events(client: Any, calendar_id: str, time_min: Any = None, time_max: Any = None,
+                page_size: int = 500) -> Iterator[MirroredEvent]:
+    """逐条返回时间范围内未取消的日程，直接查询飞书，用于镜像不可用时"""
+    for data in iter_event_pages(client, calendar_id, time_min, time_max, page_size=page_size):
+        for item in data.items or []:
+            event = event_from_feishu(calendar_id, item)
+            if event.status != "cancelled":
+                yield event
+
+
+class PrimaryCalendarResolver:
+    """
+    缓存应用（tenant）身份的主日历ID，带过期时间，线程安全
+
+    calendar.primary 以应用身份调用，不带用户令牌，返回的总是应用自己的主日历，所以只缓存一份
+    """
+
+    def __init__(self, client: Any, ttl: float = float(os.getenv("CALENDAR_ID_TTL", "3600"))) -> None:
+        """
+        Args:
+            client: 飞书SDK客户端
+            ttl: 缓存的主日历ID多少秒后重新查询
+        """
+        self.client = client
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (主日历ID, 过期时间)
+        self._entry: Optional[Tuple[str, float]] = None
+        self.counters = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def resolve(self) -> str:
+        """返回应用的主日历ID，未缓存或已过期时调用一次 calendar.primary"""
+        with self._lock:
+            entry = self._entry
+            if entry and entry[1] > time.monotonic():
+                self.counters["hits"] += 1
+                return entry[0]
+            self.counters["misses"] += 1
+
+        from lark_oapi.api.calendar.v4 import PrimaryCalendarRequest
+
+        request = PrimaryCalendarRequest.builder().user_id_type("open_id").build()
+        response = self.client.calendar.v4.calendar.primary(request)
+        if not response.success():
+            raise CalendarSyncError(response.code, response.msg)
+        calendars = response.data.calendars if response.data else None
+        if not calendars or not calendars[0].calendar:
+            raise CalendarSyncError(0, "未找到主日历")
+        calendar_id = calendars[0].calendar.calendar_id
+        with self._lock:
+            self._entry = (calendar_id, time.monotonic() + self.ttl)
+        return calendar_id
+
+    def invalidate(self, calendar_id: str) -> None:
+        """缓存的主日历正是该日历时丢弃缓存"""
+        with self._lock:
+            if self._entry and self._entry[0] == calendar_id:
+                self._entry = None
+                self.counters["invalidations"] += 1
+
+    def check(self, calendar_id: str, code: int) -> None:
+        """飞书返回日历不存在类错误码时使缓存失效，下次调用重新解析"""
+        if code in CALENDAR_NOT_FOUND_CODES:
+            logger.warning(f"日历 {calendar_id} 不存在或不可访问（{code}），清除缓存")
+            self.invalidate(calendar_id)
+
+
+_EVENT_COLUMNS = "calendar_id, event_id, summary, description, start_ts, end_ts, is_all_day, status, free_busy, updated_at"
+
+
+class CalendarMirror:
+    """基于sqlite的日历镜像，线程安全"""
+
+    def __init__(self, client: Any = None, path: Optional[str] = None,
+                 max_staleness: float = float(os.getenv("CALENDAR_MAX_STALENESS", "300")),
+                 page_size: int = int(os.getenv("CALENDAR_PAGE_SIZE", "500"))) -> None:
+        """
+        Args:
+            client: 飞书SDK客户端，为 None 时只能读取本地镜像
+            path: sqlite文件路径，None则使用 CALENDAR_STATE_DIR/calendar.sqlite3
+            max_staleness: 距上次同步超过该秒数时，查询前先做一次增量同步（订阅失效时的兜底）
+            page_size: 同步时每页拉取的日程数
+        """
+        self.client = client
+        self.max_staleness = max_staleness
+        self.page_size = page_size
+        self.path = path or os.path.join(get_calendar_state_dir(), "calendar.sqlite3")
+        self._lock = threading.Lock()
+        self._sync_locks: Dict[str, threading.Lock] = {}
+        # 变更通知触发的同步在后台单线程执行，不阻塞事件回调
+        self._background = ThreadPoolExecutor(max_workers=1, thread_name_prefix="calendar-sync")
+        self.counters = {"queries": 0, "syncs": 0, "full_syncs": 0, "sync_errors": 0, "notifications": 0}
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS calendars ("
+                "calendar_id TEXT PRIMARY KEY, sync_token TEXT, synced_at REAL, "
+                "changed_at REAL, last_lag REAL, last_duration REAL, subscribed INTEGER DEFAULT 0)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "calendar_id TEXT NOT NULL, event_id TEXT NOT NULL, summary TEXT, description TEXT, "
+                "start_ts INTEGER, end_ts INTEGER, is_all_day INTEGER, status TEXT, free_busy TEXT, updated_at REAL, "
+                "PRIMARY KEY (calendar_id, event_id))"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_events_start ON events(calendar_id, start_ts)")
+
+    # ---- 同步 ----
+
+    def _sync_lock(self, calendar_id: str) -> threading.Lock:
+        with self._lock:
+            return self._sync_locks.setdefault(calendar_id, threading.Lock())
+
+    def _state(self, calendar_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT sync_token, synced_at, changed_at, subscribed FROM calendars WHERE calendar_id = ?",
+                (calendar_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("sync_token", "synced_at", "changed_at", "subscribed"), row))
+
+    def _pull(self, calendar_id: str, sync_token: Optional[str]) -> Tuple[List[Any], Optional[str]]:
+        """拉取全部（或自 sync_token 以来变化的）日程，同步需要最后一页返回的新 sync_token"""
+        items, next_token = [], sync_token
+        for data in iter_event_pages(self.client, calendar_id, sync_token=sync_token, page_size=self.page_size):
+            items.extend(data.items or [])
+            if data.sync_token:
+                next_token = data.sync_token
+        return items, next_token
+
+    def sync(self, calendar_id: str) -> int:
+        """
+        同步一个日历，已有 sync_token 时只拉取变化的日程
+
+        增量同步失败（例如 sync_token 过期）时丢弃本地数据重新全量同步。
+
+        Returns:
+            本次写入或删除的日程数
+        """
+        with self._sync_lock(calendar_id):
+            state = self._state(calendar_id)
+            token = state["sync_token"] if state else None
+            started = time.time()
+            try:
+                items, next_token = self._pull(calendar_id, token)
+            except CalendarSyncError as e:
+                self.counters["sync_errors"] += 1
+                if not token:
+                    raise
+                logger.warning(f"日历 {calendar_id} 增量同步失败（{e}），改为全量同步")
+                token = None
+                items, next_token = self._pull(calendar_id, None)
+
+            events = [event_from_feishu(calendar_id, item) for item in items]
+            finished = time.time()
+            lag = None
+            if state and state["changed_at"] and (not state["synced_at"] or state["changed_at"] > state["synced_at"]):
+                lag = finished - state["changed_at"]
+            with self._lock, self.conn:
+                if not token:
+                    self.conn.execute("DELETE FROM events WHERE calendar_id = ?", (calendar_id,))
+                self._write_events(events)
+                self.conn.execute(
+                    "INSERT INTO calendars (calendar_id, sync_token, synced_at, last_lag, last_duration) "
+                    "VALUES (?, ?, ?, ?, ?) ON CONFLICT(calendar_id) DO UPDATE SET "
+                    "sync_token = excluded.sync_token, "
+                    "synced_at = excluded.synced_at, last_lag = COALESCE(excluded.last_lag, last_lag), "
+                    "last_duration = excluded.last_duration",
+                    (calendar_id, next_token, started, lag, finished - started),
+                )
+            self.counters["syncs"] += 1
+            if not token:
+                self.counters["full_syncs"] += 1
+            logger.info(
+                f"日历 {calendar_id} {'增量' if token else '全量'}同步 {len(events)} 条，耗时 {finished - started:.2f}s"
+                + (f"，变更延迟 {lag:.2f}s" if lag is not None else "")
+            )
+            if not state or not state["subscribed"]:
+                self.subscribe(calendar_id)
+            return len(events)
+
+    def _write_events(self, events: List[MirroredEvent]) -> None:
+        # 调用方持有锁；已取消的日程直接从镜像中删除
+        self.conn.executemany(
+            "DELETE FROM events WHERE calendar_id = ? AND event_id = ?",
+            [(e.calendar_id, e.event_id) for e in events if e.status == "cancelled"],
+        )
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO events ({_EVENT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (e.calendar_id, e.event_id, e.summary, e.description, e.start, e.end,
+                 int(e.is_all_day), e.status, e.free_busy, e.updated_at)
+                for e in events if e.status != "cancelled"
+            ],
+        )
+
+    def subscribe(self, calendar_id: str) -> bool:
+        """订阅日历变更事件，失败时只依赖 max_staleness 兜底"""
+        from lark_oapi.api.calendar.v4 import SubscriptionCalendarEventRequest
+
+        request = SubscriptionCalendarEventRequest.builder().calendar_id(calendar_id).build()
+        response = self.client.calendar.v4.calendar_event.subscription(request)
+        if not response.success():
+            logger.warning(f"订阅日历 {calendar_id} 变更失败: {response.code}: {response.msg}")
+            return False
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE calendars SET subscribed = 1 WHERE calendar_id = ?", (calendar_id,))
+        return True
+
+    def mark_changed(self, calendar_id: str) -> None:
+        """收到日历变更通知：记录通知时间并在后台补一次增量同步"""
+        self.counters["notifications"] += 1
+        with self._lock, self.conn:
+            cursor = self.conn.execute(
+                "UPDATE calendars SET changed_at = ? WHERE calendar_id = ?", (time.time(), calendar_id)
+            )
+        if cursor.rowcount and self.client is not None:
+            self._background.submit(self._sync_quietly, calendar_id)
+
+    def _sync_quietly(self, calendar_id: str) -> None:
+        try:
+            self.sync(calendar_id)
+        except Exception as e:
+            logger.error(f"日历 {calendar_id} 后台同步失败: {e}")
+
+    def ensure_fresh(self, calendar_id: str) -> None:
+        """首次使用时全量同步；有未处理的变更通知或超过 max_staleness 时增量同步"""
+        state = self._state(calendar_id)
+        if (
+            state is None
+            or not state["synced_at"]
+            or (state["changed_at"] and state["changed_at"] > state["synced_at"])
+            or time.time() - state["synced_at"] > self.max_staleness
+        ):
+            self.sync(calendar_id)
+
+    # ---- 查询 ----
+
+    def query(self, calendar_id: str, time_min: Any = None, time_max: Any = None,
+              keyword: Optional[str] = None, limit: Optional[int] = None) -> List[MirroredEvent]:
+        """
+        查询与时间范围有交集的日程，按开始时间排序
+
+        Args:
+            time_min: 范围开始，时间戳或 ISO-8601 字符串，None 表示不限
+            time_max: 范围结束，同上
+            keyword: 只返回标题或描述包含该关键词的日程
+            limit: 最多返回的条数
+        """
+        self.ensure_fresh(calendar_id)
+        self.counters["queries"] += 1
+        sql = f"SELECT {_EVENT_COLUMNS} FROM events WHERE calendar_id = ?"
+        params: List[Any] = [calendar_id]
+        lower, upper = to_timestamp(time_min), to_timestamp(time_max)
+        if lower is not None:
+            sql += " AND COALESCE(end_ts, start_ts) > ?"
+            params.append(lower)
+        if upper is not None:
+            sql += " AND start_ts < ?"
+            params.append(upper)
+        if keyword:
+            sql += " AND (instr(summary, ?) > 0 OR instr(description, ?) > 0)"
+            params.extend([keyword, keyword])
+        sql += " ORDER BY start_ts"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [_row_to_event(row) for row in rows]
+
+    def get(self, calendar_id: str, event_id: str) -> Optional[MirroredEvent]:
+        """镜像中的某个日程，不触发同步；用于写操作前取得原来的时间"""
+        with self._lock:
+            row = self.conn.execute(
+                f"SELECT {_EVENT_COLUMNS} FROM events WHERE calendar_id = ? AND event_id = ?", (calendar_id, event_id)
+            ).fetchone()
+        return _row_to_event(row) if row else None
+
+    def busy(self, calendar_id: str, time_min: Any, time_max: Any) -> List[Tuple[int, int]]:
+        """时间范围内的忙碌时段，用于冲突检查"""
+        return [
+            (e.start, e.end or e.start)
+            for e in self.query(calendar_id, time_min, time_max)
+            if e.free_busy != "free" and e.start is not None
+        ]
+
+    # ---- 写回 ----
+
+    def apply(self, calendar_id: str, event: Any) -> None:
+        """创建或修改日程成功后，把飞书返回的日程写回镜像"""
+        if event is None:
+            return
+        with self._lock, self.conn:
+            self._write_events([event_from_feishu(calendar_id, event)])
+
+    def remove(self, calendar_id: str, event_id: str) -> None:
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM events WHERE calendar_id = ? AND event_id = ?", (calendar_id, event_id))
+
+    # ---- 指标 ----
+
+    def stats(self) -> Dict[str, Any]:
+        """各日历的日程数、距上次同步的秒数、未处理的变更以及最近一次变更到同步完成的延迟"""
+        now = time.time()
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT c.calendar_id, c.synced_at, c.changed_at, c.last_lag, c.last_duration, c.subscribed, "
+                "(SELECT COUNT(*) FROM events e WHERE e.calendar_id = c.calendar_id) "
+                "FROM calendars c ORDER BY c.calendar_id"
+            ).fetchall()
+        calendars = [
+            {
+                "calendar_id": calendar_id,
+                "event_count": count,
+                "staleness_seconds": round(now - synced_at, 1) if synced_at else None,
+                "pending_change": bool(changed_at and (not synced_at or changed_at > synced_at)),
+                "last_sync_lag_seconds": round(lag, 3) if lag is not None else None,
+                "last_sync_seconds": round(duration, 3) if duration is not None else None,
+                "subscribed": bool(subscribed),
+            }
+            for calendar_id, synced_at, changed_at, lag, duration, subscribed, count in rows
+        ]
+        return {"calendars": calendars, **self.counters}
+
+
+def main() -> None:
+    print(json.dumps(CalendarMirror().stats(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
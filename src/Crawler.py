@@ -0,0 +1,318 @@
+"""
+站点抓取
+
+从 sitemap.xml 或种子URL出发发现同站页面，交给入库流水线抓取：
+URL先规范化再去重，遵守 robots.txt 与 Crawl-delay，发现的页面记录在持久化的待抓取队列中，
+大规模抓取中断后可按同一个 crawl_id 继续。
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from urllib.robotparser import RobotFileParser
+from xml.etree import ElementTree
+
+import aiohttp
+
+from .Fetcher import FetchError, FetchSession
+from .Manifest import IngestManifest, get_state_dir
+
+logger = logging.getLogger("Crawler")
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+# 去重时忽略的跟踪参数
+_TRACKING_PARAMS = re.compile(r"^(utm_\w+|spm|from|fbclid|gclid)$")
+
+
+def normalize_url(url: str) -> Optional[str]:
+    """
+    规范化URL用于去重：小写协议与主机、去掉默认端口、片段和跟踪参数、查询参数排序
+
+    Returns:
+        规范化后的URL，非 http(s) 链接返回None
+    """
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in _DEFAULT_PORTS or not parts.hostname:
+        return None
+    host = parts.hostname.lower()
+    netloc = host if port is None or port == _DEFAULT_PORTS[scheme] else f"{host}:{port}"
+    path = re.sub(r"/{2,}", "/", parts.path or "/")
+    query = urlencode(sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not _TRACKING_PARAMS.match(k)
+    ))
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+
+class CrawlFrontier:
+    """持久化的待抓取队列，按 crawl_id 区分不同的抓取"""
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path or os.path.join(get_state_dir(), "crawl.sqlite3")
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS crawls (id TEXT PRIMARY KEY, params TEXT, created_at REAL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS frontier ("
+                "crawl_id TEXT NOT NULL, url TEXT NOT NULL, depth INTEGER NOT NULL, status TEXT NOT NULL, "
+                "PRIMARY KEY (crawl_id, url))"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_frontier_status ON frontier(crawl_id, status)")
+
+    def exists(self, crawl_id: str) -> bool:
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM crawls WHERE id = ?", (crawl_id,)).fetchone() is not None
+
+    def register(self, crawl_id: str, params: dict) -> bool:
+        """登记抓取，返回是否为新抓取"""
+        with self._lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO crawls (id, params, created_at) VALUES (?, ?, ?)",
+                (crawl_id, json.dumps(params, ensure_ascii=False), time.time()),
+            )
+            if cursor.rowcount == 0:
+                # 上次中断时正在抓取的URL重新排队
+                self.conn.execute(
+                    "UPDATE frontier SET status = 'pending' WHERE crawl_id = ? AND status = 'in_flight'",
+                    (crawl_id,),
+                )
+        return cursor.rowcount > 0
+
+    def add(self, crawl_id: str, entries: Iterable[Tuple[str, int]], max_pages: int) -> int:
+        """加入新发现的URL，已存在的忽略，总数不超过 max_pages，返回新加入的数量"""
+        with self._lock, self.conn:
+            total = self.conn.execute(
+                "SELECT COUNT(*) FROM frontier WHERE crawl_id = ? AND status != 'disallowed'", (crawl_id,)
+            ).fetchone()[0]
+            added = 0
+            for url, depth in entries:
+                if total + added >= max_pages:
+                    break
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO frontier (crawl_id, url, depth, status) VALUES (?, ?, ?, 'pending')",
+                    (crawl_id, url, depth),
+                )
+                added += cursor.rowcount
+        return added
+
+    def next_pending(self, crawl_id: str, limit: int) -> List[Tuple[str, int]]:
+        """按深度优先取出待抓取的URL（浅层优先）"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT url, depth FROM frontier WHERE crawl_id = ? AND status = 'pending' ORDER BY depth LIMIT ?",
+                (crawl_id, limit),
+            ).fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+    def set_status(self, crawl_id: str, url: str, status: str) -> None:
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE frontier SET status = ? WHERE crawl_id = ? AND url = ?", (status, crawl_id, url)
+            )
+
+    def counts(self, crawl_id: str) -> Dict[str, int]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT status, COUNT(*) FROM frontier WHERE crawl_id = ? GROUP BY status", (crawl_id,)
+            ).fetchall()
+        return {row[0]: row[1] for row in rows}
+
+
+class SiteCrawler:
+    """同站抓取：向入库流水线提供待抓取的URL，并接收解析出的链接"""
+
+    def __init__(self,
+                 crawl_id: str,
+                 seed: Optional[str] = None,
+                 sitemap: Optional[str] = None,
+                 max_depth: Optional[int] = None,
+                 path_prefix: Optional[str] = None,
+                 max_pages: int = int(os.getenv("CRAWL_MAX_PAGES", "1000")),
+                 frontier: Optional[CrawlFrontier] = None,
+                 manifest: Optional[IngestManifest] = None,
+                 default_delay: float = float(os.getenv("CRAWL_DELAY", "0")),
+                 max_delay: float = float(os.getenv("CRAWL_MAX_DELAY", "10"))) -> None:
+        """
+        Args:
+            crawl_id: 抓取ID，相同ID的抓取从持久化队列继续
+            seed: 种子页面URL，与 sitemap 二选一
+            sitemap: sitemap.xml 地址，支持 sitemap index 与 .gz
+            max_depth: 从种子或sitemap页面出发跟随链接的层数，默认种子为2、sitemap为0
+            path_prefix: 只抓取路径以此开头的页面，默认为整站
+            max_pages: 本次抓取最多发现的页面数
+            frontier: 待抓取队列，None则使用 INGEST_STATE_DIR 下的默认库
+            manifest: 入库清单，用于对不需要再发现链接的页面发送条件请求
+            default_delay: robots.txt 未声明 Crawl-delay 时同一站点的请求间隔（秒）
+            max_delay: Crawl-delay 的上限（秒）
+        """
+        if bool(seed) == bool(sitemap):
+            raise ValueError("seed 与 sitemap 必须且只能提供一个")
+        root = normalize_url(seed or sitemap)
+        if root is None:
+            raise ValueError(f"无效的URL: {seed or sitemap}")
+        self.crawl_id = crawl_id
+        self.seed = root if seed else None
+        self.sitemap = root if sitemap else None
+        self.max_depth = max_depth if max_depth is not None else (0 if sitemap else 2)
+        self.host = urlsplit(root).netloc
+        self.path_prefix = path_prefix or "/"
+        self.max_pages = max_pages
+        self.frontier = frontier or CrawlFrontier()
+        self.manifest = manifest
+        self.default_delay = default_delay
+        self.max_delay = max_delay
+        self.session: Optional[FetchSession] = None
+        self.robots: Dict[str, Optional[RobotFileParser]] = {}
+        # 已交给流水线、尚未处理完的URL -> 深度
+        self.in_flight: Dict[str, int] = {}
+        self._changed = asyncio.Event()
+
+    @property
+    def params(self) -> dict:
+        return {
+            "seed": self.seed, "sitemap": self.sitemap, "max_depth": self.max_depth,
+            "path_prefix": self.path_prefix, "max_pages": self.max_pages,
+        }
+
+    def in_scope(self, url: str) -> bool:
+        parts = urlsplit(url)
+        return parts.netloc == self.host and parts.path.startswith(self.path_prefix)
+
+    async def prepare(self, session: FetchSession) -> None:
+        """绑定抓取会话；新抓取时写入种子或sitemap中的页面"""
+        self.session = session
+        if self.frontier.exists(self.crawl_id):
+            self.frontier.register(self.crawl_id, self.params)
+            logger.info(f"继续抓取 {self.crawl_id}: {self.frontier.counts(self.crawl_id)}")
+            return
+        if self.seed:
+            entries = [self.seed]
+        else:
+            entries = [url for url in await self._read_sitemap(self.sitemap) if self.in_scope(url)]
+            logger.info(f"sitemap 中共 {len(entries)} 个范围内的页面")
+        # sitemap 读取成功后才登记，失败的抓取不会留下空队列
+        self.frontier.register(self.crawl_id, self.params)
+        self.frontier.add(self.crawl_id, ((url, 0) for url in entries), self.max_pages)
+
+    async def urls(self) -> AsyncIterator[str]:
+        """依次产出待抓取的URL，队列为空且没有处理中的页面时结束"""
+        while True:
+            batch = self.frontier.next_pending(self.crawl_id, 64)
+            if not batch:
+                if not self.in_flight:
+                    return
+                # 等待处理中的页面发现新链接
+                self._changed.clear()
+                await self._changed.wait()
+                continue
+            for url, depth in batch:
+                if not await self._allowed(url):
+                    self.frontier.set_status(self.crawl_id, url, "disallowed")
+                    continue
+                self.frontier.set_status(self.crawl_id, url, "in_flight")
+                self.in_flight[url] = depth
+                yield url
+
+    def validator(self, url: str) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        """不再需要发现链接的页面可以发送条件请求，未变化时不必下载"""
+        if self.manifest is None or self.in_flight.get(url, 0) < self.max_depth:
+            return None
+        record = self.manifest.get_source(url)
+        if record and (record.etag or record.last_modified):
+            return record.etag, record.last_modified
+        return None
+
+    def done(self, url: str, links: Optional[List[str]] = None, status: str = "done") -> None:
+        """页面处理完毕，把范围内的新链接加入队列"""
+        depth = self.in_flight.pop(url, None)
+        self.frontier.set_status(self.crawl_id, url, status)
+        if links and depth is not None and depth < self.max_depth:
+            found = dict.fromkeys(
+                normalized for normalized in map(normalize_url, links)
+                if normalized and self.in_scope(normalized)
+            )
+            self.frontier.add(self.crawl_id, ((link, depth + 1) for link in found), self.max_pages)
+        self._changed.set()
+
+    def summary(self) -> dict:
+        return {"crawl_id": self.crawl_id, **self.params, "frontier": self.frontier.counts(self.crawl_id)}
+
+    async def _allowed(self, url: str) -> bool:
+        parts = urlsplit(url)
+        if parts.netloc not in self.robots:
+            parser = await self._read_robots(f"{parts.scheme}://{parts.netloc}/robots.txt")
+            self.robots[parts.netloc] = parser
+            agent = self.session.fetcher.headers["User-Agent"]
+            delay = (parser.crawl_delay(agent) if parser else None) or self.default_delay
+            if delay:
+                self.session.set_crawl_delay(parts.netloc, min(float(delay), self.max_delay))
+        parser = self.robots[parts.netloc]
+        return parser is None or parser.can_fetch(self.session.fetcher.headers["User-Agent"], url)
+
+    async def _read_robots(self, url: str) -> Optional[RobotFileParser]:
+        """读取 robots.txt，不存在或无法访问时视为不限制"""
+        try:
+            async with self.session.session.get(url) as response:
+                if response.status != 200:
+                    return None
+                text = await response.text(errors="replace")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"读取 robots.txt 失败 {url}: {e}")
+            return None
+        parser = RobotFileParser(url)
+        parser.parse(text.splitlines())
+        return parser
+
+    async def _read_sitemap(self, url: str, level: int = 0) -> List[str]:
+        """读取sitemap中的页面地址，sitemap index 最多展开3层；下载和解压后的大小都受 FETCH_MAX_BYTES 限制"""
+        try:
+            body = (await self.session.fetch(url, binary=True)).body
+        except FetchError as e:
+            raise FetchError(f"读取sitemap失败 {url}: {e}") from e
+        if url.endswith(".gz") or body[:2] == b"\x1f\x8b":
+            body = self._gunzip(url, body, self.session.fetcher.max_bytes)
+        try:
+            root = ElementTree.fromstring(body)
+        except ElementTree.ParseError as e:
+            raise FetchError(f"sitemap 格式错误 {url}: {e}") from e
+        # 只取 <url>/<sitemap> 下直接的 <loc>，忽略图片等扩展标签
+        locs = [
+            node.text.strip() for entry in root for node in entry
+            if node.tag.rsplit("}", 1)[-1] == "loc" and node.text and node.text.strip()
+        ]
+        if not root.tag.endswith("sitemapindex"):
+            return [normalized for normalized in map(normalize_url, locs) if normalized]
+        if level >= 3:
+            return []
+        urls: List[str] = []
+        for child in locs:
+            urls.extend(await self._read_sitemap(child, level + 1))
+        return urls
+
+    @staticmethod
+    def _gunzip(url: str, body: bytes, max_bytes: int) -> bytes:
+        """解压 gzip，解压结果超过 max_bytes 时放弃，不会先在内存中展开整个文件"""
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            data = decompressor.decompress(body, max_bytes + 1)
+        except zlib.error as e:
+            raise FetchError(f"sitemap 解压失败 {url}: {e}") from e
+        if len(data) > max_bytes:
+            raise FetchError(f"sitemap 解压后超过 {max_bytes} 字节上限 {url}")
+        if not decompressor.eof:
+            raise FetchError(f"sitemap 压缩数据不完整 {url}")
+        return data
@@ -0,0 +1,131 @@
+"""
+批量并发嵌入
+
+把待入库的分片切成固定大小的批次，在并发上限和每分钟token上限内调用嵌入接口，
+每批完成后立即写入Qdrant。单个批次失败只重试该批次，不会丢弃整次入库。
+"""
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from langchain_core.documents import Document
+
+from .VectorStore import VectorStoreService
+
+logger = logging.getLogger("Embedder")
+
+_CJK_RE = re.compile(r"[㐀-鿿豈-﫿]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：中日韩字符约1字1token，其他字符约4字符1token"""
+    cjk = len(CJK_RE.findall(text))
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+class TokenRateLimiter:
+    """每分钟token数的令牌桶，tokens_per_minute<=0 表示不限流"""
+
+    def __init__(self, tokens_per_minute: int) -> None:
+        self.capacity = tokens_per_minute
+        self.available = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int) -> None:
+        if self.capacity <= 0:
+            return
+        # 单批超过桶容量时按容量计，避免永远等不到
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60)
+                self.updated = now
+                if self.available >= tokens:
+                    self.available -= tokens
+                    return
+                await asyncio.sleep((tokens - self.available) * 60 / self.capacity)
+
+
+@dataclass
+class EmbeddingStats:
+    total_chunks: int = 0
+    written_chunks: int = 0
+    failed_chunks: int = 0
+    batches: int = 0
+    failed_batches: int = 0
+    retries: int = 0
+    elapsed: float = 0.0
+    errors: List[str] = field(default_factory=list)
+    failed_ids: List[str] = field(default_factory=list)
+
+    @property
+    def chunks_per_sec(self) -> float:
+        return self.written_chunks / self.elapsed if self.elapsed else 0.0
+
+    def to_dict(self) -> Dict:
+        return {
+            "total_chunks": self.total_chunks,
+            "written_chunks": self.written_chunks,
+            "failed_chunks": self.failed_chunks,
+            "batches": self.batches,
+            "failed_batches": self.failed_batches,
+            "retries": self.retries,
+            "elapsed": round(self.elapsed, 3),
+            "chunks_per_sec": round(self.chunks_per_sec, 2),
+            "errors": self.errors[:10],
+        }
+
+
+class EmbeddingPipeline:
+    """批次大小、并发上限、token限流与重试；批次调度和写入由 IngestionPipeline 完成"""
+
+    def __init__(self,
+                 store: VectorStoreService,
+                 batch_size: int = int(os.getenv("EMBED_BATCH_SIZE", "32")),
+                 max_concurrency: int = int(os.getenv("EMBED_MAX_CONCURRENCY", "4")),
+                 tokens_per_minute: int = int(os.getenv("EMBED_TOKENS_PER_MINUTE", "0")),
+                 max_retries: int = int(os.getenv("EMBED_MAX_RETRIES", "3")),
+                 backoff_base: float = 1.0,
+                 yield_to_reads: float = 0.0) -> None:
+        """
+        Args:
+            store: 写入目标向量库
+            batch_size: 每批嵌入的分片数，同时也是每次写入Qdrant的点数
+            max_concurrency: 同时进行的批次上限
+            tokens_per_minute: 嵌入接口的每分钟token上限，0表示不限
+            max_retries: 单个批次失败后的重试次数
+            backoff_base: 重试退避基数（秒）
+            yield_to_reads: 每批写入前为进行中的检索最多让路的秒数，0表示不让路
+        """
+        self.store = store
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.limiter = TokenRateLimiter(tokens_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.yield_to_reads = yield_to_reads
+
+    async def embed_batch(self, batch: List[Document], stats: EmbeddingStats) -> List[List[float]]:
+        """在token限流内嵌入一个批次，失败按退避重试，重试耗尽后抛出最后一次异常"""
+        texts = [doc.page_content for doc in batch]
+        tokens = sum(estimate_tokens(text) for text in texts)
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(tokens)
+            try:
+                return await self.store.embeddings.aembed_documents(texts)
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    raise
+                stats.retries += 1
+                # 限流错误退避更久
+                factor = 4 if "rate" in type(e).__name__.lower() or "429" in str(e) else 1
+                delay = self.backoff_base * factor * (2 ** attempt) * (1 + random.random())
+                logger.warning(f"嵌入批次失败，{delay:.1f}s 后第 {attempt + 1} 次重试: {e}")
+                await asyncio.sleep(delay)
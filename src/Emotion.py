@@ -1,14 +1,15 @@
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
 from dotenv import load_dotenv
 load_dotenv()
 import os
+from .ModelRouter import get_model
 
 class EmotionClass:
-    def __init__(self,model=os.getenv("BASE_MODEL")):
+    def __init__(self,model=None):
         self.chat = None
         self.Emotion = None
-        self.chatmodel = ChatOpenAI(model=model)
+        # 模型、超时等由 emotion 阶段的路由配置决定，model 仅用于临时覆盖
+        self.chatmodel = get_model("emotion", model)
 
     def Emotion_Sensing(self, input):
         # 处理输入长度
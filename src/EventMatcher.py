@@ -0,0 +1,126 @@
+"""
+日程匹配
+
+在查询到的多个日程中找出用户所指的那一个：标题、描述做模糊匹配，再结合与用户给出时间的接近程度打分。
+最高分足够高且明显领先时直接给出结果；分数接近的几个候选，或者只有一个但把握不大的候选，交给大模型判断。
+"""
+import logging
+import math
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from rapidfuzz import fuzz, utils
+
+from .CalendarMirror import to_timestamp
+
+logger = logging.getLogger("EventMatcher")
+
+# 中文没有空格分词，按单字切分；其他文字按连续字母数字切分
+_TOKEN_RE = re.compile(r"[\u4e00-\u9fff]|[a-z0-9]+")
+
+
+@dataclass
+class MatchQuery:
+    """用户描述的日程，字段都可以为空"""
+    summary: Optional[str] = None
+    description: Optional[str] = None
+    # 用户提到的时间，时间戳或 ISO-8601 字符串
+    start: Any = None
+
+
+@dataclass
+class MatchResult:
+    # 明确胜出的日程，None 表示没有匹配或需要大模型在 candidates 中选择
+    event: Optional[Dict[str, Any]] = None
+    # 分数接近、需要大模型判断的候选
+    candidates: List[Dict[str, Any]] = field(default_factory=list)
+    # (日程id, 分数)，按分数从高到低
+    scores: List[Tuple[str, float]] = field(default_factory=list)
+
+
+def _text_score(expected: Optional[str], actual: Optional[str]) -> Optional[float]:
+    if not expected or not actual:
+        return None
+    # 整体相似度对语序和多余字敏感，字词集合相似度能处理“后端面试”与“面试：后端工程师”这类说法；
+    # 中文按单字比较，只共有两三个字（“张三生日”与“和张三一对一”）也能得到不低的分，
+    # 因此集合相似度按用户说法中出现在日程里的字词比例折算
+    words = _TOKEN_RE.findall(expected.lower())
+    present = set(_TOKEN_RE.findall(actual.lower()))
+    coverage = sum(word in present for word in words) / len(words) if words else 0.0
+    return max(
+        fuzz.WRatio(expected, actual, processor=utils.default_process),
+        fuzz.token_set_ratio(" ".join(words), " ".join(present)) * coverage,
+    )
+
+
+def _parse_time(value: Any) -> Optional[int]:
+    try:
+        return to_timestamp(value)
+    except ValueError:
+        return None
+
+
+def _event_start(event: Dict[str, Any]) -> Optional[int]:
+    # SearchSchedule 返回的紧凑结构中 time 形如 "2024-06-01 10:00~11:00" 或 "2024-06-01"
+    return _parse_time((event.get("time") or "").split("~")[0].strip())
+
+
+class EventMatcher:
+    """按标题、描述相似度和时间接近程度给候选日程打分"""
+
+    def __init__(self, min_score: float = float(os.getenv("MATCH_MIN_SCORE", "40")),
+                 decide_score: float = float(os.getenv("MATCH_DECIDE_SCORE", "80")),
+                 margin: float = float(os.getenv("MATCH_MARGIN", "10")),
+                 time_scale_hours: float = 6.0) -> None:
+        """
+        Args:
+            min_score: 最高分低于该值视为没有匹配的日程
+            decide_score: 最高分不低于该值才直接判定，低于该值时即使只有一个候选也交给大模型确认
+            margin: 最高分领先第二名不少于该值时直接判定，否则分差以内的候选交给大模型
+            time_scale_hours: 时间相差该小时数时，时间得分衰减到约 37 分
+        """
+        self.min_score = min_score
+        self.decide_score = decide_score
+        self.margin = margin
+        self.time_scale = time_scale_hours * 3600
+        self.counters = {"decided": 0, "ties": 0, "no_match": 0}
+
+    def score(self, query: MatchQuery, event: Dict[str, Any]) -> float:
+        """0-100 的综合得分，只按双方都有的信息加权"""
+        signals = []
+        summary = _text_score(query.summary, event.get("summary"))
+        if summary is not None:
+            signals.append((0.6, summary))
+        description = _text_score(query.description, event.get("description"))
+        if description is not None:
+            signals.append((0.2, description))
+        expected = _parse_time(query.start)
+        actual = _event_start(event)
+        if expected is not None and actual is not None:
+            signals.append((0.2, 100 * math.exp(-abs(expected - actual) / self.time_scale)))
+        if not signals:
+            return 0.0
+        return sum(w * s for w, s in signals) / sum(w for w, _ in signals)
+
+    def match(self, query: MatchQuery, events: List[Dict[str, Any]]) -> MatchResult:
+        """
+        在候选日程中找出用户所指的一个
+
+        Returns:
+            明确胜出时 event 有值；分数接近或把握不大时 candidates 为需要大模型判断的候选；都为空表示没有匹配
+        """
+        scored = sorted(((self.score(query, e), e) for e in events), key=lambda item: item[0], reverse=True)
+        scores = [(e.get("id"), round(s, 1)) for s, e in scored]
+        if not scored or scored[0][0] < self.min_score:
+            self.counters["no_match"] += 1
+            return MatchResult(scores=scores)
+        top = scored[0][0]
+        close = [e for s, e in scored if top - s < self.margin]
+        if len(close) == 1 and top >= self.decide_score:
+            self.counters["decided"] += 1
+            return MatchResult(event=close[0], scores=scores)
+        self.counters["ties"] += 1
+        logger.info(f"日程匹配交给大模型判断 {len(close)} 个候选: {scores[:len(close)]}")
+        return MatchResult(candidates=close, scores=scores)
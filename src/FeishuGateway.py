@@ -0,0 +1,288 @@
+"""
+飞书开放接口网关
+
+所有飞书 OpenAPI 调用都经过这里：
+- 每个接口一个令牌桶，按 FEISHU_RATE_LIMIT（每秒请求数）限流，个别接口可用 FEISHU_ENDPOINT_RATE_LIMITS 单独配置；
+- 触发频控错误码或 HTTP 429 时按带抖动的指数退避重试，响应头给出重置时间时至少等到重置；
+  HTTP 5xx 只对只读请求重试，网络异常只对只读请求或尚未连上服务器的请求重试，避免创建日程、发送消息等写操作重复执行；
+- 完全相同的只读请求（GET 以及忙闲查询）在途时合并为一次调用，结果共享给所有调用方。
+
+网关对 SDK 透明：get_gateway() 返回的对象与 lark.Client 用法相同，例如
+    get_gateway(app_id, app_secret).calendar.v4.calendar_event.list(request)
+"""
+import inspect
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Optional
+
+import lark_oapi as lark
+import requests
+from urllib3.exceptions import NewConnectionError
+
+logger = logging.getLogger("FeishuGateway")
+
+# 飞书频控错误码：应用级接口频率超限、消息发送频率超限
+RATE_LIMIT_CODES = {99991400, 230020}
+
+# 方法为 POST 但只读取数据、可以合并的接口
+READ_ONLY_ENDPOINTS = {"calendar.v4.freebusy.list", "calendar.v4.freebusy.batch"}
+
+
+def _parse_rate_limits(text: str) -> Dict[str, float]:
+    # 形如 "calendar.v4.freebusy.batch=5,im.v1.message.create=50"
+    limits = {}
+    for item in text.split(","):
+        if "=" in item:
+            endpoint, rate = item.split("=", 1)
+            limits[endpoint.strip()] = float(rate)
+    return limits
+
+
+def _not_sent(error: Exception) -> bool:
+    """异常发生在建立连接阶段，请求没有发出"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = getattr(error.args[0] if error.args else None, "reason", None)
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+class TokenBucket:
+    """每秒请求数的令牌桶，线程安全，rate<=0 表示不限流"""
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """取一个令牌，返回等待的秒数"""
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available >= 1:
+                    self.available -= 1
+                    return waited
+                delay = (1 - self.available) / self.rate
+                time.sleep(delay)
+                waited += delay
+
+
+class _Flight:
+    """一次在途的只读请求，合并进来的调用方等待它完成"""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class FeishuGateway:
+    """包装 lark.Client，为所有同步接口调用加上限流、重试与请求合并"""
+
+    def __init__(self, client: lark.Client,
+                 rate_limit: float = float(os.getenv("FEISHU_RATE_LIMIT", "50")),
+                 endpoint_rate_limits: Optional[Dict[str, float]] = None,
+                 max_retries: int = int(os.getenv("FEISHU_MAX_RETRIES", "3")),
+                 backoff_base: float = float(os.getenv("FEISHU_BACKOFF_BASE", "0.5"))) -> None:
+        """
+        Args:
+            client: 飞书SDK客户端
+            rate_limit: 每个接口默认的每秒请求数
+            endpoint_rate_limits: 个别接口的每秒请求数，None 则读取 FEISHU_ENDPOINT_RATE_LIMITS
+            max_retries: 频控或服务端错误时的最大重试次数
+            backoff_base: 退避基数（秒），第n次重试等待约 base * 2^n * (1~2)
+        """
+        self.client = client
+        self.rate_limit = rate_limit
+        self.endpoint_rate_limits = endpoint_rate_limits if endpoint_rate_limits is not None else \
+            _parse_rate_limits(os.getenv("FEISHU_ENDPOINT_RATE_LIMITS", ""))
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._inflight: Dict[str, _Flight] = {}
+        self._counters: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return _Route(self, getattr(self.client, name), name)
+
+    # ---- 调用 ----
+
+    def call(self, endpoint: str, method: Callable, request: Any, *args, **kwargs) -> Any:
+        """经由网关调用一个SDK接口方法"""
+        key = self._coalesce_key(endpoint, request, args, kwargs)
+        if key is None:
+            return self._execute(endpoint, method, request, *args, **kwargs)
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self._counters[endpoint]["coalesced"] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = self._execute(endpoint, method, request, *args, **kwargs)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.done.set()
+
+    def _execute(self, endpoint: str, method: Callable, request: Any, *args, **kwargs) -> Any:
+        counters = self._counters[endpoint]
+        for attempt in range(self.max_retries + 1):
+            waited = self._bucket(endpoint).acquire()
+            counters["calls"] += 1
+            if waited:
+                counters["throttled"] += 1
+                counters["throttled_seconds"] += waited
+            reset = None
+            try:
+                response = method(request, *args, **kwargs)
+            except Exception as e:
+                # 写请求可能已被服务端执行，只有尚未连上服务器时才重试
+                if attempt >= self.max_retries or not (self._read_only(endpoint, request) or _not_sent(e)):
+                    counters["failures"] += 1
+                    raise
+                reason = f"{type(e).__name__}: {e}"
+                counters["errors"] += 1
+            else:
+                reason, reset = self._retry_reason(response)
+                if reason is None:
+                    return response
+                counters["rate_limited" if reason == "rate_limited" else "server_errors"] += 1
+                # 频控说明请求没有被处理，任何接口都可以重试；5xx 时写请求可能已经生效，只重试只读请求
+                if attempt >= self.max_retries or (reason != "rate_limited" and not self._read_only(endpoint, request)):
+                    counters["failures"] += 1
+                    return response
+            counters["retries"] += 1
+            delay = self.backoff_base * (2 ** attempt) * (1 + random.random())
+            if reset:
+                delay = max(delay, reset)
+            logger.warning(f"飞书接口 {endpoint} 调用失败（{reason}），{delay:.1f}s 后第 {attempt + 1} 次重试")
+            time.sleep(delay)
+
+    @staticmethod
+    def _retry_reason(response: Any):
+        """判断响应是否需要重试，返回 (原因, 建议等待秒数)"""
+        raw = getattr(response, "raw", None)
+        status = getattr(raw, "status_code", None) or 0
+        if getattr(response, "code", None) in RATE_LIMIT_CODES or status == 429:
+            headers = getattr(raw, "headers", None) or {}
+            reset = headers.get("x-ogw-ratelimit-reset") or headers.get("X-Ogw-Ratelimit-Reset")
+            try:
+                return "rate_limited", float(reset) if reset else None
+            except ValueError:
+                return "rate_limited", None
+        if status >= 500:
+            return f"HTTP {status}", None
+        return None, None
+
+    def _bucket(self, endpoint: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(endpoint)
+            if bucket is None:
+                bucket = self._buckets[endpoint] = TokenBucket(self.endpoint_rate_limits.get(endpoint, self.rate_limit))
+            return bucket
+
+    @staticmethod
+    def _read_only(endpoint: str, request: Any) -> bool:
+        method = getattr(getattr(request, "http_method", None), "name", None)
+        return method == "GET" or endpoint in READ_ONLY_ENDPOINTS
+
+    @staticmethod
+    def _coalesce_key(endpoint: str, request: Any, args: tuple, kwargs: dict) -> Optional[str]:
+        # 带 RequestOption（例如用户身份）的请求不合并
+        if args or kwargs.get("option") is not None:
+            return None
+        if not FeishuGateway._read_only(endpoint, request):
+            return None
+        body = lark.JSON.marshal(request.body) if getattr(request, "body", None) is not None else None
+        return json.dumps(
+            [endpoint, getattr(request, "paths", None), sorted(getattr(request, "queries", None) or []), body],
+            ensure_ascii=False, sort_keys=True, default=str,
+        )
+
+    # ---- 指标 ----
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """各接口的调用、限流等待、重试、频控、服务端错误、合并与最终失败次数"""
+        with self._lock:
+            return {
+                endpoint: {name: round(value, 3) for name, value in counters.items()}
+                for endpoint, counters in sorted(self._counters.items())
+            }
+
+
+class _Route:
+    """沿 client.calendar.v4.calendar_event 这样的属性链前进，到达接口方法时交给网关调用"""
+
+    def __init__(self, gateway: FeishuGateway, target: Any, path: str) -> None:
+        self._gateway = gateway
+        self._target = target
+        self._path = path
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._target, name)
+        path = f"{self._path}.{name}"
+        if inspect.iscoroutinefunction(attr):
+            # 异步接口不经过网关
+            return attr
+        if inspect.ismethod(attr):
+            def call(request, *args, **kwargs):
+                return self._gateway.call(path, attr, request, *args, **kwargs)
+            return call
+        return _Route(self._gateway, attr, path)
+
+
+_gateways: Dict[str, FeishuGateway] = {}
+_gateways_lock = threading.Lock()
+
+
+def get_gateway(app_id: str, app_secret: str, log_level: lark.LogLevel = lark.LogLevel.INFO) -> FeishuGateway:
+    """
+    进程内每个应用共享一个飞书客户端和网关
+
+    飞书的频控按应用计算，共享网关才能让令牌桶覆盖该应用的全部调用
+    """
+    with _gateways_lock:
+        gateway = _gateways.get(app_id)
+        if gateway is None:
+            client = lark.Client.builder() \
+                .app_id(app_id) \
+                .app_secret(app_secret) \
+                .log_level(log_level) \
+                .build()
+            gateway = _gateways[app_id] = FeishuGateway(client)
+        return gateway
+
+
+def gateway_stats() -> Dict[str, Dict[str, Dict[str, float]]]:
+    """进程内所有网关的计数，按 app_id 分组"""
+    with _gateways_lock:
+        return {app_id: gateway.stats() for app_id, gateway in _gateways.items()}
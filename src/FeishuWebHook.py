@@ -10,6 +10,8 @@ from typing import Any
 
 from src.Agents import AgentClass
 from src.Storage import add_user, set_processing_user
+from src.Tools import on_calendar_changed
+from src.FeishuGateway import get_gateway
 from dotenv import load_dotenv as _load_dotenv
 
 _load_dotenv()
@@ -31,12 +33,8 @@ def setup_logging():
 
 logger = setup_logging()
 
-# 初始化飞书客户端
-client = lark.Client.builder() \
-    .app_id(os.getenv("FEISHU_APP_ID")) \
-    .app_secret(os.getenv("FEISHU_APP_SECRET")) \
-    .log_level(lark.LogLevel.DEBUG) \
-    .build()
+# 初始化飞书客户端，与日程工具共享同一个网关，频控按应用统一计算
+client = get_gateway(os.getenv("FEISHU_APP_ID"), os.getenv("FEISHU_APP_SECRET"), log_level=lark.LogLevel.DEBUG)
 
 
 async def process_message_async(message_text: str, user_id: str, message_id: str, chat_id: str):
@@ -46,6 +44,8 @@ async def process_message_async(message_text: str, user_id: str, message_id: str
         
         # 记录用户信息
         add_user(user_id, {"user_id": user_id, "chat_id": chat_id})
+        # 工具通过上下文取得当前用户，每个消息任务各自独立
+        set_processing_user(user_id)
         
         # 处理消息 - 直接传递用户ID
         response = AgentClass().run_agent(message_text, user_id=user_id)
@@ -142,6 +142,15 @@ def handle_message_read_v1(event: Any) -> None:
     # 这个事件通常不需要特殊处理，只是用户读取了消息的回执
 
 
+def handle_calendar_event_changed(event: Any) -> None:
+    """处理日历变更事件，通知本地镜像增量同步并使相关的工具结果缓存失效"""
+    calendar_id = getattr(event.event, "calendar_id", None) if event.event else None
+    user_ids = [u.open_id for u in event.event.user_id_list or [] if u.open_id] if event.event else []
+    logger.info(f"Calendar changed: {calendar_id}")
+    if calendar_id:
+        on_calendar_changed(calendar_id, user_ids)
+
+
 def handle_customized_event(data: lark.CustomizedEvent) -> None:
     """处理自定义事件"""
     logger.info(f"Received customized event: {lark.JSON.marshal(data, indent=4)}")
@@ -159,6 +168,7 @@ def start_ws_client():
         ).register_p2_im_message_receive_v1(handle_message_receive_v1) \
          .register_p2_im_chat_access_event_bot_p2p_chat_entered_v1(handle_bot_p2p_chat_entered) \
          .register_p2_im_message_message_read_v1(handle_message_read_v1) \
+         .register_p2_calendar_calendar_event_changed_v4(handle_calendar_event_changed) \
          .build()
 
 
@@ -0,0 +1,235 @@
+"""
+异步网页抓取
+
+替代 WebBaseLoader 的串行阻塞加载：所有URL并发抓取，受全局与单站点并发上限约束，
+带超时、指数退避重试和响应大小上限；HTML解析放到进程池中执行，不占用事件循环。
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+
+import aiohttp
+from bs4 import BeautifulSoup
+from langchain_core.documents import Document
+
+logger = logging.getLogger("Fetcher")
+
+# 需要重试的HTTP状态码：限流与服务端错误
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+_parser_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_parser_pool() -> ProcessPoolExecutor:
+    """进程内共享的HTML解析进程池"""
+    global _parser_pool
+    if _parser_pool is None:
+        workers = int(os.getenv("FETCH_PARSER_WORKERS", "0")) or os.cpu_count() or 2
+        _parser_pool = ProcessPoolExecutor(max_workers=workers)
+    return _parser_pool
+
+
+def parse_html(url: str, body: bytes, encoding: Optional[str], content_type: str) -> dict:
+    """
+    解析网页正文，输出与 WebBaseLoader 一致的内容和元数据，以及页面中的链接
+
+    在子进程中运行，只接收和返回可序列化的数据。
+    """
+    if "html" not in content_type:
+        text = body.decode(encoding or "utf-8", errors="replace")
+        return {"page_content": text, "metadata": {"source": url}, "links": []}
+    soup = BeautifulSoup(body, "html.parser", from_encoding=encoding)
+    metadata = {"source": url}
+    if soup.title and soup.title.string:
+        metadata["title"] = soup.title.string.strip()
+    description = soup.find("meta", attrs={"name": "description"})
+    if description and description.get("content"):
+        metadata["description"] = description.get("content")
+    html = soup.find("html")
+    if html and html.get("lang"):
+        metadata["language"] = html.get("lang")
+    links = [urljoin(url, a["href"]) for a in soup.find_all("a", href=True)]
+    return {"page_content": soup.get_text(), "metadata": metadata, "links": links}
+
+
+class FetchError(Exception):
+    """抓取失败，message 中包含失败原因"""
+
+
+class NotModified(Exception):
+    """条件请求命中，页面自上次抓取后未变化"""
+
+
+class _Retryable(Exception):
+    """可重试的HTTP状态"""
+
+
+@dataclass
+class RawPage:
+    """下载完成、尚未解析的页面"""
+    url: str
+    body: bytes
+    encoding: Optional[str]
+    content_type: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+class AsyncFetcher:
+    """并发抓取网页并解析为 Document"""
+
+    def __init__(self,
+                 max_concurrency: int = int(os.getenv("FETCH_MAX_CONCURRENCY", "32")),
+                 per_host_concurrency: int = int(os.getenv("FETCH_PER_HOST_CONCURRENCY", "4")),
+                 timeout: float = float(os.getenv("FETCH_TIMEOUT", "20")),
+                 max_retries: int = int(os.getenv("FETCH_MAX_RETRIES", "3")),
+                 backoff_base: float = 0.5,
+                 max_bytes: int = int(os.getenv("FETCH_MAX_BYTES", str(5 * 1024 * 1024)))) -> None:
+        """
+        Args:
+            max_concurrency: 全局最大并发请求数
+            per_host_concurrency: 单个站点的最大并发请求数
+            timeout: 单次请求的总超时（秒）
+            max_retries: 失败后的最大重试次数
+            backoff_base: 退避基数（秒），第n次重试等待约 base * 2^n
+            max_bytes: 单个响应的最大字节数，超过则放弃
+        """
+        self.max_concurrency = max_concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_bytes = max_bytes
+        self.headers = {"User-Agent": os.getenv("USER_AGENT", "xiaolang-feishu-agent/0.1")}
+
+    def open(self) -> "FetchSession":
+        """创建一次抓取会话，会话内共享连接池和并发名额"""
+        return FetchSession(self)
+
+    async def parse_page(self, page: RawPage) -> Tuple[Optional[Document], List[str]]:
+        """在进程池中解析页面，返回文档（正文为空时为None）和页面中的链接"""
+        loop = asyncio.get_running_loop()
+        try:
+            parsed = await loop.run_in_executor(
+                get_parser_pool(), parse_html, page.url, page.body, page.encoding, page.content_type
+            )
+        except Exception as e:
+            raise FetchError(f"解析失败: {e}") from e
+        if not parsed["page_content"].strip():
+            return None, parsed["links"]
+        return Document(page_content=parsed["page_content"], metadata=parsed["metadata"]), parsed["links"]
+
+
+class FetchSession:
+    """一次抓取会话：共享的HTTP连接池、全局与单站点并发名额"""
+
+    def __init__(self, fetcher: AsyncFetcher) -> None:
+        self.fetcher = fetcher
+        self.global_limit = asyncio.Semaphore(fetcher.max_concurrency)
+        self.host_limits: Dict[str, asyncio.Semaphore] = {}
+        # 站点 -> 请求间隔（robots.txt 的 Crawl-delay），以及下一次可发请求的时间
+        self.host_delays: Dict[str, float] = {}
+        self._next_slot: Dict[str, float] = {}
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> "FetchSession":
+        connector = aiohttp.TCPConnector(
+            limit=self.fetcher.max_concurrency, limit_per_host=self.fetcher.per_host_concurrency
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector, timeout=self.fetcher.timeout, headers=self.fetcher.headers
+        )
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.session.close()
+
+    def set_crawl_delay(self, host: str, delay: float) -> None:
+        """设置同一站点两次请求之间的最小间隔"""
+        self.host_delays[host] = delay
+
+    async def _wait_for_slot(self, host: str) -> None:
+        delay = self.host_delays.get(host)
+        if not delay:
+            return
+        # 先预约时间片再等待，并发请求依次错开
+        now = time.monotonic()
+        slot = max(now, self._next_slot.get(host, 0.0))
+        self._next_slot[host] = slot + delay
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def fetch(self, url: str, validator: Optional[Tuple[Optional[str], Optional[str]]] = None,
+                    binary: bool = False) -> RawPage:
+        """
+        下载单个页面，失败自动重试
+
+        Args:
+            binary: 为 True 时不检查内容类型，例如 gzip 压缩的 sitemap
+
+        Raises:
+            NotModified: 条件请求命中
+            FetchError: 重试后仍失败或响应不可用
+        """
+        fetcher = self.fetcher
+        headers = {}
+        if validator:
+            etag, last_modified = validator
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        host = urlsplit(url).netloc
+        host_limit = self.host_limits.setdefault(host, asyncio.Semaphore(fetcher.per_host_concurrency))
+        last_error = "未知错误"
+        for attempt in range(fetcher.max_retries + 1):
+            if attempt:
+                # 退避等待期间不占用并发名额
+                await asyncio.sleep(fetcher.backoff_base * (2 ** (attempt - 1)) * (1 + random.random()))
+            try:
+                await self._wait_for_slot(host)
+                # 先占站点名额再占全局名额，避免排队等某个站点时占住全局并发
+                async with host_limit, self.global_limit:
+                    return await self._request(url, headers, binary)
+            except (FetchError, NotModified):
+                raise
+            except _Retryable as e:
+                last_error = str(e)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error = f"{type(e).__name__}: {e}"
+        raise FetchError(f"重试 {fetcher.max_retries} 次后仍失败: {last_error}")
+
+    async def _request(self, url: str, headers: Dict[str, str], binary: bool = False) -> RawPage:
+        max_bytes = self.fetcher.max_bytes
+        async with self.session.get(url, allow_redirects=True, headers=headers) as response:
+            if response.status == 304:
+                raise NotModified()
+            if response.status in RETRY_STATUS:
+                raise _Retryable(f"HTTP {response.status}")
+            if response.status >= 400:
+                raise FetchError(f"HTTP {response.status}")
+            content_type = response.content_type or ""
+            if not binary and not (content_type.startswith("text/") or "html" in content_type or "xml" in content_type):
+                raise FetchError(f"不支持的内容类型: {content_type}")
+            if response.content_length and response.content_length > max_bytes:
+                raise FetchError(f"响应过大: {response.content_length} 字节")
+            chunks, size = [], 0
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise FetchError(f"响应超过 {max_bytes} 字节上限")
+                chunks.append(chunk)
+            return RawPage(
+                url=url,
+                body=b"".join(chunks),
+                encoding=response.charset,
+                content_type=content_type,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
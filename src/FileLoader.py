@@ -0,0 +1,168 @@
+"""
+本地文件入库
+
+遍历目录，在进程池中解析并分割 PDF、Markdown、Word 和纯文本文件，
+分片交给与网页相同的流式入库流水线嵌入写入。修改时间与内容哈希均未变化的文件直接跳过。
+
+命令行用法：
+    python -m src.FileLoader /mnt/shared/docs
+    python -m src.FileLoader /mnt/shared/docs --server http://127.0.0.1:8000
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+from xml.etree import ElementTree
+
+logger = logging.getLogger("FileLoader")
+
+SUPPORTED_SUFFIXES = {".pdf", ".md", ".markdown", ".txt", ".docx"}
+
+_WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+# 解析进程数，默认等于CPU核数
+LOADER_WORKERS = int(os.getenv("LOADER_WORKERS", "0")) or os.cpu_count() or 2
+
+_loader_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_loader_pool() -> ProcessPoolExecutor:
+    """进程内共享的文件解析进程池"""
+    global _loader_pool
+    if _loader_pool is None:
+        _loader_pool = ProcessPoolExecutor(max_workers=LOADER_WORKERS)
+    return _loader_pool
+
+
+def iter_files(root: str, recursive: bool = True) -> Iterator[str]:
+    """
+    按路径顺序列出目录下支持的文件，跳过隐藏文件和目录
+
+    Args:
+        root: 目录或单个文件路径
+        recursive: 是否进入子目录
+    """
+    root = os.path.abspath(root)
+    if os.path.isfile(root):
+        if os.path.splitext(root)[1].lower() in SUPPORTED_SUFFIXES:
+            yield root
+        return
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith(".")) if recursive else []
+        for name in sorted(filenames):
+            if not name.startswith(".") and os.path.splitext(name)[1].lower() in SUPPORTED_SUFFIXES:
+                yield os.path.join(dirpath, name)
+
+
+def file_hash(path: str) -> str:
+    """分块计算文件内容的sha256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_pdf(path: str) -> List[Tuple[str, dict]]:
+    try:
+        from pypdf import PdfReader
+    except ImportError as e:
+        raise RuntimeError("解析PDF需要安装 pypdf") from e
+    reader = PdfReader(path)
+    return [(page.extract_text() or "", {"page": i}) for i, page in enumerate(reader.pages)]
+
+
+def _read_docx(path: str) -> List[Tuple[str, dict]]:
+    # docx 是 zip 包，正文在 word/document.xml 中，按段落取出文字
+    with zipfile.ZipFile(path) as archive:
+        root = ElementTree.fromstring(archive.read("word/document.xml"))
+    paragraphs = [
+        "".join(node.text or "" for node in paragraph.iter(f"{_WORD_NS}t"))
+        for paragraph in root.iter(f"{_WORD_NS}p")
+    ]
+    return [("\n".join(p for p in paragraphs if p), {})]
+
+
+def _read_text(path: str) -> List[Tuple[str, dict]]:
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        return [(f.read(), {})]
+
+
+def load_and_split(path: str, chunk_size: int, chunk_overlap: int) -> Dict[str, List[dict]]:
+    """
+    解析并分割单个文件
+
+    在子进程中运行，只接收和返回可序列化的数据。
+
+    Returns:
+        {"documents": 原文, "chunks": 分片}，每项包含 page_content 和 metadata
+    """
+    from langchain_core.documents import Document
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix == ".pdf":
+        pages = _read_pdf(path)
+    elif suffix == ".docx":
+        pages = _read_docx(path)
+    else:
+        pages = _read_text(path)
+    docs = [
+        Document(page_content=text, metadata={"source": path, "title": os.path.basename(path), **meta})
+        for text, meta in pages if text.strip()
+    ]
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=len
+    )
+    return {
+        "documents": [{"page_content": d.page_content, "metadata": d.metadata} for d in docs],
+        "chunks": [{"page_content": c.page_content, "metadata": c.metadata} for c in splitter.split_documents(docs)],
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="本地文件入库")
+    parser.add_argument("paths", nargs="+", help="要入库的目录或文件")
+    parser.add_argument("--no-recursive", action="store_true", help="不进入子目录")
+    parser.add_argument("--persist-dir", default=os.getenv("PERSIST_DIR", "./vector_store"),
+                        help="本地向量库目录，需与 Server.py 一致")
+    parser.add_argument("--server", default=None,
+                        help="Server.py 地址；本地模式下服务已占用向量库时，通过服务的 /add_directory 入库")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = build_parser().parse_args(argv)
+    recursive = not args.no_recursive
+
+    if args.server:
+        import httpx
+        results = []
+        for path in args.paths:
+            response = httpx.post(
+                f"{args.server.rstrip('/')}/add_directory",
+                json={"path": os.path.abspath(path), "recursive": recursive, "wait": True},
+                headers={"X-Ingest-Token": os.getenv("INGEST_TOKEN", "")},
+                timeout=None,
+            )
+            results.append(response.json())
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+
+    import asyncio
+    from .AddDoc import DocumentProcessor
+
+    processor = DocumentProcessor(persist_directory=args.persist_dir)
+    files = [f for path in args.paths for f in iter_files(path, recursive=recursive)]
+    logger.info(f"共发现 {len(files)} 个文件")
+    result = asyncio.run(processor.add_files(files))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
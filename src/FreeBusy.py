@@ -0,0 +1,137 @@
+"""
+多人忙闲汇总
+
+批量查询多个用户的忙闲信息，在本地合并忙碌区间，并用区间扫描找出所有人共同空闲的时段，
+只把结论交给大模型，不再让模型自己做区间运算。
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from .CalendarMirror import LOCAL_TZ, CalendarSyncError, format_timestamp, to_timestamp
+
+logger = logging.getLogger("FreeBusy")
+
+Interval = Tuple[int, int]
+
+# 飞书批量忙闲接口每次最多查询的用户数
+FREEBUSY_BATCH_SIZE = int(os.getenv("FREEBUSY_BATCH_SIZE", "10"))
+
+
+def merge_intervals(intervals: List[Interval]) -> List[Interval]:
+    """按开始时间排序后合并重叠或相接的区间"""
+    merged: List[Interval] = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _working_windows(time_min: int, time_max: int, day_start: int, day_end: int,
+                     skip_weekends: bool) -> List[Interval]:
+    """时间范围内每天的工作时段，按 Asia/Shanghai 计算"""
+    windows = []
+    day = datetime.fromtimestamp(time_min, LOCAL_TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+    while int(day.timestamp()) < time_max:
+        if not (skip_weekends and day.weekday() >= 5):
+            start = max(time_min, int((day + timedelta(hours=day_start)).timestamp()))
+            end = min(time_max, int((day + timedelta(hours=day_end)).timestamp()))
+            if end > start:
+                windows.append((start, end))
+        day += timedelta(days=1)
+    return windows
+
+
+def find_common_slots(busy: List[Interval], time_min: int, time_max: int, duration: int,
+                      limit: int = 3, day_start: int = 9, day_end: int = 18,
+                      skip_weekends: bool = True) -> List[Interval]:
+    """
+    在所有人的忙碌区间之外找出不短于 duration 秒的空闲时段
+
+    Args:
+        busy: 所有参与者的忙碌区间，无需预先排序或合并
+        time_min: 查找范围开始，秒级时间戳
+        time_max: 查找范围结束
+        duration: 会议时长（秒）
+        limit: 最多返回的时段数，按时间先后
+        day_start: 每天工作时段开始的小时
+        day_end: 每天工作时段结束的小时
+        skip_weekends: 是否跳过周六周日
+
+    Returns:
+        空闲时段 (开始, 结束)，每段都能容纳一次会议
+    """
+    merged = merge_intervals(busy)
+    slots: List[Interval] = []
+    i = 0
+    for window_start, window_end in _working_windows(time_min, time_max, day_start, day_end, skip_weekends):
+        # 窗口按时间递增，已结束的忙碌区间不会再影响后面的窗口
+        while i < len(merged) and merged[i][1] <= window_start:
+            i += 1
+        cursor, j = window_start, i
+        while j < len(merged) and merged[j][0] < window_end:
+            if merged[j][0] - cursor >= duration:
+                slots.append((cursor, merged[j][0]))
+            cursor = max(cursor, merged[j][1])
+            j += 1
+        if window_end - cursor >= duration:
+            slots.append((cursor, window_end))
+        if len(slots) >= limit:
+            return slots[:limit]
+    return slots
+
+
+def fetch_busy(client: Any, user_ids: List[str], time_min: Any, time_max: Any,
+               batch_size: int = FREEBUSY_BATCH_SIZE) -> Tuple[Dict[str, List[Interval]], Dict[str, str]]:
+    """
+    批量查询多个用户的忙碌区间，每批一次请求，多批并发
+
+    Returns:
+        (各用户合并后的忙碌区间, 查询失败的用户及原因)
+    """
+    from lark_oapi.api.calendar.v4 import BatchFreebusyRequest, BatchFreebusyRequestBody
+
+    lower, upper = format_timestamp(to_timestamp(time_min)), format_timestamp(to_timestamp(time_max))
+    user_ids = list(dict.fromkeys(u for u in user_ids if u))
+    batches = [user_ids[i:i + batch_size] for i in range(0, len(user_ids), batch_size)]
+
+    def query(batch: List[str]) -> Dict[str, List[Interval]]:
+        request = BatchFreebusyRequest.builder() \
+            .user_id_type("open_id") \
+            .request_body(BatchFreebusyRequestBody.builder()
+                          .time_min(lower)
+                          .time_max(upper)
+                          .user_ids(batch)
+                          .include_external_calendar(True)
+                          .only_busy(True)
+                          .build()) \
+            .build()
+        response = client.calendar.v4.freebusy.batch(request)
+        if not response.success():
+            raise CalendarSyncError(response.code, response.msg)
+        result: Dict[str, List[Interval]] = {user_id: [] for user_id in batch}
+        for item in (response.data.freebusy_lists if response.data else None) or []:
+            result[item.user_id] = merge_intervals([
+                (to_timestamp(busy.start_time), to_timestamp(busy.end_time))
+                for busy in item.freebusy_items or []
+            ])
+        return result
+
+    busy: Dict[str, List[Interval]] = {}
+    errors: Dict[str, str] = {}
+    if not batches:
+        return busy, errors
+    with ThreadPoolExecutor(max_workers=min(4, len(batches))) as pool:
+        futures = [(batch, pool.submit(query, batch)) for batch in batches]
+        for batch, future in futures:
+            try:
+                busy.update(future.result())
+            except Exception as e:
+                logger.error(f"查询忙闲失败 {batch}: {e}")
+                errors.update({user_id: str(e) for user_id in batch})
+    return busy, errors
@@ -0,0 +1,231 @@
+"""
+主备模型对冲调用
+
+with_fallbacks 只在主模型报错后才切换，主模型变慢但没有失败时用户只能一直等到超时。这里改为对冲：
+- 主模型在截止时间内还没返回第一个 token，就并行启动备用模型，谁先返回第一个 token 用谁，另一个取消；
+- 截止时间取主模型近期首 token 耗时的分位数（HEDGE_PERCENTILE），并限制在 [HEDGE_MIN_DELAY, HEDGE_MAX_DELAY]，
+  样本不足时使用 HEDGE_INITIAL_DELAY；
+- 主模型连续 HEDGE_BREAKER_FAILURES 次失败或超过截止时间时熔断，HEDGE_BREAKER_COOLDOWN 秒内直接使用备用模型，
+  冷却后放行的请求若再次失败立即重新熔断；
+- 任一方失败而另一方还没启动时立即启动另一方，熔断期间备用模型失败也会再试主模型，与 with_fallbacks 一样两个都会尝试。
+
+取消只能在流式响应的两个分片之间生效：被取消的一方在收到下一个分片时关闭连接。
+"""
+import contextvars
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Dict, Iterator, List, Optional
+
+from langchain_core.language_models import LanguageModelInput
+from langchain_core.messages import BaseMessage, BaseMessageChunk, message_chunk_to_message
+from langchain_core.runnables import Runnable, RunnableConfig
+
+logger = logging.getLogger("HedgedModel")
+
+
+class _HedgeState:
+    """主模型首 token 耗时与熔断状态，同一对主备模型的所有绑定副本共享"""
+
+    def __init__(self) -> None:
+        self.percentile = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+        self.initial_delay = float(os.getenv("HEDGE_INITIAL_DELAY", "3"))
+        self.min_delay = float(os.getenv("HEDGE_MIN_DELAY", "1"))
+        self.max_delay = float(os.getenv("HEDGE_MAX_DELAY", "10"))
+        self.min_samples = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+        self.breaker_failures = int(os.getenv("HEDGE_BREAKER_FAILURES", "5"))
+        self.breaker_cooldown = float(os.getenv("HEDGE_BREAKER_COOLDOWN", "30"))
+        self._lock = threading.Lock()
+        self.latencies: deque = deque(maxlen=int(os.getenv("HEDGE_WINDOW", "200")))
+        self.failures = 0
+        self.open_until = 0.0
+        self.counters: Dict[str, int] = defaultdict(int)
+
+    def _quantile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def deadline(self) -> float:
+        """启动备用模型前等待主模型首 token 的秒数"""
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return self.initial_delay
+            return min(max(self._quantile(self.percentile), self.min_delay), self.max_delay)
+
+    def first_token(self, seconds: float) -> None:
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def allow_primary(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    def record(self, healthy: bool) -> None:
+        """记录主模型一次调用是否在截止时间内正常返回"""
+        with self._lock:
+            if healthy:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.breaker_failures and time.monotonic() >= self.open_until:
+                self.open_until = time.monotonic() + self.breaker_cooldown
+                self.counters["breaker_opened"] += 1
+                logger.warning(f"主模型连续 {self.failures} 次失败或超时，{self.breaker_cooldown:g}s 内直接使用备用模型")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            p50, p95 = self._quantile(0.5), self._quantile(0.95)
+            stats = {
+                **self.counters,
+                "samples": len(self.latencies),
+                "first_token_p50": round(p50, 3) if p50 is not None else None,
+                "first_token_p95": round(p95, 3) if p95 is not None else None,
+                "breaker_open": time.monotonic() < self.open_until,
+                "consecutive_failures": self.failures,
+            }
+        stats["deadline"] = round(self.deadline(), 3)
+        return stats
+
+
+class _Racer:
+    """在后台线程中读取一个模型的流式输出，分片放入共享队列"""
+
+    def __init__(self, name: str, runnable: Runnable, input: Any, config: Optional[RunnableConfig],
+                 kwargs: Dict[str, Any], events: "queue.Queue", state: Optional[_HedgeState] = None) -> None:
+        self.name = name
+        self.cancelled = threading.Event()
+        self.started = time.monotonic()
+        self._runnable = runnable
+        self._args = (input, config)
+        self._kwargs = kwargs
+        self._events = events
+        self._state = state
+        # 复制上下文，工具中读取的当前用户等 contextvars 在线程中仍然可见
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self._run,), daemon=True,
+                         name=f"hedged-{name}").start()
+
+    def _run(self) -> None:
+        first = True
+        stream = self._runnable.stream(*self._args, **self._kwargs)
+        try:
+            for chunk in stream:
+                if first and self._state is not None:
+                    # 即使已经被取消也记录首 token 耗时，避免慢请求从分位数样本中消失
+                    self._state.first_token(time.monotonic() - self.started)
+                first = False
+                if self.cancelled.is_set():
+                    return
+                self._events.put((self.name, "chunk", chunk))
+            self._events.put((self.name, "done", None))
+        except Exception as e:
+            self._events.put((self.name, "error", e))
+        finally:
+            stream.close()
+
+
+class HedgedChatModel(Runnable[LanguageModelInput, BaseMessage]):
+    """对冲调用主备两个聊天模型，用法与单个模型相同，支持 bind_tools"""
+
+    def __init__(self, primary: Runnable, backup: Runnable, state: Optional[_HedgeState] = None) -> None:
+        """
+        Args:
+            primary: 主模型
+            backup: 备用模型
+            state: 与其他绑定副本共享的统计和熔断状态，None 表示新建
+        """
+        self.primary = primary
+        self.backup = backup
+        self.state = state or _HedgeState()
+
+    def bind_tools(self, tools: List[Any], **kwargs: Any) -> "HedgedChatModel":
+        return HedgedChatModel(self.primary.bind_tools(tools, **kwargs),
+                               self.backup.bind_tools(tools, **kwargs), state=self.state)
+
+    def stream(self, input: LanguageModelInput, config: Optional[RunnableConfig] = None,
+               **kwargs: Any) -> Iterator[BaseMessageChunk]:
+        state = self.state
+        events: "queue.Queue" = queue.Queue()
+        racers: Dict[str, _Racer] = {}
+        errors: Dict[str, Exception] = {}
+
+        def start(name: str) -> None:
+            runnable = self.primary if name == "primary" else self.backup
+            racers[name] = _Racer(name, runnable, input, config, kwargs, events,
+                                  state if name == "primary" else None)
+
+        if state.allow_primary():
+            start("primary")
+            hedge_at = time.monotonic() + state.deadline()
+        else:
+            state.counters["breaker_skips"] += 1
+            start("backup")
+            hedge_at = None
+        # 主模型是否因为超过截止时间而被对冲
+        hedged = False
+
+        try:
+            winner, first = None, None
+            while winner is None:
+                timeout = None
+                if "backup" not in racers:
+                    timeout = max(0.0, hedge_at - time.monotonic())
+                try:
+                    name, kind, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    # 主模型在截止时间内没有返回首 token，并行启动备用模型
+                    state.counters["hedges"] += 1
+                    hedged = True
+                    start("backup")
+                    continue
+                if kind == "error":
+                    errors[name] = payload
+                    state.counters[f"{name}_errors"] += 1
+                    logger.warning(f"{name} 模型调用失败: {payload}")
+                    other = "backup" if name == "primary" else "primary"
+                    if other not in racers:
+                        start(other)
+                    elif len(errors) == len(racers):
+                        raise errors.get("primary") or payload
+                else:
+                    winner, first = name, payload
+
+            if "primary" in racers:
+                state.record(winner == "primary" and not hedged)
+            state.counters[f"{winner}_wins"] += 1
+            for name, racer in racers.items():
+                if name != winner:
+                    racer.cancelled.set()
+
+            if first is not None:
+                yield first
+                while True:
+                    name, kind, payload = events.get()
+                    if name != winner:
+                        continue
+                    if kind == "chunk":
+                        yield payload
+                    elif kind == "error":
+                        raise payload
+                    else:
+                        break
+        finally:
+            for racer in racers.values():
+                racer.cancelled.set()
+
+    def invoke(self, input: LanguageModelInput, config: Optional[RunnableConfig] = None,
+               **kwargs: Any) -> BaseMessage:
+        message = None
+        for chunk in self.stream(input, config, **kwargs):
+            message = chunk if message is None else message + chunk
+        if message is None:
+            raise ValueError("模型没有返回任何内容")
+        return message_chunk_to_message(message)
+
+    def stats(self) -> Dict[str, Any]:
+        """对冲次数、主备胜出次数、失败次数、首 token 耗时分位数和熔断状态"""
+        return self.state.stats()
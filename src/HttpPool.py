@@ -0,0 +1,255 @@
+"""
+共享HTTP连接池
+
+所有 OpenAI 兼容的模型与嵌入客户端（ChatOpenAI、ChatDeepSeek、OpenAIEmbeddings）共用一组 httpx 客户端，
+不再各自新建连接池：长连接复用、连接数上限可调，安装了 h2 时使用 HTTP/2，连接、读取和等待连接池都有超时
+（超时随 http_clients() 一并传给模型客户端）。
+
+异步连接与事件循环绑定，共享的 AsyncClient 按事件循环各自持有一个连接池，
+入库流程多次 asyncio.run 也不会复用到已关闭循环上的连接。
+
+连接池使用情况（在途请求、峰值、等待连接超时次数、空闲连接数等）见 http_pool_stats()。
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import defaultdict
+from typing import Any, Callable, Dict, Optional
+
+import httpx
+
+logger = logging.getLogger("HttpPool")
+
+
+def _http2_available() -> bool:
+    if os.getenv("HTTP2", "1") == "0":
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.info("未安装 h2，共享连接池使用 HTTP/1.1")
+        return False
+    return True
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE", "20")),
+        keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30")),
+    )
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        connect=float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")),
+        read=float(os.getenv("HTTP_READ_TIMEOUT", "60")),
+        write=float(os.getenv("HTTP_WRITE_TIMEOUT", "30")),
+        pool=float(os.getenv("HTTP_POOL_TIMEOUT", "10")),
+    )
+
+
+class _PoolMetrics:
+    """在途请求与连接池异常的计数，请求在响应体读完或关闭时才算结束"""
+
+    def __init__(self, max_connections: Optional[int]) -> None:
+        self.max_connections = max_connections
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.counters: Dict[str, float] = defaultdict(float)
+
+    def start(self) -> float:
+        with self._lock:
+            self.in_flight += 1
+            self.counters["requests"] += 1
+            self.counters["peak_in_flight"] = max(self.counters["peak_in_flight"], self.in_flight)
+        return time.monotonic()
+
+    def finish(self, started: float) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self.counters["busy_seconds"] += time.monotonic() - started
+
+    def error(self, e: Exception) -> None:
+        with self._lock:
+            if isinstance(e, httpx.PoolTimeout):
+                # 等待空闲连接超时，说明连接池已饱和
+                self.counters["pool_timeouts"] += 1
+            elif isinstance(e, httpx.ConnectError):
+                self.counters["connect_errors"] += 1
+            elif isinstance(e, httpx.TimeoutException):
+                self.counters["timeouts"] += 1
+            else:
+                self.counters["errors"] += 1
+
+    def snapshot(self, pools: list) -> Dict[str, Any]:
+        connections = [c for pool in pools for c in getattr(pool, "connections", [])]
+        with self._lock:
+            stats = {name: round(value, 3) for name, value in self.counters.items()}
+            stats["in_flight"] = self.in_flight
+        stats["connections"] = len(connections)
+        stats["idle_connections"] = sum(1 for c in connections if c.is_idle())
+        if self.max_connections:
+            stats["saturation"] = round(stats["in_flight"] / self.max_connections, 3)
+        return stats
+
+
+class _MeteredStream(httpx.SyncByteStream):
+    def __init__(self, stream: httpx.SyncByteStream, done: Callable[[], None]) -> None:
+        self._stream = stream
+        self._done = done
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self) -> None:
+        try:
+            self._stream.close()
+        finally:
+            self._done()
+
+
+class _AsyncMeteredStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, done: Callable[[], None]) -> None:
+        self._stream = stream
+        self._done = done
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            self._done()
+
+
+def _once(callback: Callable[[], None]) -> Callable[[], None]:
+    called = []
+
+    def wrapper() -> None:
+        if not called:
+            called.append(True)
+            callback()
+    return wrapper
+
+
+class _MeteredTransport(httpx.BaseTransport):
+    """同步连接池，记录在途请求数"""
+
+    def __init__(self, metrics: _PoolMetrics, **kwargs: Any) -> None:
+        self.metrics = metrics
+        self.transport = httpx.HTTPTransport(**kwargs)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        started = self.metrics.start()
+        done = _once(lambda: self.metrics.finish(started))
+        try:
+            response = self.transport.handle_request(request)
+        except Exception as e:
+            self.metrics.error(e)
+            done()
+            raise
+        response.stream = _MeteredStream(response.stream, done)
+        return response
+
+    def close(self) -> None:
+        self.transport.close()
+
+    def pools(self) -> list:
+        return [self.transport._pool]
+
+
+class _LoopLocalTransport(httpx.AsyncBaseTransport):
+    """按事件循环各自持有一个异步连接池，记录在途请求数"""
+
+    def __init__(self, metrics: _PoolMetrics, **kwargs: Any) -> None:
+        self.metrics = metrics
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._transports: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncHTTPTransport]" = \
+            weakref.WeakKeyDictionary()
+
+    def _transport(self) -> httpx.AsyncHTTPTransport:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            # 已关闭循环上的连接不能再用，直接丢弃
+            for closed in [l for l in self._transports if l.is_closed()]:
+                del self._transports[closed]
+            transport = self._transports.get(loop)
+            if transport is None:
+                transport = self._transports[loop] = httpx.AsyncHTTPTransport(**self._kwargs)
+            return transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = self.metrics.start()
+        done = _once(lambda: self.metrics.finish(started))
+        try:
+            response = await self._transport().handle_async_request(request)
+        except Exception as e:
+            self.metrics.error(e)
+            done()
+            raise
+        response.stream = _AsyncMeteredStream(response.stream, done)
+        return response
+
+    async def aclose(self) -> None:
+        transport = self._transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
+
+    def pools(self) -> list:
+        with self._lock:
+            return [transport._pool for loop, transport in self._transports.items() if not loop.is_closed()]
+
+
+_lock = threading.Lock()
+_client: Optional[httpx.Client] = None
+_async_client: Optional[httpx.AsyncClient] = None
+_transports: Dict[str, Any] = {}
+_metrics: Dict[str, _PoolMetrics] = {}
+
+
+def get_http_client() -> httpx.Client:
+    """进程内共享的同步 httpx 客户端，传给模型客户端的 http_client"""
+    global _client
+    with _lock:
+        if _client is None:
+            limits = _limits()
+            metrics = _metrics["sync"] = _PoolMetrics(limits.max_connections)
+            transport = _transports["sync"] = _MeteredTransport(metrics, http2=_http2_available(), limits=limits)
+            _client = httpx.Client(transport=transport, timeout=_timeout())
+        return _client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """进程内共享的异步 httpx 客户端，传给模型客户端的 http_async_client"""
+    global _async_client
+    with _lock:
+        if _async_client is None:
+            limits = _limits()
+            metrics = _metrics["async"] = _PoolMetrics(limits.max_connections)
+            transport = _transports["async"] = _LoopLocalTransport(metrics, http2=_http2_available(), limits=limits)
+            _async_client = httpx.AsyncClient(transport=transport, timeout=_timeout())
+        return _async_client
+
+
+def http_clients() -> Dict[str, Any]:
+    """
+    模型与嵌入客户端构造参数：ChatOpenAI(model=..., **http_clients())
+
+    openai 客户端每次请求都会带上自己的 timeout（未设置时为 None），覆盖 httpx 客户端的默认超时，
+    因此超时需要同时作为 timeout 参数传入；需要单独的超时时用 {**http_clients(), "timeout": ...} 覆盖。
+    """
+    return {"http_client": get_http_client(), "http_async_client": get_async_http_client(), "timeout": _timeout()}
+
+
+def http_pool_stats() -> Dict[str, Dict[str, Any]]:
+    """同步、异步连接池的请求数、在途与峰值请求、饱和度、连接数以及超时和连接错误次数"""
+    with _lock:
+        items = [(name, _metrics[name], transport) for name, transport in _transports.items()]
+    return {name: metrics.snapshot(transport.pools()) for name, metrics, transport in items}
@@ -0,0 +1,168 @@
+"""
+消息意图快速路由
+
+在 run_agent 之前用关键词和正则规则判断消息意图，可选再用嵌入相似度兜底：
+- chitchat：问候、感谢等闲聊，直接调用一次大模型，不带任何工具；
+- calendar / todo / knowledge：意图明确时只给 Agent 挂对应的几个工具，减少工具描述和循环次数；
+- agent：无法判断时走完整的工具调用 Agent。
+
+每次路由的决定和耗时都会记录，并与完整 Agent 的平均耗时比较，得出每条路由节省的时间。
+"""
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("IntentRouter")
+
+CHITCHAT = "chitchat"
+FULL_AGENT = "agent"
+
+# 意图明确时 Agent 可用的工具
+ROUTE_TOOLS: Dict[str, List[str]] = {
+    "calendar": ["checkSchedule", "FindFreeSlots", "SetSchedule", "SearchSchedule",
+                 "ModifySchedule", "DelSchedule", "ConfirmDelSchedule"],
+    "todo": ["create_todo"],
+    "knowledge": ["get_info_from_local"],
+}
+
+# 闲聊规则必须匹配整条消息，"你好，帮我约个会" 这类带具体请求的消息不会被当成闲聊。
+# "好的"、"嗯"、"ok" 等肯定答复不算闲聊：它们常用来回答删除日程等工具的确认提问，需要走带工具的 Agent
+CHITCHAT_RE = re.compile(
+    r"^\s*(你好|您好|hi|hello|hey|嗨|哈喽|在吗|在不在|早上好|早安|中午好|下午好|晚上好|晚安|"
+    r"谢谢|多谢|感谢|谢啦|thanks|thank you|哈哈+|再见|拜拜|bye)"
+    r"[\s!！。.~～?？,，呀啊哦呢吧你您小浪]*$",
+    re.IGNORECASE,
+)
+
+INTENT_RULES: Dict[str, re.Pattern] = {
+    "calendar": re.compile(
+        r"日程|日历|会议|开会|约会|约个|空闲|有空|忙闲|时间段|改期|推迟|提前.*(会|约)|取消.*(会|约|日程)|"
+        r"(明天|后天|今天|下周|周[一二三四五六日天]|星期[一二三四五六日天]).*(安排|几点|有什么)"
+    ),
+    "todo": re.compile(r"待办|todo|提醒我|记一下|投诉|退款|维权|找人工|转人工", re.IGNORECASE),
+    "knowledge": re.compile(r"langchain|lang chain|向量库|知识库|检索增强|\brag\b|embedding", re.IGNORECASE),
+}
+
+# 嵌入分类器的示例语句
+EXEMPLARS: Dict[str, List[str]] = {
+    CHITCHAT: ["你好", "谢谢你的帮助", "早上好呀", "你真棒", "今天心情不错"],
+    "calendar": ["帮我查一下明天的安排", "下午三点和产品开个会", "把周五的评审改到下周一", "我们几个人什么时候都有空"],
+    "todo": ["帮我建一个待办", "提醒我周五交报告", "我要投诉你们的服务"],
+    "knowledge": ["LangChain 的 Agent 怎么用", "什么是向量数据库", "如何做文档检索问答"],
+}
+
+
+@dataclass
+class RouteDecision:
+    route: str
+    # 窄化 Agent 可用的工具名，None 表示不需要工具（闲聊）或使用全部工具
+    tools: Optional[List[str]]
+    # 命中的规则或分类器相似度，用于日志
+    reason: str
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class IntentRouter:
+    """规则优先、嵌入相似度兜底的意图路由"""
+
+    def __init__(self, use_embeddings: bool = os.getenv("INTENT_EMBEDDINGS", "0") == "1",
+                 min_similarity: float = float(os.getenv("INTENT_MIN_SIMILARITY", "0.75")),
+                 max_chitchat_length: int = int(os.getenv("INTENT_CHITCHAT_MAX_LENGTH", "20"))) -> None:
+        """
+        Args:
+            use_embeddings: 规则都不命中时是否用嵌入相似度分类，需要一次嵌入接口调用
+            min_similarity: 与最相近示例的余弦相似度低于该值时走完整 Agent
+            max_chitchat_length: 超过该长度的消息不视为闲聊
+        """
+        self.use_embeddings = use_embeddings
+        self.min_similarity = min_similarity
+        self.max_chitchat_length = max_chitchat_length
+        self._lock = threading.Lock()
+        self._exemplars: Optional[List[Tuple[str, List[float]]]] = None
+        self._latency: Dict[str, List[float]] = defaultdict(lambda: [0, 0.0])
+
+    def route(self, message: str) -> RouteDecision:
+        """判断消息应当走哪条路由"""
+        text = (message or "").strip()
+        if len(text) <= self.max_chitchat_length and CHITCHAT_RE.match(text):
+            return RouteDecision(CHITCHAT, None, "rule:chitchat")
+
+        matched = [intent for intent, pattern in INTENT_RULES.items() if pattern.search(text)]
+        if matched:
+            tools = [name for intent in matched for name in ROUTE_TOOLS[intent]]
+            return RouteDecision("+".join(matched), tools, f"rule:{','.join(matched)}")
+
+        if self.use_embeddings:
+            try:
+                intent, similarity = self._classify(text)
+            except Exception as e:
+                logger.warning(f"意图嵌入分类失败，使用完整Agent: {e}")
+            else:
+                reason = f"embedding:{intent}:{similarity:.2f}"
+                if similarity >= self.min_similarity:
+                    if intent == CHITCHAT:
+                        return RouteDecision(CHITCHAT, None, reason)
+                    return RouteDecision(intent, list(ROUTE_TOOLS[intent]), reason)
+                return RouteDecision(FULL_AGENT, None, reason)
+        return RouteDecision(FULL_AGENT, None, "default")
+
+    def _classify(self, text: str) -> Tuple[str, float]:
+        from .VectorStore import get_embeddings
+
+        embeddings = get_embeddings()
+        with self._lock:
+            if self._exemplars is None:
+                labels = [(intent, sample) for intent, samples in EXEMPLARS.items() for sample in samples]
+                vectors = embeddings.embed_documents([sample for _, sample in labels])
+                self._exemplars = [(intent, vector) for (intent, _), vector in zip(labels, vectors)]
+        query = embeddings.embed_query(text)
+        return max(((intent, _cosine(query, vector)) for intent, vector in self._exemplars),
+                   key=lambda item: item[1])
+
+    def record(self, decision: RouteDecision, seconds: float) -> None:
+        """记录一次路由的耗时，并在日志中给出相对完整 Agent 平均耗时节省的时间"""
+        with self._lock:
+            stats = self._latency[decision.route]
+            stats[0] += 1
+            stats[1] += seconds
+            baseline = self._latency.get(FULL_AGENT)
+            baseline_avg = baseline[1] / baseline[0] if baseline and baseline[0] else None
+        saved = f"，比完整Agent平均少 {baseline_avg - seconds:.2f}s" \
+            if baseline_avg is not None and decision.route != FULL_AGENT else ""
+        logger.info(f"消息路由 {decision.route}（{decision.reason}）耗时 {seconds:.2f}s{saved}")
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """每条路由的次数、平均耗时，以及相对完整 Agent 平均节省的秒数"""
+        with self._lock:
+            latency = {route: (count, total) for route, (count, total) in self._latency.items()}
+        baseline = latency.get(FULL_AGENT)
+        baseline_avg = baseline[1] / baseline[0] if baseline and baseline[0] else None
+        result = {}
+        for route, (count, total) in latency.items():
+            avg = total / count if count else 0.0
+            result[route] = {"count": count, "avg_seconds": round(avg, 3)}
+            if baseline_avg is not None and route != FULL_AGENT:
+                result[route]["saved_seconds"] = round(baseline_avg - avg, 3)
+        return result
+
+
+_router: Optional[IntentRouter] = None
+
+
+def get_intent_router() -> IntentRouter:
+    """进程内共享的意图路由，耗时统计在所有消息间累计"""
+    global _router
+    if _router is None:
+        _router = IntentRouter()
+    return _router
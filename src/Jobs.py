@@ -0,0 +1,300 @@
+"""
+异步入库任务
+
+POST /add_urls、/add_directory 只负责登记任务并立即返回任务ID，由有界的后台工作协程从持久化队列中取任务执行。
+任务与每个URL（或文件）的状态保存在sqlite中，服务重启后未完成的任务会自动继续；
+进度通过订阅队列推送给 SSE 接口。
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Set
+
+from .Manifest import get_state_dir
+
+logger = logging.getLogger("Jobs")
+
+TERMINAL_STATUSES = {"succeeded", "partial", "failed"}
+
+
+class JobStore:
+    """任务与URL明细的sqlite存储"""
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path or os.path.join(get_state_dir(), "jobs.sqlite3")
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, created_at REAL, updated_at REAL, "
+                "embedded_chunks INTEGER DEFAULT 0, pending_chunks INTEGER DEFAULT 0, error TEXT, "
+                "kind TEXT DEFAULT 'urls', params TEXT)"
+            )
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+            if "kind" not in columns:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN kind TEXT DEFAULT 'urls'")
+            if "params" not in columns:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN params TEXT")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_items ("
+                "job_id TEXT NOT NULL, url TEXT NOT NULL, status TEXT NOT NULL, "
+                "chunk_count INTEGER DEFAULT 0, added_count INTEGER DEFAULT 0, error TEXT, "
+                "PRIMARY KEY (job_id, url))"
+            )
+
+    def create(self, urls: List[str], kind: str = "urls", params: Optional[Dict[str, Any]] = None) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO jobs (id, status, created_at, updated_at, kind, params) VALUES (?, 'queued', ?, ?, ?, ?)",
+                (job_id, now, now, kind, json.dumps(params, ensure_ascii=False) if params else None),
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO job_items (job_id, url, status) VALUES (?, ?, 'pending')",
+                [(job_id, url) for url in urls],
+            )
+        return job_id
+
+    def set_status(self, job_id: str, status: str, error: Optional[str] = None) -> None:
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, time.time(), job_id),
+            )
+
+    def set_progress(self, job_id: str, embedded: int, pending: int) -> None:
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET embedded_chunks = ?, pending_chunks = ?, updated_at = ? WHERE id = ?",
+                (embedded, pending, time.time(), job_id),
+            )
+
+    def add_items(self, job_id: str, urls: List[str]) -> None:
+        """站点抓取任务在抓取过程中发现的页面"""
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO job_items (job_id, url, status) VALUES (?, ?, 'pending')",
+                [(job_id, url) for url in urls],
+            )
+
+    def update_item(self, job_id: str, url: str, status: str, chunk_count: int = 0,
+                    added_count: int = 0, error: Optional[str] = None) -> None:
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE job_items SET status = ?, chunk_count = ?, added_count = ?, error = ? "
+                "WHERE job_id = ? AND url = ?",
+                (status, chunk_count, added_count, error, job_id, url),
+            )
+
+    def pending_urls(self, job_id: str) -> List[str]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT url FROM job_items WHERE job_id = ? AND status = 'pending'", (job_id,)
+            ).fetchall()
+        return [row["url"] for row in rows]
+
+    def unfinished_jobs(self) -> List[str]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at"
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            items = self.conn.execute(
+                "SELECT url, status, chunk_count, added_count, error FROM job_items WHERE job_id = ?", (job_id,)
+            ).fetchall()
+        counts: Dict[str, int] = {}
+        for item in items:
+            counts[item["status"]] = counts.get(item["status"], 0) + 1
+        return {
+            **dict(job),
+            "url_count": len(items),
+            "url_status_counts": counts,
+            "chunk_count": sum(item["chunk_count"] for item in items),
+            "items": [dict(item) for item in items],
+        }
+
+
+class JobManager:
+    """有界的后台入库工作池"""
+
+    def __init__(self, processor, store: Optional[JobStore] = None,
+                 workers: int = int(os.getenv("INGEST_WORKERS", "2")),
+                 slice_size: int = int(os.getenv("INGEST_JOB_SLICE", "20"))) -> None:
+        """
+        Args:
+            processor: DocumentProcessor 实例
+            store: 任务存储，None则使用 INGEST_STATE_DIR 下的默认库
+            workers: 同时执行的任务数上限
+            slice_size: 每次交给 add_urls 的URL数，完成一片即落盘，重启后从未完成的片继续
+        """
+        self.processor = processor
+        self.store = store or JobStore()
+        self.workers = workers
+        self.slice_size = slice_size
+        self.queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self) -> None:
+        """启动工作协程，并把上次未完成的任务重新放回队列"""
+        for job_id in self.store.unfinished_jobs():
+            logger.info(f"恢复未完成的入库任务: {job_id}")
+            self.store.set_status(job_id, "queued")
+            self.queue.put_nowait(job_id)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def submit(self, urls: List[str], kind: str = "urls", params: Optional[Dict[str, Any]] = None) -> str:
+        """
+        登记入库任务
+
+        Args:
+            urls: URL列表，kind 为 files 时为本地文件路径，为 crawl 时为种子或sitemap地址
+            kind: urls、files、crawl 或 reindex
+            params: 站点抓取或重建索引的参数
+        """
+        job_id = self.store.create(list(dict.fromkeys(urls)), kind, params)
+        self.queue.put_nowait(job_id)
+        logger.info(f"已登记入库任务 {job_id}: {len(urls)} 个{'文件' if kind == 'files' else 'URL'}")
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self.store.get(job_id)
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=100)
+        self._subscribers.setdefault(job_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue) -> None:
+        subscribers = self._subscribers.get(job_id)
+        if subscribers:
+            subscribers.discard(queue)
+            if not subscribers:
+                self._subscribers.pop(job_id, None)
+
+    def _publish(self, job_id: str, event: Dict[str, Any]) -> None:
+        for queue in list(self._subscribers.get(job_id, ())):
+            if queue.full():
+                # 慢订阅者丢弃最旧的事件，不影响任务执行
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self._run_job(job_id)
+            except Exception as e:
+                logger.error(f"入库任务 {job_id} 执行出错: {e}", exc_info=True)
+                self.store.set_status(job_id, "failed", str(e))
+                self._publish(job_id, {"type": "status", "status": "failed", "error": str(e)})
+            finally:
+                self.queue.task_done()
+
+    async def _run_job(self, job_id: str) -> None:
+        self.store.set_status(job_id, "running")
+        self._publish(job_id, {"type": "status", "status": "running"})
+        pending = self.store.pending_urls(job_id)
+        job = self.store.get(job_id) or {}
+        embedded_before = job.get("embedded_chunks", 0)
+        if job.get("kind") == "reindex":
+            await self._run_reindex(job_id, job)
+            return
+        if job.get("kind") == "crawl":
+            # 抓取进度保存在以任务ID为 crawl_id 的队列中，重启后直接继续
+            await self._run_crawl(job_id, job, embedded_before)
+        else:
+            ingest = self.processor.add_files if job.get("kind") == "files" else self.processor.add_urls
+            for start in range(0, len(pending), self.slice_size):
+                urls = pending[start:start + self.slice_size]
+                result = await ingest(urls, on_progress=self._progress(job_id, embedded_before))
+                embedded_before += result.get("added_count", 0)
+                self._record_slice(job_id, urls, result)
+
+        job = self.store.get(job_id)
+        counts = job["url_status_counts"]
+        if counts.get("failed", 0) == job["url_count"]:
+            status = "failed"
+        elif counts.get("failed") or counts.get("partial"):
+            status = "partial"
+        else:
+            status = "succeeded"
+        self.store.set_status(job_id, status)
+        self._publish(job_id, {"type": "status", "status": status, "chunk_count": job["chunk_count"]})
+        logger.info(f"入库任务 {job_id} 完成: {status}")
+
+    async def _run_reindex(self, job_id: str, job: Dict[str, Any]) -> None:
+        # 延迟导入，避免 Jobs 依赖重建索引模块
+        from .Reindex import Reindexer
+
+        params = json.loads(job.get("params") or "{}")
+        result = await Reindexer(self.processor, **params).run(on_progress=self._progress(job_id, 0))
+        status = "failed" if "error" in result else "succeeded"
+        self.store.set_status(job_id, status, result.get("error"))
+        self._publish(job_id, {"type": "status", "status": status, "result": result})
+        logger.info(f"重建索引任务 {job_id} 完成: {status}")
+
+    async def _run_crawl(self, job_id: str, job: Dict[str, Any], embedded_before: int) -> None:
+        params = json.loads(job.get("params") or "{}")
+        root = job["items"][0]["url"] if job["items"] else None
+        result = await self.processor.crawl(
+            crawl_id=job_id, on_progress=self._progress(job_id, embedded_before), **params
+        )
+        urls = list(dict.fromkeys([*result.get("sources", {}), *result.get("failed_urls", {})]))
+        self.store.add_items(job_id, urls)
+        self._record_slice(job_id, urls, result)
+        if root and root not in urls:
+            # sitemap 地址本身不是页面
+            item = {"status": "failed", "error": result["error"]} if "error" in result else {"status": "crawled"}
+            self.store.update_item(job_id, root, item["status"], error=item.get("error"))
+            self._publish(job_id, {"type": "item", "url": root, **item})
+
+    def _progress(self, job_id: str, embedded_base: int):
+        def on_progress(done: int, total: int) -> None:
+            self.store.set_progress(job_id, embedded_base + done, total - done)
+            self._publish(job_id, {"type": "progress", "embedded_chunks": embedded_base + done,
+                                   "pending_chunks": total - done})
+        return on_progress
+
+    def _record_slice(self, job_id: str, urls: List[str], result: Dict[str, Any]) -> None:
+        sources = result.get("sources", {})
+        failed = {**result.get("failed_urls", {}), **result.get("failed_files", {})}
+        for url in urls:
+            item = self._item_event(sources, failed, result, url)
+            self.store.update_item(job_id, url, item["status"], item.get("chunk_count", 0),
+                                   item.get("added_count", 0), item.get("error"))
+            self._publish(job_id, {"type": "item", "url": url, **item})
+
+    @staticmethod
+    def _item_event(sources: Dict, failed: Dict, result: Dict, url: str) -> Dict[str, Any]:
+        if "error" in result:
+            return {"status": "failed", "error": result["error"]}
+        if url in sources:
+            return sources[url]
+        if url in failed:
+            return {"status": "failed", "error": failed[url]}
+        # 304未变化、文件未修改或页面为空
+        return {"status": "unchanged"}
+
+
+def format_sse(event: Dict[str, Any]) -> str:
+    return f"event: {event.get('type', 'message')}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
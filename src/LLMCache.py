@@ -0,0 +1,195 @@
+"""
+大模型响应缓存
+
+替代全局的 InMemoryCache：
+- 进程内一层按最近最少使用淘汰，条数（LLM_CACHE_SIZE）、总大小（LLM_CACHE_MAX_BYTES）和过期时间（LLM_CACHE_TTL）都有上限；
+- Redis 一层在多个 worker 之间共享，本地未命中时再查 Redis，命中后回填本地；
+- 不再设置全局缓存，只有显式传入 cache=get_llm_cache() 的调用点才会缓存，对话 Agent 的每一轮不缓存。
+
+Redis 不可用时只记录错误并在一段时间内跳过 Redis，本地缓存照常工作。
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.load import dumps, loads
+
+logger = logging.getLogger("LLMCache")
+
+
+@dataclass
+class _Entry:
+    value: RETURN_VAL_TYPE
+    expires: float
+    size: int
+
+
+def _serialize(value: RETURN_VAL_TYPE) -> str:
+    return json.dumps([dumps(generation) for generation in value], ensure_ascii=False)
+
+
+def _deserialize(payload: str) -> RETURN_VAL_TYPE:
+    return [loads(generation) for generation in json.loads(payload)]
+
+
+class BoundedLLMCache(BaseCache):
+    """按条数、大小和过期时间淘汰的两级大模型缓存，线程安全"""
+
+    def __init__(self, max_entries: int = int(os.getenv("LLM_CACHE_SIZE", "1000")),
+                 max_bytes: int = int(os.getenv("LLM_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+                 ttl: float = float(os.getenv("LLM_CACHE_TTL", "3600")),
+                 redis_url: Optional[str] = None,
+                 prefix: str = os.getenv("LLM_CACHE_PREFIX", "llm_cache:"),
+                 redis_retry_after: float = 30.0) -> None:
+        """
+        Args:
+            max_entries: 本地最多缓存的条数
+            max_bytes: 本地缓存序列化后的总字节数上限
+            ttl: 本地与 Redis 中缓存的秒数
+            redis_url: 共享层 Redis 地址，None 表示只用本地缓存
+            prefix: Redis 键前缀
+            redis_retry_after: Redis 出错后暂停使用的秒数
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.prefix = prefix
+        self.redis_retry_after = redis_retry_after
+        self._redis = None
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(redis_url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self._redis_paused_until = 0.0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self.counters = {"local_hits": 0, "redis_hits": 0, "misses": 0, "updates": 0,
+                         "evictions": 0, "expired": 0, "redis_errors": 0}
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        # llm_string 包含模型名和调用参数，不同模型或温度的结果互不混用
+        return hashlib.sha256(f"{llm_string}\0{prompt}".encode("utf-8")).hexdigest()
+
+    # ---- Redis ----
+
+    def _redis_available(self) -> bool:
+        return self._redis is not None and time.monotonic() >= self._redis_paused_until
+
+    def _redis_failed(self, e: Exception) -> None:
+        self.counters["redis_errors"] += 1
+        self._redis_paused_until = time.monotonic() + self.redis_retry_after
+        logger.warning(f"LLM缓存的Redis层不可用，{self.redis_retry_after:g}s 内只使用本地缓存: {e}")
+
+    # ---- 本地 ----
+
+    def _put_local(self, key: str, value: RETURN_VAL_TYPE, size: int, expires: float) -> None:
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[key] = _Entry(value, expires, size)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self.counters["evictions"] += 1
+
+    # ---- BaseCache ----
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        key = self._key(prompt, llm_string)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.counters["local_hits"] += 1
+                    return entry.value
+                del self._entries[key]
+                self._bytes -= entry.size
+                self.counters["expired"] += 1
+
+        if self._redis_available():
+            try:
+                payload = self._redis.get(self.prefix + key)
+                ttl = self._redis.ttl(self.prefix + key) if payload is not None else None
+            except Exception as e:
+                self._redis_failed(e)
+            else:
+                if payload is not None:
+                    payload = payload.decode("utf-8")
+                    value = _deserialize(payload)
+                    remaining = ttl if ttl and ttl > 0 else self.ttl
+                    self._put_local(key, value, len(payload), time.monotonic() + remaining)
+                    self.counters["redis_hits"] += 1
+                    return value
+
+        self.counters["misses"] += 1
+        return None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        key = self._key(prompt, llm_string)
+        payload = _serialize(return_val)
+        self.counters["updates"] += 1
+        self._put_local(key, return_val, len(payload), time.monotonic() + self.ttl)
+        if self._redis_available():
+            try:
+                self._redis.set(self.prefix + key, payload, ex=max(1, int(self.ttl)))
+            except Exception as e:
+                self._redis_failed(e)
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self._redis_available():
+            try:
+                keys = list(self._redis.scan_iter(match=self.prefix + "*", count=500))
+                if keys:
+                    self._redis.delete(*keys)
+            except Exception as e:
+                self._redis_failed(e)
+
+    # ---- 指标 ----
+
+    def stats(self) -> Dict[str, Any]:
+        """命中率（本地、Redis 分别统计）、本地条数和占用字节数"""
+        with self._lock:
+            counters = dict(self.counters)
+            counters.update(entries=len(self._entries), bytes=self._bytes)
+        lookups = counters["local_hits"] + counters["redis_hits"] + counters["misses"]
+        counters["hit_rate"] = round((counters["local_hits"] + counters["redis_hits"]) / lookups, 3) if lookups else 0.0
+        counters["redis"] = self._redis is not None
+        return counters
+
+
+_llm_cache: Optional[BoundedLLMCache] = None
+_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> Optional[BoundedLLMCache]:
+    """
+    进程内共享的大模型缓存，供需要缓存的调用点显式传给模型：ChatOpenAI(..., cache=get_llm_cache())
+
+    LLM_CACHE_SIZE<=0 时返回 None，即不缓存；LLM_CACHE_REDIS=0 时不使用 Redis 共享层。
+    """
+    global _llm_cache
+    if int(os.getenv("LLM_CACHE_SIZE", "1000")) <= 0:
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            redis_url = None
+            if os.getenv("LLM_CACHE_REDIS", "1") != "0":
+                redis_url = os.getenv("LLM_CACHE_REDIS_URL") or os.getenv("REDIS_URL", "redis://localhost:6379/0")
+            _llm_cache = BoundedLLMCache(redis_url=redis_url)
+        return _llm_cache
@@ -0,0 +1,160 @@
+"""
+入库清单
+
+记录每个来源（URL或文件）当前在向量库中的分片ID、整篇内容哈希以及HTTP缓存校验信息，
+用于增量入库：未变化的分片跳过，变化的分片替换，消失的分片删除。
+同时保存来源的原文（压缩），更换嵌入模型或分片参数重建索引时不必重新抓取。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# 固定命名空间，保证同一来源同一内容在任何机器上都得到相同的点ID
+CHUNK_NAMESPACE = uuid.UUID("6f1c3c9e-8a51-4d0b-9a52-3f3f3b6f2a10")
+
+
+def get_state_dir() -> str:
+    """入库相关状态文件所在目录"""
+    path = os.getenv("INGEST_STATE_DIR", "./ingest_state")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def chunk_id(source: str, text: str) -> str:
+    """由来源和分片内容哈希得到确定性的点ID"""
+    return str(uuid.uuid5(CHUNK_NAMESPACE, f"{source}\n{content_hash(text)}"))
+
+
+@dataclass
+class SourceRecord:
+    source: str
+    content_hash: Optional[str] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    updated_at: float = 0.0
+    # 本地文件的修改时间
+    mtime: Optional[float] = None
+
+
+class IngestManifest:
+    """基于sqlite的入库清单，线程安全"""
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        """
+        Args:
+            path: sqlite文件路径，None则使用 INGEST_STATE_DIR/manifest.sqlite3，":memory:" 表示仅内存
+        """
+        self.path = path or os.path.join(get_state_dir(), "manifest.sqlite3")
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS sources ("
+                "source TEXT PRIMARY KEY, content_hash TEXT, etag TEXT, last_modified TEXT, updated_at REAL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, source TEXT NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_source ON chunks(source)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "source TEXT NOT NULL, position INTEGER NOT NULL, content BLOB NOT NULL, metadata TEXT, "
+                "PRIMARY KEY (source, position))"
+            )
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(sources)")}
+            if "mtime" not in columns:
+                # 兼容本地文件入库之前创建的清单
+                self.conn.execute("ALTER TABLE sources ADD COLUMN mtime REAL")
+
+    def get_source(self, source: str) -> Optional[SourceRecord]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT source, content_hash, etag, last_modified, updated_at, mtime FROM sources WHERE source = ?",
+                (source,),
+            ).fetchone()
+        return SourceRecord(*row) if row else None
+
+    def get_validators(self, sources: Iterable[str]) -> Dict[str, SourceRecord]:
+        """批量读取来源记录，用于构造条件请求"""
+        records = {}
+        for source in sources:
+            record = self.get_source(source)
+            if record and (record.etag or record.last_modified):
+                records[source] = record
+        return records
+
+    def chunk_ids(self, source: str) -> Set[str]:
+        with self._lock:
+            rows = self.conn.execute("SELECT id FROM chunks WHERE source = ?", (source,)).fetchall()
+        return {row[0] for row in rows}
+
+    def update_source(self, source: str, ids: Set[str], content_hash: Optional[str] = None,
+                      etag: Optional[str] = None, last_modified: Optional[str] = None,
+                      mtime: Optional[float] = None) -> None:
+        """原子地替换某来源的分片ID集合和校验信息"""
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM chunks WHERE source = ?", (source,))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO chunks (id, source) VALUES (?, ?)", [(i, source) for i in ids]
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sources (source, content_hash, etag, last_modified, updated_at, mtime) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (source, content_hash, etag, last_modified, time.time(), mtime),
+            )
+
+    def sources(self, updated_since: Optional[float] = None) -> List[str]:
+        """列出全部来源，或某时间之后更新过的来源"""
+        with self._lock:
+            if updated_since is None:
+                rows = self.conn.execute("SELECT source FROM sources ORDER BY source").fetchall()
+            else:
+                rows = self.conn.execute(
+                    "SELECT source FROM sources WHERE updated_at > ? ORDER BY source", (updated_since,)
+                ).fetchall()
+        return [row[0] for row in rows]
+
+    def save_documents(self, source: str, documents: List[Tuple[str, dict]]) -> None:
+        """保存来源的原文，documents 为 (正文, 元数据) 列表"""
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM documents WHERE source = ?", (source,))
+            self.conn.executemany(
+                "INSERT INTO documents (source, position, content, metadata) VALUES (?, ?, ?, ?)",
+                [
+                    (source, i, zlib.compress(text.encode("utf-8")), json.dumps(metadata, ensure_ascii=False))
+                    for i, (text, metadata) in enumerate(documents)
+                ],
+            )
+
+    def load_documents(self, source: str) -> List[Tuple[str, dict]]:
+        """读取来源的原文，未保存过（早期入库的来源）时返回空列表"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT content, metadata FROM documents WHERE source = ? ORDER BY position", (source,)
+            ).fetchall()
+        return [(zlib.decompress(row[0]).decode("utf-8"), json.loads(row[1] or "{}")) for row in rows]
+
+    def touch(self, source: str) -> None:
+        """来源未变化时只刷新检查时间"""
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE sources SET updated_at = ? WHERE source = ?", (time.time(), source))
+
+    def remove_source(self, source: str) -> Set[str]:
+        """删除来源记录，返回其原有的分片ID"""
+        ids = self.chunk_ids(source)
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM chunks WHERE source = ?", (source,))
+            self.conn.execute("DELETE FROM documents WHERE source = ?", (source,))
+            self.conn.execute("DELETE FROM sources WHERE source = ?", (source,))
+        return ids
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+日程匹配评测
+
+用一组固定的日程和用户说法评测 EventMatcher：
+直接判定的准确率、需要大模型兜底的比例、误判和漏判数，以及单次匹配耗时 p50/p95。
+不调用任何外部服务，结果以 JSON 输出，调整 MATCH_MIN_SCORE / MATCH_DECIDE_SCORE / MATCH_MARGIN 后可直接对比。
+
+用法：
+    python -m src.MatchEval
+    python -m src.MatchEval --min-score 45 --decide-score 75 --margin 8 --repeat 200
+"""
+import argparse
+import json
+import time
+from typing import Any, Dict, List, Optional
+
+from .EventMatcher import EventMatcher, MatchQuery
+
+# SearchSchedule 返回的紧凑结构
+EVENTS: List[Dict[str, Any]] = [
+    {"id": "e1", "summary": "产品周会", "time": "2024-06-03 10:00~11:00", "description": "同步本周迭代进度"},
+    {"id": "e2", "summary": "产品周会", "time": "2024-06-10 10:00~11:00", "description": "同步本周迭代进度"},
+    {"id": "e3", "summary": "和张三一对一", "time": "2024-06-04 15:00~15:30"},
+    {"id": "e4", "summary": "季度OKR复盘", "time": "2024-06-05 14:00~17:00", "description": "各组汇报Q2目标完成情况"},
+    {"id": "e5", "summary": "牙医预约", "time": "2024-06-06 09:00~10:00"},
+    {"id": "e6", "summary": "团建", "time": "2024-06-07", "isAllDay": True, "description": "郊外烧烤"},
+    {"id": "e7", "summary": "面试：后端工程师", "time": "2024-06-04 11:00~12:00", "description": "候选人李四"},
+    {"id": "e8", "summary": "面试：前端工程师", "time": "2024-06-04 16:00~17:00", "description": "候选人王五"},
+    {"id": "e9", "summary": "Weekly sync with design", "time": "2024-06-05 09:30~10:00"},
+    {"id": "e10", "summary": "架构评审", "time": "2024-06-06 14:00~16:00", "description": "新版检索服务设计评审"},
+]
+
+# expected 为应当直接判定的日程id；"tie" 表示确实有歧义、应交给大模型；None 表示不应匹配任何日程，
+# 此时交给大模型确认也可以接受（deferred），直接判定为某个日程则是误判
+CASES: List[Dict[str, Any]] = [
+    {"query": {"summary": "产品周会", "start": "2024-06-03T10:00:00+08:00"}, "expected": "e1"},
+    {"query": {"summary": "产品周会", "start": "2024-06-10T10:00:00+08:00"}, "expected": "e2"},
+    {"query": {"summary": "产品周会"}, "expected": "tie"},
+    {"query": {"summary": "周会", "start": "2024-06-10T09:00:00+08:00"}, "expected": "e2"},
+    {"query": {"summary": "和张三的一对一"}, "expected": "e3"},
+    {"query": {"summary": "张三 1v1"}, "expected": "e3"},
+    {"query": {"summary": "OKR复盘"}, "expected": "e4"},
+    {"query": {"summary": "季度复盘", "description": "Q2目标"}, "expected": "e4"},
+    {"query": {"summary": "看牙"}, "expected": "e5"},
+    {"query": {"summary": "牙医"}, "expected": "e5"},
+    {"query": {"summary": "团建活动"}, "expected": "e6"},
+    {"query": {"summary": "后端面试"}, "expected": "e7"},
+    {"query": {"summary": "面试", "description": "王五"}, "expected": "e8"},
+    {"query": {"summary": "面试"}, "expected": "tie"},
+    {"query": {"summary": "weekly sync"}, "expected": "e9"},
+    {"query": {"summary": "design sync"}, "expected": "e9"},
+    {"query": {"summary": "架构评审会"}, "expected": "e10"},
+    {"query": {"summary": "检索服务评审"}, "expected": "e10"},
+    {"query": {"summary": "年会彩排"}, "expected": None},
+    {"query": {"summary": "部门聚餐"}, "expected": None},
+    # 与某个日程共有两三个字、但说的是另一件事
+    {"query": {"summary": "张三生日"}, "expected": None},
+    {"query": {"summary": "季度规划"}, "expected": None},
+    {"query": {"summary": "OKR对齐"}, "expected": None},
+    {"query": {"summary": "项目周会"}, "expected": None},
+    {"query": {"summary": "设计评审"}, "expected": None},
+    {"query": {"summary": "前端周会"}, "expected": None},
+    {"query": {"summary": "年度OKR"}, "expected": None},
+    {"query": {"summary": "张三面试"}, "expected": None},
+]
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def evaluate(matcher: EventMatcher, repeat: int = 100) -> Dict[str, Any]:
+    """
+    在内置语料上评测匹配器
+
+    Args:
+        repeat: 每个用例重复匹配的次数，用于统计耗时
+    """
+    outcomes = {"correct": 0, "wrong": 0, "tie_expected": 0, "tie_unexpected": 0, "deferred": 0, "missed": 0}
+    failures: List[Dict[str, Any]] = []
+    latencies: List[float] = []
+    for case in CASES:
+        query = MatchQuery(**case["query"])
+        result = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = matcher.match(query, EVENTS)
+            latencies.append((time.perf_counter() - started) * 1000)
+        expected: Optional[str] = case["expected"]
+        if result.candidates:
+            outcome = {"tie": "tie_expected", None: "deferred"}.get(expected, "tie_unexpected")
+        elif result.event is not None:
+            outcome = "correct" if result.event["id"] == expected else "wrong"
+        else:
+            outcome = "correct" if expected is None else "missed"
+        outcomes[outcome] += 1
+        if outcome not in ("correct", "tie_expected", "deferred"):
+            failures.append({"query": case["query"], "expected": expected, "outcome": outcome,
+                             "top": result.scores[:3]})
+
+    total = len(CASES)
+    return {
+        "cases": total,
+        "min_score": matcher.min_score,
+        "decide_score": matcher.decide_score,
+        "margin": matcher.margin,
+        # 不需要大模型就得到正确结论（含正确判定为无匹配）的比例
+        "accuracy": round(outcomes["correct"] / total, 3),
+        # 需要调用大模型的比例
+        "llm_fallback_rate": round(
+            (outcomes["tie_expected"] + outcomes["tie_unexpected"] + outcomes["deferred"]) / total, 3
+        ),
+        **outcomes,
+        "latency_ms": {
+            "p50": round(_percentile(latencies, 0.5), 4),
+            "p95": round(_percentile(latencies, 0.95), 4),
+        },
+        "failures": failures,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="日程匹配评测")
+    parser.add_argument("--min-score", type=float, default=None)
+    parser.add_argument("--decide-score", type=float, default=None)
+    parser.add_argument("--margin", type=float, default=None)
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+    matcher = EventMatcher()
+    if args.min_score is not None:
+        matcher.min_score = args.min_score
+    if args.decide_score is not None:
+        matcher.decide_score = args.decide_score
+    if args.margin is not None:
+        matcher.margin = args.margin
+    print(json.dumps(evaluate(matcher, repeat=args.repeat), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
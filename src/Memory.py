@@ -1,21 +1,22 @@
 from langchain.memory import ConversationBufferMemory
 from langchain_community.chat_message_histories import RedisChatMessageHistory
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_openai import ChatOpenAI
 from src.Prompt import PromptClass
 from dotenv import load_dotenv
 load_dotenv()
 import os
+from src.ModelRouter import get_model
 
 redis_url = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
 print(f"Redis URL: {redis_url}")
 
 
 class MemoryClass:
-    def __init__(self, memorykey="chat_history", model=os.getenv("BASE_MODEL")):
+    def __init__(self, memorykey="chat_history", model=None):
         self.memorykey = memorykey
         self.memory = []
-        self.chatmodel = ChatOpenAI(model=model)
+        # 模型、超时等由 memory_summary 阶段的路由配置决定，model 仅用于临时覆盖
+        self.chatmodel = get_model("memory_summary", model)
 
     def summary_chain(self, store_message):
         try:
@@ -0,0 +1,220 @@
+"""
+按调用阶段路由大模型
+
+Agent 对话、情绪识别、记忆摘要、日程匹配和知识库问答各自是一个阶段，每个阶段可以配置不同的模型、
+超时、max_tokens 和 temperature，简单的分类、抽取类阶段可以换成小而快的模型，不需要改代码。
+
+配置为 JSON，来自环境变量 MODEL_ROUTES 或 MODEL_ROUTES_FILE 指向的文件，例如
+    {"default": {"timeout": 60},
+     "emotion": {"model": "gpt-4o-mini", "timeout": 10, "max_tokens": 50, "temperature": 0}}
+未配置的字段沿用 default，再沿用内置默认值（模型为 BASE_MODEL）。
+
+每个阶段的客户端在第一次使用时创建，进程内共享，并共用 HttpPool 的连接池；各阶段的调用次数、耗时和token用量见 model_stats()。
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from dataclasses import asdict, dataclass, replace
+from typing import Any, Dict, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_openai import ChatOpenAI
+
+from .HttpPool import http_clients
+from .LLMCache import get_llm_cache
+
+logger = logging.getLogger("ModelRouter")
+
+
+@dataclass(frozen=True)
+class StageConfig:
+    model: Optional[str] = None
+    # 单次请求超时秒数，None 表示客户端默认
+    timeout: Optional[float] = None
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    # 是否使用 get_llm_cache() 缓存响应
+    cache: bool = False
+    # 流式调用时是否请求token用量（stream_options.include_usage），不支持该参数的兼容接口需关闭
+    stream_usage: bool = False
+
+
+# 内置的阶段及默认配置：只有结果可复用的辅助阶段默认开启缓存；
+# Agent 阶段经 HedgedChatModel 流式调用，需要流式用量才能统计token和执行单轮token预算
+STAGES: Dict[str, StageConfig] = {
+    "agent": StageConfig(stream_usage=True),
+    "emotion": StageConfig(cache=True),
+    "memory_summary": StageConfig(cache=True),
+    "event_match": StageConfig(cache=True),
+    "rag_condense": StageConfig(),
+    "rag_answer": StageConfig(),
+}
+
+
+def load_routes() -> Dict[str, Dict[str, Any]]:
+    """读取 MODEL_ROUTES 或 MODEL_ROUTES_FILE 中的路由配置"""
+    text = os.getenv("MODEL_ROUTES")
+    path = os.getenv("MODEL_ROUTES_FILE")
+    if not text and path:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+    routes = json.loads(text) if text else {}
+    unknown = set(routes) - set(STAGES) - {"default"}
+    if unknown:
+        logger.warning(f"模型路由配置中有未知的阶段: {sorted(unknown)}")
+    return routes
+
+
+def _usage(response: Any) -> Dict[str, int]:
+    """
+    一次调用的token用量
+
+    非流式调用在 llm_output.token_usage 中；流式调用没有 llm_output，用量在消息的 usage_metadata 中
+    """
+    usage = (response.llm_output or {}).get("token_usage")
+    if usage:
+        return usage
+    total: Dict[str, int] = defaultdict(int)
+    for generations in response.generations:
+        for generation in generations:
+            metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+            total["prompt_tokens"] += metadata.get("input_tokens", 0)
+            total["completion_tokens"] += metadata.get("output_tokens", 0)
+            total["total_tokens"] += metadata.get("total_tokens", 0)
+    return total
+
+
+class _StageMetrics(BaseCallbackHandler):
+    """记录一个阶段每次调用的耗时、失败和token用量"""
+
+    def __init__(self, window: int = 1000) -> None:
+        self._lock = threading.Lock()
+        self._started: Dict[Any, float] = {}
+        self.latencies: deque = deque(maxlen=window)
+        self.counters: Dict[str, float] = defaultdict(float)
+
+    def _start(self, run_id: Any) -> None:
+        with self._lock:
+            self._started[run_id] = time.perf_counter()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        self._start(run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs) -> None:
+        self._start(run_id)
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        # 命中缓存时没有用量，只计调用次数和耗时
+        usage = _usage(response)
+        with self._lock:
+            started = self._started.pop(run_id, None)
+            self.counters["calls"] += 1
+            if started is not None:
+                self.latencies.append(time.perf_counter() - started)
+            for name in ("prompt_tokens", "completion_tokens", "total_tokens"):
+                self.counters[name] += usage.get(name) or 0
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        with self._lock:
+            self._started.pop(run_id, None)
+            self.counters["calls"] += 1
+            self.counters["errors"] += 1
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            ordered = sorted(self.latencies)
+            stats = {name: int(value) for name, value in self.counters.items()}
+        if ordered:
+            stats["latency_p50"] = round(ordered[len(ordered) // 2], 3)
+            stats["latency_p95"] = round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3)
+        return stats
+
+
+class ModelRouter:
+    """按阶段创建并共享模型客户端"""
+
+    def __init__(self, routes: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
+        """
+        Args:
+            routes: 阶段 -> 配置字段，None 则读取 MODEL_ROUTES / MODEL_ROUTES_FILE
+        """
+        self.routes = routes if routes is not None else load_routes()
+        self._lock = threading.Lock()
+        self._clients: Dict[tuple, ChatOpenAI] = {}
+        self._metrics: Dict[str, _StageMetrics] = {}
+
+    def config(self, stage: str) -> StageConfig:
+        """阶段的最终配置：内置默认 < default < 该阶段"""
+        if stage not in STAGES:
+            raise ValueError(f"未知的模型阶段: {stage}")
+        config = replace(STAGES[stage], **self.routes.get("default", {}))
+        config = replace(config, **self.routes.get(stage, {}))
+        if not config.model:
+            config = replace(config, model=os.getenv("BASE_MODEL"))
+        return config
+
+    def get(self, stage: str, model: Optional[str] = None) -> ChatOpenAI:
+        """
+        返回阶段共享的模型客户端
+
+        Args:
+            stage: 阶段名，见 STAGES
+            model: 覆盖配置中的模型名
+        """
+        config = self.config(stage)
+        if model:
+            config = replace(config, model=model)
+        key = (stage, config.model)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                metrics = self._metrics.setdefault(stage, _StageMetrics())
+                kwargs = {name: value for name, value in
+                          (("timeout", config.timeout), ("max_tokens", config.max_tokens),
+                           ("temperature", config.temperature)) if value is not None}
+                if config.stream_usage:
+                    kwargs["stream_usage"] = True
+                # 阶段配置的超时覆盖共享连接池的默认超时
+                client = self._clients[key] = ChatOpenAI(
+                    model=config.model,
+                    cache=get_llm_cache() if config.cache else None,
+                    callbacks=[metrics],
+                    **{**http_clients(), **kwargs},
+                )
+                logger.info(f"模型阶段 {stage} 使用 {config.model} {kwargs}")
+            return client
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """各阶段的配置、调用次数、失败次数、耗时 p50/p95 和token用量"""
+        with self._lock:
+            metrics = dict(self._metrics)
+        return {
+            stage: {**asdict(self.config(stage)), **stage_metrics.snapshot()}
+            for stage, stage_metrics in metrics.items()
+        }
+
+
+_router: Optional[ModelRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> ModelRouter:
+    """进程内共享的模型路由"""
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ModelRouter()
+        return _router
+
+
+def get_model(stage: str, model: Optional[str] = None) -> ChatOpenAI:
+    """阶段共享的模型客户端，见 ModelRouter.get"""
+    return get_router().get(stage, model)
+
+
+def model_stats() -> Dict[str, Dict[str, Any]]:
+    """各阶段的调用统计"""
+    return get_router().stats()
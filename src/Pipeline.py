@@ -0,0 +1,596 @@
+"""
+流式入库流水线
+
+fetch → parse → split → batch → embed → upsert 各阶段之间用有界队列连接
+（本地文件为 scan → load → split → ...），
+上游只有在下游消费后才能继续放入数据，因此无论输入多大，内存中同时存在的页面和分片数量都是有限的。
+每个阶段单独统计处理量、忙碌时间和吞吐，便于定位瓶颈。
+"""
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterable, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from langchain_core.documents import Document
+
+from .Embedder import EmbeddingStats
+from .Fetcher import FetchError, FetchSession, NotModified, RawPage
+from .FileLoader import LOADER_WORKERS, file_hash, get_loader_pool, load_and_split
+from .Manifest import chunk_id, content_hash
+
+logger = logging.getLogger("Pipeline")
+
+# 阶段结束标记
+_DONE = object()
+
+Validators = Dict[str, Tuple[Optional[str], Optional[str]]]
+
+
+class StageStats:
+    """单个阶段的处理统计"""
+
+    def __init__(self, name: str, workers: int) -> None:
+        self.name = name
+        self.workers = workers
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        self.busy = 0.0
+
+    def to_dict(self, elapsed: float) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "in": self.items_in,
+            "out": self.items_out,
+            "errors": self.errors,
+            "busy_seconds": round(self.busy, 3),
+            "items_per_sec": round(self.items_in / elapsed, 2) if elapsed else 0.0,
+            # 忙碌时间占比，接近1说明该阶段是瓶颈
+            "utilization": round(self.busy / (elapsed * self.workers), 3) if elapsed else 0.0,
+        }
+
+
+@dataclass
+class _SourceDocs:
+    """同一来源的文档（网页通常一篇，PDF等按页可能多篇）"""
+    source: str
+    docs: List[Document]
+    # 已在进程池中分割好的分片
+    chunks: Optional[List[Document]] = None
+    # 本地文件的内容哈希与修改时间
+    content_hash: Optional[str] = None
+    mtime: Optional[float] = None
+
+
+@dataclass
+class _LocalFile:
+    path: str
+    mtime: float
+    content_hash: str
+
+
+@dataclass
+class _SourcePlan:
+    """某来源的增量写入计划，全部新分片写完后更新清单并删除过期分片"""
+    source: str
+    new_ids: Set[str]
+    existing: Set[str]
+    added: Set[str]
+    doc_hash: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    remaining: int
+    mtime: Optional[float] = None
+    written: Set[str] = field(default_factory=set)
+    failed: bool = False
+
+
+@dataclass
+class _Run:
+    """一次流水线运行的状态，只随来源数量增长，不保存页面或分片内容"""
+    validators: Validators
+    on_progress: Optional[Callable[[int, int], None]]
+    session: Optional[FetchSession] = None
+    # 站点抓取时由 SiteCrawler 提供URL并接收解析出的链接
+    crawler: Optional[Any] = None
+    stages: Dict[str, StageStats] = field(default_factory=dict)
+    embed_stats: EmbeddingStats = field(default_factory=EmbeddingStats)
+    plans: Dict[str, _SourcePlan] = field(default_factory=dict)
+    sources: Dict[str, dict] = field(default_factory=dict)
+    new_validators: Validators = field(default_factory=dict)
+    # 来源 -> 失败原因
+    failed: Dict[str, str] = field(default_factory=dict)
+    not_modified: List[str] = field(default_factory=list)
+    file_count: int = 0
+    skipped_files: int = 0
+    document_count: int = 0
+    chunk_count: int = 0
+    unchanged_chunks: int = 0
+    unchanged_sources: int = 0
+    deleted_count: int = 0
+
+
+class IngestGate:
+    """
+    入库与重建索引切换之间的闸门
+
+    每次入库运行以共享方式进入；重建索引在最后一次同步和切换别名时独占，
+    等待进行中的入库结束，并让新的入库等到切换完成后再以新版本的配置开始。
+    只在单个事件循环内使用，计数不需要加锁。
+    """
+
+    def __init__(self, interval: float = 0.05) -> None:
+        self.interval = interval
+        self._active = 0
+        self._closed = False
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @asynccontextmanager
+    async def shared(self):
+        while self._closed:
+            await asyncio.sleep(self.interval)
+        self._active += 1
+        try:
+            yield
+        finally:
+            self._active -= 1
+
+    @asynccontextmanager
+    async def exclusive(self):
+        while self._closed:
+            await asyncio.sleep(self.interval)
+        # 先关闭闸门，新的入库不再进入，再等进行中的入库结束
+        self._closed = True
+        try:
+            if self._active:
+                logger.info(f"等待 {self._active} 个进行中的入库结束")
+            while self._active:
+                await asyncio.sleep(self.interval)
+            yield
+        finally:
+            self._closed = False
+
+
+class IngestionPipeline:
+    """DocumentProcessor 的流式入库实现"""
+
+    def __init__(self, processor,
+                 queue_size: int = int(os.getenv("INGEST_QUEUE_SIZE", "16")),
+                 split_workers: int = int(os.getenv("INGEST_SPLIT_WORKERS", "2")),
+                 upsert_workers: int = int(os.getenv("INGEST_UPSERT_WORKERS", "2"))) -> None:
+        """
+        Args:
+            processor: DocumentProcessor 实例，提供抓取器、分割器、嵌入流水线、向量库和清单
+            queue_size: 各阶段之间队列的容量
+            split_workers: 分割阶段的并发数
+            upsert_workers: 写入阶段的并发数
+        """
+        self.processor = processor
+        self.queue_size = queue_size
+        self.split_workers = split_workers
+        self.upsert_workers = upsert_workers
+        # 重建索引切换别名时独占，期间不开始新的入库
+        self.gate = IngestGate()
+
+    async def run_urls(self, urls: Union[Iterable[str], AsyncIterable[str]],
+                       validators: Optional[Validators] = None,
+                       on_progress: Optional[Callable[[int, int], None]] = None) -> dict:
+        """
+        抓取并入库URL，urls 可以是任意（异步）可迭代对象，按需消费
+
+        Args:
+            urls: URL序列，重复项只处理一次
+            validators: URL -> (ETag, Last-Modified)，用于条件请求
+            on_progress: 进度回调 (已写入块数, 已发现待写入块数)
+        """
+        run = _Run(validators=validators or {}, on_progress=on_progress)
+        fetcher = self.processor.fetcher
+        async with fetcher.open() as session:
+            run.session = session
+            await self._run(run, self._unique(urls), [
+                ("fetch", fetcher.max_concurrency, self._fetch),
+                ("parse", os.cpu_count() or 2, self._parse),
+            ])
+        return self._result(run)
+
+    async def run_crawl(self, crawler, on_progress: Optional[Callable[[int, int], None]] = None) -> dict:
+        """
+        按 SiteCrawler 发现的页面抓取并入库，页面中的链接在解析阶段交回抓取器
+
+        Args:
+            crawler: SiteCrawler 实例
+            on_progress: 进度回调 (已写入块数, 已发现待写入块数)
+        """
+        run = _Run(validators={}, on_progress=on_progress, crawler=crawler)
+        fetcher = self.processor.fetcher
+        async with fetcher.open() as session:
+            run.session = session
+            await crawler.prepare(session)
+            await self._run(run, crawler.urls(), [
+                ("fetch", fetcher.max_concurrency, self._fetch),
+                ("parse", os.cpu_count() or 2, self._parse),
+            ])
+        result = self._result(run)
+        result["crawl"] = crawler.summary()
+        return result
+
+    async def run_documents(self, docs: Union[Iterable[Document], AsyncIterable[Document]],
+                            validators: Optional[Validators] = None,
+                            on_progress: Optional[Callable[[int, int], None]] = None) -> dict:
+        """
+        入库已加载的文档，相邻且来源相同的文档视为同一来源
+
+        Args:
+            docs: 文档序列
+            validators: 来源 -> (ETag, Last-Modified)，随清单保存
+            on_progress: 进度回调 (已写入块数, 已发现待写入块数)
+        """
+        run = _Run(validators=validators or {}, on_progress=on_progress)
+        await self._run(run, self._group_by_source(docs), [])
+        return self._result(run)
+
+    async def run_files(self, paths: Union[Iterable[str], AsyncIterable[str]],
+                        on_progress: Optional[Callable[[int, int], None]] = None) -> dict:
+        """
+        入库本地文件，解析与分割在进程池中进行
+
+        Args:
+            paths: 文件路径序列，重复项只处理一次
+            on_progress: 进度回调 (已写入块数, 已发现待写入块数)
+        """
+        run = _Run(validators={}, on_progress=on_progress)
+        await self._run(run, self._unique(paths), [
+            ("scan", self.split_workers, self._scan),
+            ("load", LOADER_WORKERS, self._load),
+        ])
+        result = self._result(run, failed_key="failed_files")
+        elapsed = run.embed_stats.elapsed
+        result["file_count"] = run.file_count
+        result["skipped_file_count"] = run.skipped_files
+        result["files_per_sec"] = round(run.file_count / elapsed, 2) if elapsed else 0.0
+        result["chunks_per_sec"] = round(run.embed_stats.chunks_per_sec, 2)
+        logger.info(
+            f"文件入库完成: {run.file_count} 个文件（跳过 {run.skipped_files} 个）, "
+            f"{result['files_per_sec']} 文件/秒, {result['chunks_per_sec']} 块/秒"
+        )
+        return result
+
+    async def _run(self, run: _Run, items: AsyncIterable, head: List[tuple]) -> None:
+        async with self.gate.shared():
+            await self._run_stages(run, items, head)
+
+    async def _run_stages(self, run: _Run, items: AsyncIterable, head: List[tuple]) -> None:
+        started = time.perf_counter()
+        embedder = self.processor.embedder
+        stages = head + [
+            ("split", self.split_workers, self._split),
+            ("batch", 1, None),
+            ("embed", embedder.max_concurrency, self._embed),
+            ("upsert", self.upsert_workers, self._upsert),
+        ]
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in stages]
+        tasks = [self._feed(items, queues[0], stages[0][1])]
+        for i, (name, workers, handler) in enumerate(stages):
+            run.stages[name] = StageStats(name, workers)
+            out_q = queues[i + 1] if i + 1 < len(stages) else None
+            next_workers = stages[i + 1][1] if out_q is not None else 0
+            if name == "batch":
+                tasks.append(self._batch(run, queues[i], out_q, next_workers, embedder.batch_size))
+            else:
+                tasks.append(self._stage(run, name, workers, queues[i], out_q, next_workers, handler))
+        await asyncio.gather(*tasks)
+
+        run.embed_stats.elapsed = time.perf_counter() - started
+        elapsed = run.embed_stats.elapsed
+        for stats in run.stages.values():
+            summary = stats.to_dict(elapsed)
+            logger.info(
+                f"阶段 {stats.name}: 输入 {summary['in']}, 输出 {summary['out']}, 错误 {summary['errors']}, "
+                f"{summary['items_per_sec']}/秒, 利用率 {summary['utilization']}"
+            )
+
+    # ---------- 调度 ----------
+
+    async def _unique(self, urls: Union[Iterable[str], AsyncIterable[str]]):
+        seen = set()
+        async for url in _aiter(urls):
+            if url not in seen:
+                seen.add(url)
+                yield url
+
+    async def _group_by_source(self, docs: Union[Iterable[Document], AsyncIterable[Document]]):
+        current: Optional[_SourceDocs] = None
+        async for doc in _aiter(docs):
+            source = doc.metadata.get("source", "")
+            if current is not None and current.source == source:
+                current.docs.append(doc)
+                continue
+            if current is not None:
+                yield current
+            current = _SourceDocs(source, [doc])
+        if current is not None:
+            yield current
+
+    async def _feed(self, items: AsyncIterable, out_q: asyncio.Queue, next_workers: int) -> None:
+        async for item in items:
+            await out_q.put(item)
+        for _ in range(next_workers):
+            await out_q.put(_DONE)
+
+    async def _stage(self, run: _Run, name: str, workers: int, in_q: asyncio.Queue,
+                     out_q: Optional[asyncio.Queue], next_workers: int, handler) -> None:
+        stats = run.stages[name]
+
+        async def worker():
+            while True:
+                item = await in_q.get()
+                if item is _DONE:
+                    return
+                stats.items_in += 1
+                started = time.perf_counter()
+                try:
+                    outputs = await handler(run, item)
+                except Exception as e:
+                    stats.errors += 1
+                    logger.error(f"阶段 {name} 处理出错: {e}", exc_info=True)
+                    outputs = []
+                stats.busy += time.perf_counter() - started
+                for output in outputs:
+                    stats.items_out += 1
+                    # 队列已满时在这里等待下游，形成背压
+                    await out_q.put(output)
+
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        if out_q is not None:
+            for _ in range(next_workers):
+                await out_q.put(_DONE)
+
+    async def _batch(self, run: _Run, in_q: asyncio.Queue, out_q: asyncio.Queue,
+                     next_workers: int, batch_size: int) -> None:
+        stats = run.stages["batch"]
+        batch: List[tuple] = []
+        while True:
+            item = await in_q.get()
+            if item is _DONE:
+                break
+            stats.items_in += 1
+            batch.append(item)
+            if len(batch) >= batch_size:
+                stats.items_out += 1
+                await out_q.put(batch)
+                batch = []
+        if batch:
+            stats.items_out += 1
+            await out_q.put(batch)
+        for _ in range(next_workers):
+            await out_q.put(_DONE)
+
+    # ---------- 各阶段处理 ----------
+
+    async def _fetch(self, run: _Run, url: str) -> List[RawPage]:
+        crawler = run.crawler
+        # 从抓取器取出的URL无论成败都要交回 crawler.done，否则 SiteCrawler.urls() 会一直等它完成
+        try:
+            validator = crawler.validator(url) if crawler else run.validators.get(url)
+            page = await run.session.fetch(url, validator)
+        except NotModified:
+            run.not_modified.append(url)
+            if crawler:
+                crawler.done(url)
+            self.processor.manifest.touch(url)
+            return []
+        except Exception as e:
+            logger.warning(f"抓取失败 {url}: {e}")
+            run.failed[url] = str(e)
+            if crawler:
+                crawler.done(url, status="failed")
+            return []
+        if page.etag or page.last_modified:
+            run.new_validators[url] = (page.etag, page.last_modified)
+        return [page]
+
+    async def _parse(self, run: _Run, page: RawPage) -> List[_SourceDocs]:
+        try:
+            doc, links = await self.processor.fetcher.parse_page(page)
+        except Exception as e:
+            run.failed[page.url] = str(e)
+            if run.crawler:
+                run.crawler.done(page.url, status="failed")
+            return []
+        if run.crawler:
+            run.crawler.done(page.url, links)
+        return [_SourceDocs(page.url, [doc])] if doc is not None else []
+
+    async def _scan(self, run: _Run, path: str) -> List[_LocalFile]:
+        manifest = self.processor.manifest
+        run.file_count += 1
+        try:
+            mtime = (await asyncio.to_thread(os.stat, path)).st_mtime
+            record = manifest.get_source(path)
+            if record and record.mtime == mtime:
+                self._skip_file(run, path)
+                manifest.touch(path)
+                return []
+            digest = await asyncio.to_thread(file_hash, path)
+        except OSError as e:
+            run.failed[path] = str(e)
+            return []
+        if record and record.content_hash == digest:
+            # 只是修改时间变了，内容相同
+            ids = self._skip_file(run, path)
+            manifest.update_source(path, ids, digest, mtime=mtime)
+            return []
+        return [_LocalFile(path, mtime, digest)]
+
+    def _skip_file(self, run: _Run, path: str) -> Set[str]:
+        ids = self.processor.manifest.chunk_ids(path)
+        run.skipped_files += 1
+        run.unchanged_sources += 1
+        run.chunk_count += len(ids)
+        run.unchanged_chunks += len(ids)
+        run.sources[path] = {"status": "unchanged", "chunk_count": len(ids), "added_count": 0}
+        return ids
+
+    async def _load(self, run: _Run, file: _LocalFile) -> List[_SourceDocs]:
+        processor = self.processor
+        loop = asyncio.get_running_loop()
+        try:
+            loaded = await loop.run_in_executor(
+                get_loader_pool(), load_and_split, file.path, processor.chunk_size, processor.chunk_overlap
+            )
+        except Exception as e:
+            logger.warning(f"解析失败 {file.path}: {e}")
+            run.failed[file.path] = f"解析失败: {e}"
+            return []
+        return [_SourceDocs(
+            file.path,
+            [Document(page_content=d["page_content"], metadata=d["metadata"]) for d in loaded["documents"]],
+            chunks=[Document(page_content=c["page_content"], metadata=c["metadata"]) for c in loaded["chunks"]],
+            content_hash=file.content_hash, mtime=file.mtime,
+        )]
+
+    async def _split(self, run: _Run, item: _SourceDocs) -> List[tuple]:
+        processor = self.processor
+        source, docs = item.source, item.docs
+        # 本地文件按文件计数
+        run.document_count += len(docs) if item.chunks is None else 1
+        doc_hash = item.content_hash or content_hash("\n".join(doc.page_content for doc in docs))
+        etag, last_modified = run.new_validators.get(source) or run.validators.get(source, (None, None))
+        existing = processor.manifest.chunk_ids(source)
+        record = processor.manifest.get_source(source)
+        if record and record.content_hash == doc_hash:
+            # 整篇内容未变化，无需分割
+            run.unchanged_sources += 1
+            run.chunk_count += len(existing)
+            run.unchanged_chunks += len(existing)
+            processor.manifest.update_source(source, existing, doc_hash, etag, last_modified)
+            run.sources[source] = {"status": "unchanged", "chunk_count": len(existing), "added_count": 0}
+            return []
+
+        # 保存原文，重建索引时使用
+        processor.manifest.save_documents(source, [(doc.page_content, doc.metadata) for doc in docs])
+        chunks = item.chunks
+        if chunks is None:
+            chunks = await asyncio.to_thread(processor.splitter.split_documents, docs)
+        # 同一来源内容相同的分片只保留一份
+        new_chunks = {chunk_id(source, chunk.page_content): chunk for chunk in chunks}
+        added = [i for i in new_chunks if i not in existing]
+        run.chunk_count += len(new_chunks)
+        run.unchanged_chunks += len(new_chunks) - len(added)
+        run.embed_stats.total_chunks += len(added)
+        plan = _SourcePlan(
+            source=source, new_ids=set(new_chunks), existing=existing, added=set(added),
+            doc_hash=doc_hash, etag=etag, last_modified=last_modified, remaining=len(added), mtime=item.mtime,
+        )
+        run.plans[source] = plan
+        if not added:
+            await self._finalize(run, plan)
+        return [(source, i, new_chunks[i]) for i in added]
+
+    async def _embed(self, run: _Run, batch: List[tuple]) -> List[tuple]:
+        try:
+            vectors = await self.processor.embedder.embed_batch([chunk for _, _, chunk in batch], run.embed_stats)
+        except Exception as e:
+            await self._fail(run, batch, e)
+            return []
+        return [(batch, vectors)]
+
+    async def _upsert(self, run: _Run, item: tuple) -> List[Any]:
+        batch, vectors = item
+        processor = self.processor
+        try:
+            if processor.embedder.yield_to_reads:
+                await asyncio.to_thread(processor.store.wait_for_reads, processor.embedder.yield_to_reads)
+            await asyncio.to_thread(
+                processor.store.upsert_vectors,
+                [chunk for _, _, chunk in batch], [i for _, i, _ in batch], vectors,
+            )
+        except Exception as e:
+            await self._fail(run, batch, e)
+            return []
+
+        stats = run.embed_stats
+        stats.written_chunks += len(batch)
+        for source, i, _ in batch:
+            plan = run.plans[source]
+            plan.written.add(i)
+            plan.remaining -= 1
+            if plan.remaining == 0:
+                await self._finalize(run, plan)
+        if run.on_progress:
+            run.on_progress(stats.written_chunks, stats.total_chunks)
+        return []
+
+    async def _fail(self, run: _Run, batch: List[tuple], error: Exception) -> None:
+        stats = run.embed_stats
+        stats.failed_batches += 1
+        stats.failed_chunks += len(batch)
+        stats.failed_ids.extend(i for _, i, _ in batch)
+        stats.errors.append(f"{type(error).__name__}: {error}")
+        logger.error(f"批次写入失败（{len(batch)} 块）: {error}")
+        for source, _, _ in batch:
+            plan = run.plans[source]
+            plan.failed = True
+            plan.remaining -= 1
+            if plan.remaining == 0:
+                await self._finalize(run, plan)
+
+    async def _finalize(self, run: _Run, plan: _SourcePlan) -> None:
+        """某来源的新分片全部处理完毕：更新清单；全部成功时删除过期分片，有失败时保留旧分片待下次补齐"""
+        processor = self.processor
+        if plan.failed:
+            processor.manifest.update_source(plan.source, plan.existing | plan.written)
+            run.sources[plan.source] = {"status": "partial", "chunk_count": len(plan.new_ids),
+                                        "added_count": len(plan.written)}
+        else:
+            stale = list(plan.existing - plan.new_ids)
+            if stale:
+                await asyncio.to_thread(processor.store.delete, stale)
+                run.deleted_count += len(stale)
+            processor.manifest.update_source(plan.source, plan.new_ids, plan.doc_hash,
+                                             plan.etag, plan.last_modified, plan.mtime)
+            run.sources[plan.source] = {"status": "success", "chunk_count": len(plan.new_ids),
+                                        "added_count": len(plan.added)}
+        run.plans.pop(plan.source, None)
+
+    def _result(self, run: _Run, failed_key: str = "failed_urls") -> dict:
+        stats = run.embed_stats
+        elapsed = stats.elapsed
+        result = {
+            "status": "success" if stats.failed_chunks == 0 and not run.failed else "partial",
+            "message": f"成功添加 {stats.written_chunks} 个文档块",
+            "document_count": run.document_count,
+            "chunk_count": run.chunk_count,
+            "added_count": stats.written_chunks,
+            "unchanged_count": run.unchanged_chunks,
+            "deleted_count": run.deleted_count,
+            "unchanged_source_count": run.unchanged_sources,
+            "not_modified_count": len(run.not_modified),
+            "sources": run.sources,
+            "embedding": stats.to_dict(),
+            "stages": {name: s.to_dict(elapsed) for name, s in run.stages.items()},
+        }
+        if run.failed:
+            result[failed_key] = run.failed
+        if run.document_count == 0 and not run.not_modified and not run.unchanged_sources:
+            result["status"] = "warning"
+            result["message"] = "没有文档需要处理"
+        elif stats.total_chunks and stats.written_chunks == 0:
+            result["error"] = f"所有批次均写入失败: {stats.errors[:3]}"
+        return result
+
+
+async def _aiter(items: Union[Iterable, AsyncIterable]):
+    """把同步或异步可迭代对象统一成异步迭代"""
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
@@ -0,0 +1,344 @@
+"""
+蓝绿重建索引
+
+更换嵌入模型、分片参数或向量维度时，用入库清单中保存的原文在新的版本集合（<别名>_v<n>）中重建索引，
+期间旧集合继续对外提供检索。构建完成后抽样检查召回率，通过后原子切换别名，再删除旧版本集合。
+
+命令行用法：
+    python -m src.Reindex --embedding-model BAAI/bge-large-zh-v1.5 --chunk-size 600
+    python -m src.Reindex --chunk-size 600 --server http://127.0.0.1:8000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from .AddDoc import DocumentProcessor
+from .Manifest import IngestManifest, get_state_dir
+from .VectorStore import (CONTENT_KEY, METADATA_KEY, IndexRegistry, IndexVersion, VectorStoreService,
+                          copy_collection, get_registry, replace_with_alias, resolve_collection, switch_alias)
+
+logger = logging.getLogger("Reindex")
+
+# 同一进程内同时只进行一次重建
+_reindex_lock = asyncio.Lock()
+
+
+class ReindexError(Exception):
+    """新版本集合未通过校验，别名保持不变"""
+
+
+class Reindexer:
+    """在新版本集合中重建索引并切换别名"""
+
+    def __init__(self,
+                 processor: DocumentProcessor,
+                 embedding_model: Optional[str] = None,
+                 chunk_size: Optional[int] = None,
+                 chunk_overlap: Optional[int] = None,
+                 vector_size: Optional[int] = None,
+                 embeddings: Optional[Embeddings] = None,
+                 spot_check_size: int = int(os.getenv("REINDEX_SPOT_CHECK", "50")),
+                 min_recall: float = float(os.getenv("REINDEX_MIN_RECALL", "0.8")),
+                 keep_old: bool = False,
+                 registry: Optional[IndexRegistry] = None) -> None:
+        """
+        Args:
+            processor: 当前对外服务的 DocumentProcessor，其集合名作为别名
+            embedding_model: 新版本的嵌入模型，None则沿用当前配置
+            chunk_size: 新版本的分片大小，None则沿用当前配置
+            chunk_overlap: 新版本的分片重叠，None则沿用当前配置
+            vector_size: 新版本的向量维度，None则沿用当前配置
+            embeddings: 自定义嵌入模型，优先于 embedding_model
+            spot_check_size: 召回抽查的样本数
+            min_recall: 抽查召回率低于该值时放弃切换
+            keep_old: 切换后保留旧版本集合，便于回滚
+            registry: 版本登记，None则使用 INGEST_STATE_DIR 下的默认库
+        """
+        self.processor = processor
+        self.embedding_model = embedding_model or processor.embedding_model
+        self.chunk_size = chunk_size or processor.chunk_size
+        self.chunk_overlap = chunk_overlap if chunk_overlap is not None else processor.chunk_overlap
+        self.vector_size = vector_size or processor.vector_size
+        self.embeddings = embeddings
+        self.spot_check_size = spot_check_size
+        self.min_recall = min_recall
+        self.keep_old = keep_old
+        self.registry = registry or get_registry()
+        self.legacy_sources = 0
+
+    async def run(self, on_progress: Optional[Callable[[int, int], None]] = None) -> dict:
+        """
+        重建索引
+
+        Args:
+            on_progress: 嵌入进度回调 (已写入块数, 已发现待写入块数)
+
+        Returns:
+            包含新旧集合、入库统计与抽查结果的字典；失败时包含 error，别名不变
+        """
+        async with _reindex_lock:
+            return await self._run(on_progress)
+
+    async def _run(self, on_progress: Optional[Callable[[int, int], None]]) -> dict:
+        processor = self.processor
+        client = processor.client
+        alias = processor.collection_name
+        previous = await asyncio.to_thread(resolve_collection, client, alias)
+        if previous == alias:
+            try:
+                # 复制期间暂停入库，第1版集合不会漏掉新写入的分片
+                async with processor.pipeline.gate.exclusive():
+                    previous = await self._migrate_legacy(alias)
+            except Exception as e:
+                logger.error(f"原集合 {alias} 迁移为别名失败: {e}")
+                return {"error": f"原集合迁移为别名失败: {e}", "previous_collection": alias}
+        target = self.registry.next_collection(alias)
+        self.registry.add(IndexVersion(
+            collection=target, alias=alias, version=int(target.rsplit("_v", 1)[1]),
+            embedding_model=self.embedding_model, chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap, vector_size=self.vector_size, status="building",
+        ))
+        logger.info(
+            f"开始重建索引 {alias}: {previous} -> {target}（模型 {self.embedding_model}，"
+            f"分片 {self.chunk_size}/{self.chunk_overlap}，维度 {self.vector_size}）"
+        )
+        started = time.time()
+        builder = None
+        sources: List[str] = []
+        try:
+            builder = DocumentProcessor(
+                collection_name=target,
+                embedding_model=self.embedding_model,
+                chunk_size=self.chunk_size,
+                chunk_overlap=self.chunk_overlap,
+                embeddings=self.embeddings,
+                client=client,
+                vector_size=self.vector_size,
+                hnsw_config=processor.hnsw_config,
+                quantization_config=processor.quantization_config,
+                manifest=IngestManifest(os.path.join(get_state_dir(), f"manifest_{target}.sqlite3")),
+            )
+            sources = processor.manifest.sources()
+            self._check_build(await builder.pipeline.run_documents(
+                self._documents(sources, previous), on_progress=on_progress
+            ))
+
+            # 最后一次同步到切换别名期间暂停入库：进行中的入库结束后再同步，切换前不会有新的写入
+            async with processor.pipeline.gate.exclusive():
+                await self._catch_up(builder, sources, started, previous)
+                check = await asyncio.to_thread(
+                    self.spot_check, builder.store, processor.store if previous else None
+                )
+                logger.info(f"召回抽查: {check}")
+                if check["recall"] < self.min_recall:
+                    raise ReindexError(f"召回率 {check['recall']} 低于阈值 {self.min_recall}")
+
+                old = await asyncio.to_thread(switch_alias, client, alias, target)
+                processor.use_index(builder)
+                self._adopt_manifest(builder.manifest)
+        except Exception as e:
+            logger.error(f"重建索引失败，别名保持指向 {previous}: {e}")
+            self.registry.set_status(target, "failed", {"error": str(e)})
+            if builder is not None:
+                await asyncio.to_thread(builder.store._locked, client.delete_collection, target)
+                self._drop_manifest(builder.manifest)
+            return {"error": str(e), "collection": target, "previous_collection": previous}
+
+        stats = {
+            "source_count": len(sources),
+            "legacy_source_count": self.legacy_sources,
+            "chunk_count": builder.store._locked(client.count, collection_name=target).count,
+            "spot_check": check,
+            "elapsed": round(time.time() - started, 3),
+        }
+        for version in self.registry.versions(alias):
+            if version.status == "active":
+                self.registry.set_status(version.collection, "retired")
+        self.registry.set_status(target, "active", stats)
+        self._drop_manifest(builder.manifest)
+        if old and not self.keep_old:
+            await asyncio.to_thread(builder.store._locked, client.delete_collection, old)
+            logger.info(f"已删除旧版本集合 {old}")
+        logger.info(f"重建索引完成，{alias} -> {target}")
+        return {"status": "success", "alias": alias, "collection": target, "previous_collection": previous,
+                "previous_deleted": bool(old) and not self.keep_old, **stats}
+
+    async def _migrate_legacy(self, alias: str) -> str:
+        """
+        首次版本化：把与别名同名的物理集合复制为第1版集合，登记后替换为别名
+
+        复制完成前原集合照常服务；复制失败时原集合不受影响。
+
+        Returns:
+            第1版集合名
+        """
+        processor = self.processor
+        legacy = f"{alias}_v1"
+        logger.info(f"集合 {alias} 尚未使用别名，复制为 {legacy}")
+        if await asyncio.to_thread(resolve_collection, processor.client, legacy) is not None:
+            await asyncio.to_thread(processor.store._locked, processor.client.delete_collection, legacy)
+        count = await asyncio.to_thread(copy_collection, processor.client, alias, legacy)
+        # 先登记为生效版本，别名创建前的瞬间检索按登记读取 legacy
+        self.registry.add(IndexVersion(
+            collection=legacy, alias=alias, version=1, embedding_model=processor.embedding_model,
+            chunk_size=processor.chunk_size, chunk_overlap=processor.chunk_overlap,
+            vector_size=processor.vector_size, status="active", activated_at=time.time(),
+            stats=json.dumps({"migrated_points": count}),
+        ))
+        await asyncio.to_thread(replace_with_alias, processor.client, alias, legacy)
+        return legacy
+
+    async def _catch_up(self, builder: DocumentProcessor, sources: List[str], started: float,
+                        previous: Optional[str]) -> None:
+        """同步构建期间新入库、更新和删除的来源，内容未变的来源会被跳过"""
+        current = self.processor.manifest.sources()
+        catch_up = self.processor.manifest.sources(updated_since=started)
+        if catch_up:
+            logger.info(f"同步构建期间更新的 {len(catch_up)} 个来源")
+            self._check_build(await builder.pipeline.run_documents(self._documents(catch_up, previous)))
+        removed = sorted(set(sources) - set(current))
+        if removed:
+            logger.info(f"删除构建期间移除的 {len(removed)} 个来源")
+            for source in removed:
+                ids = builder.manifest.remove_source(source)
+                if ids:
+                    await asyncio.to_thread(builder.store.delete, sorted(ids))
+
+    @staticmethod
+    def _check_build(result: dict) -> None:
+        if "error" in result or result.get("embedding", {}).get("failed_chunks"):
+            raise ReindexError(f"新集合构建失败: {result.get('error') or result['embedding']['errors']}")
+
+    @staticmethod
+    def _drop_manifest(manifest: IngestManifest) -> None:
+        """新集合的临时清单在切换或放弃后即可删除"""
+        manifest.conn.close()
+        try:
+            os.remove(manifest.path)
+        except OSError:
+            pass
+
+    async def _documents(self, sources: List[str], live_collection: Optional[str]) -> AsyncIterator[Document]:
+        """按来源逐个产出原文；早期入库未保存原文的来源，取其在线集合中的分片作为原文"""
+        manifest = self.processor.manifest
+        for source in sources:
+            documents = await asyncio.to_thread(manifest.load_documents, source)
+            if not documents and live_collection:
+                documents = await asyncio.to_thread(self._legacy_documents, source, live_collection)
+                if documents:
+                    self.legacy_sources += 1
+            for text, metadata in documents:
+                yield Document(page_content=text, metadata={**metadata, "source": source})
+
+    def _legacy_documents(self, source: str, collection: str) -> List[tuple]:
+        ids = sorted(self.processor.manifest.chunk_ids(source))
+        store = self.processor.store
+        documents = []
+        for start in range(0, len(ids), 256):
+            points = store._locked(
+                store.client.retrieve, collection_name=collection, ids=ids[start:start + 256], with_payload=True
+            )
+            documents.extend(
+                ((point.payload or {}).get(CONTENT_KEY, ""), (point.payload or {}).get(METADATA_KEY) or {})
+                for point in points
+            )
+        return [(text, metadata) for text, metadata in documents if text.strip()]
+
+    def spot_check(self, store: VectorStoreService, previous: Optional[VectorStoreService] = None) -> Dict:
+        """
+        抽样召回检查：取新集合中的分片开头作为查询，前5条结果中应有同一来源的分片
+
+        Returns:
+            {"sample_size", "recall", "previous_recall"}
+        """
+        points, _ = store._locked(
+            store.client.scroll, collection_name=store.collection_name,
+            limit=self.spot_check_size, with_payload=True,
+        )
+        samples = [
+            ((point.payload or {}).get(CONTENT_KEY, "")[:200], ((point.payload or {}).get(METADATA_KEY) or {}).get("source"))
+            for point in points
+        ]
+        samples = [(query, source) for query, source in samples if query.strip()]
+        if not samples:
+            return {"sample_size": 0, "recall": 1.0 if not self.processor.manifest.sources() else 0.0}
+
+        def recall(target: VectorStoreService) -> float:
+            results = target.search_batch([query for query, _ in samples], k=5)
+            hits = sum(
+                any(doc.metadata.get("source") == source for doc in docs)
+                for docs, (_, source) in zip(results, samples)
+            )
+            return round(hits / len(samples), 4)
+
+        check = {"sample_size": len(samples), "recall": recall(store)}
+        if previous is not None:
+            try:
+                check["previous_recall"] = recall(previous)
+            except Exception as e:
+                logger.warning(f"旧集合召回抽查失败: {e}")
+        return check
+
+    def _adopt_manifest(self, built: IngestManifest) -> None:
+        """切换后以新集合的分片ID替换清单中的记录，保留校验信息与原文"""
+        manifest = self.processor.manifest
+        for source in built.sources():
+            record = manifest.get_source(source)
+            if record is None:
+                continue
+            manifest.update_source(source, built.chunk_ids(source), record.content_hash,
+                                   record.etag, record.last_modified, record.mtime)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="蓝绿重建知识库索引")
+    parser.add_argument("--embedding-model", default=None, help="新版本的嵌入模型，不填则沿用当前配置")
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--chunk-overlap", type=int, default=None)
+    parser.add_argument("--vector-size", type=int, default=None, help="向量维度，需与嵌入模型输出一致")
+    parser.add_argument("--min-recall", type=float, default=float(os.getenv("REINDEX_MIN_RECALL", "0.8")))
+    parser.add_argument("--keep-old", action="store_true", help="切换后保留旧版本集合")
+    parser.add_argument("--persist-dir", default=os.getenv("PERSIST_DIR", "./vector_store"),
+                        help="本地向量库目录，需与 Server.py 一致")
+    parser.add_argument("--server", default=None,
+                        help="Server.py 地址；本地模式下服务已占用向量库时，通过服务的 /reindex 执行")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = build_parser().parse_args(argv)
+    params = {
+        "embedding_model": args.embedding_model,
+        "chunk_size": args.chunk_size,
+        "chunk_overlap": args.chunk_overlap,
+        "vector_size": args.vector_size,
+        "min_recall": args.min_recall,
+        "keep_old": args.keep_old,
+    }
+
+    if args.server:
+        import httpx
+        response = httpx.post(
+            f"{args.server.rstrip('/')}/reindex",
+            json={**params, "wait": True},
+            headers={"X-Ingest-Token": os.getenv("INGEST_TOKEN", "")},
+            timeout=None,
+        )
+        print(json.dumps(response.json(), ensure_ascii=False, indent=2))
+        return
+
+    processor = DocumentProcessor(persist_directory=args.persist_dir)
+    result = asyncio.run(Reindexer(processor, **params).run())
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,20 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
+from langchain_core.documents import Document
 from pydantic import BaseModel
-from typing import List
+from typing import Any, Dict, List, Optional
+import asyncio
 import uvicorn
 import logging
 import sys
+import hmac
 import os
 from .AddDoc import DocumentProcessor
+from .FileLoader import iter_files
+from .Jobs import JobManager, TERMINAL_STATUSES, format_sse
+from .Reindex import Reindexer
 
 
 # 配置日志
@@ -16,28 +24,109 @@ logging.basicConfig(
 )
 logger = logging.getLogger("server")
 
-# 创建FastAPI应用实例
-app = FastAPI(title="文档处理API", description="用于添加URL到知识库的API")
-
-# 创建DocumentProcessor实例
+# 创建DocumentProcessor实例，本进程作为本地向量库的唯一持有者
 doc_processor = DocumentProcessor(persist_directory=os.getenv("PERSIST_DIR","./vector_store"))
 
+# 后台入库任务
+job_manager = JobManager(doc_processor)
+
+# 允许 /add_directory 读取的服务器目录，多个用逗号分隔；未配置时拒绝所有本地路径
+INGEST_ALLOWED_DIRS = [os.path.realpath(d.strip()) for d in os.getenv("INGEST_ALLOWED_DIRS", "").split(",") if d.strip()]
+
+# 写入知识库的接口需要在 X-Ingest-Token 请求头中携带该令牌；未配置时只接受本机请求
+INGEST_TOKEN = os.getenv("INGEST_TOKEN", "")
+
+def resolve_allowed_path(path: str) -> Optional[str]:
+    """解析符号链接和 ..，路径位于 INGEST_ALLOWED_DIRS 之一内时返回真实路径，否则返回 None"""
+    real = os.path.realpath(path)
+    for root in INGEST_ALLOWED_DIRS:
+        if real == root or real.startswith(root.rstrip(os.sep) + os.sep):
+            return real
+    return None
+
+def require_ingest_access(request: Request) -> None:
+    """写入知识库前校验调用方：配置了 INGEST_TOKEN 时校验令牌，否则只允许本机访问"""
+    if INGEST_TOKEN:
+        if not hmac.compare_digest(request.headers.get("X-Ingest-Token", ""), INGEST_TOKEN):
+            raise HTTPException(status_code=403, detail="入库令牌无效")
+        return
+    host = request.client.host if request.client else ""
+    if host not in ("127.0.0.1", "::1", "localhost"):
+        raise HTTPException(status_code=403, detail="未配置 INGEST_TOKEN 时只允许本机写入知识库")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 启动后台工作协程，并恢复上次未完成的任务
+    await job_manager.start()
+    yield
+    await job_manager.stop()
+
+# 创建FastAPI应用实例
+app = FastAPI(title="文档处理API", description="用于添加URL到知识库的API", lifespan=lifespan)
+
 # 定义请求模型
 class UrlRequest(BaseModel):
-    urls: List[str]
+    urls: List[str] = []
+    # 站点抓取：提供 sitemap 或种子URL 之一，代替逐个列出 urls
+    sitemap: Optional[str] = None
+    seed: Optional[str] = None
+    max_depth: Optional[int] = None
+    path_prefix: Optional[str] = None
+    max_pages: Optional[int] = None
+    # 为 true 时同步等待入库完成（旧行为），否则立即返回任务ID
+    wait: bool = False
+
+class DirectoryRequest(BaseModel):
+    path: str
+    recursive: bool = True
+    wait: bool = False
+
+class ReindexRequest(BaseModel):
+    # 未填写的参数沿用当前索引版本的配置
+    embedding_model: Optional[str] = None
+    chunk_size: Optional[int] = None
+    chunk_overlap: Optional[int] = None
+    vector_size: Optional[int] = None
+    min_recall: Optional[float] = None
+    keep_old: bool = False
+    wait: bool = False
+
+class VectorSearchRequest(BaseModel):
+    queries: List[str]
+    k: int = 5
+    fetch_k: int = 20
+    search_type: str = "similarity"
+    lambda_mult: float = 0.5
+
+class VectorDocument(BaseModel):
+    page_content: str
+    metadata: Dict[str, Any] = {}
+
+class VectorUpsertRequest(BaseModel):
+    documents: List[VectorDocument]
+    ids: Optional[List[str]] = None
 
 @app.post("/add_urls")
 async def add_urls(request: UrlRequest):
     """
     添加URL到知识库
     
-    接收URL列表并处理为向量存储
+    默认登记为后台任务并立即返回任务ID，通过 /jobs/{job_id} 查询进度。
+    提供 sitemap 或 seed 时按站点抓取，遵守 robots.txt，只抓取同站且在 path_prefix 下的页面
     """
+    if request.sitemap or request.seed:
+        return await crawl_site(request)
     if not request.urls:
         raise HTTPException(status_code=400, detail="URL列表不能为空")
     
     try:
         logger.info(f"收到请求处理 {len(request.urls)} 个URL")
+        if not request.wait:
+            job_id = job_manager.submit(request.urls)
+            return JSONResponse(
+                status_code=202,
+                content={"status": "queued", "job_id": job_id, "url_count": len(request.urls)}
+            )
         result = await doc_processor.add_urls(request.urls)
         
         if "error" in result:
@@ -55,6 +144,190 @@ async def add_urls(request: UrlRequest):
             content={"status": "error", "detail": str(e)}
         )
 
+async def crawl_site(request: UrlRequest):
+    if request.sitemap and request.seed:
+        raise HTTPException(status_code=400, detail="sitemap 与 seed 只能提供一个")
+    params = {
+        "seed": request.seed, "sitemap": request.sitemap, "max_depth": request.max_depth,
+        "path_prefix": request.path_prefix, "max_pages": request.max_pages,
+    }
+    
+    try:
+        logger.info(f"收到请求抓取站点 {request.sitemap or request.seed}")
+        if not request.wait:
+            job_id = job_manager.submit([request.sitemap or request.seed], kind="crawl", params=params)
+            return JSONResponse(
+                status_code=202,
+                content={"status": "queued", "job_id": job_id, "crawl": params}
+            )
+        result = await doc_processor.crawl(**params)
+        
+        if "error" in result:
+            return JSONResponse(
+                status_code=500,
+                content={"status": "error", "detail": result["error"]}
+            )
+        
+        return result
+    
+    except Exception as e:
+        logger.error(f"抓取站点时出错: {str(e)}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": "error", "detail": str(e)}
+        )
+
+@app.post("/add_directory", dependencies=[Depends(require_ingest_access)])
+async def add_directory(request: DirectoryRequest):
+    """
+    添加服务器本地目录（或单个文件）中的 PDF、Markdown、Word 和文本文件到知识库
+    
+    只接受 INGEST_ALLOWED_DIRS 内的路径。默认登记为后台任务并立即返回任务ID，未修改的文件会被跳过
+    """
+    path = resolve_allowed_path(request.path)
+    if path is None:
+        raise HTTPException(status_code=403, detail=f"路径不在允许入库的目录内: {request.path}")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=400, detail=f"路径不存在: {request.path}")
+    
+    try:
+        # 目录中指向允许范围之外的符号链接不入库
+        files = await run_in_threadpool(
+            lambda: [f for f in iter_files(path, recursive=request.recursive) if resolve_allowed_path(f)]
+        )
+        if not files:
+            return {"status": "warning", "message": "目录中没有支持的文件"}
+        logger.info(f"收到请求处理目录 {path}: {len(files)} 个文件")
+        if not request.wait:
+            job_id = job_manager.submit(files, kind="files")
+            return JSONResponse(
+                status_code=202,
+                content={"status": "queued", "job_id": job_id, "file_count": len(files)}
+            )
+        result = await doc_processor.add_files(files)
+        
+        if "error" in result:
+            return JSONResponse(
+                status_code=500,
+                content={"status": "error", "detail": result["error"]}
+            )
+        
+        return result
+    
+    except Exception as e:
+        logger.error(f"处理目录时出错: {str(e)}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": "error", "detail": str(e)}
+        )
+
+@app.post("/reindex", dependencies=[Depends(require_ingest_access)])
+async def reindex(request: ReindexRequest):
+    """
+    蓝绿重建知识库索引
+    
+    在新版本集合中用保存的原文重建，召回抽查通过后切换别名，期间检索不受影响
+    """
+    params = request.model_dump(exclude={"wait"}, exclude_none=True)
+    
+    try:
+        logger.info(f"收到重建索引请求: {params}")
+        if not request.wait:
+            job_id = job_manager.submit([], kind="reindex", params=params)
+            return JSONResponse(status_code=202, content={"status": "queued", "job_id": job_id})
+        result = await Reindexer(doc_processor, **params).run()
+        
+        if "error" in result:
+            return JSONResponse(
+                status_code=500,
+                content={"status": "error", "detail": result["error"], **result}
+            )
+        
+        return result
+    
+    except Exception as e:
+        logger.error(f"重建索引时出错: {str(e)}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": "error", "detail": str(e)}
+        )
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """查询入库任务状态，包含每个URL的状态与分块数"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """以 server-sent events 推送入库任务进度，任务结束后关闭连接"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+
+    async def stream():
+        queue = job_manager.subscribe(job_id)
+        try:
+            snapshot = job_manager.get(job_id)
+            yield format_sse({"type": "snapshot", **snapshot})
+            if snapshot["status"] in TERMINAL_STATUSES:
+                return
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # 心跳，防止代理断开空闲连接
+                    yield ": ping\n\n"
+                    continue
+                yield format_sse(event)
+                if event.get("type") == "status" and event.get("status") in TERMINAL_STATUSES:
+                    return
+        finally:
+            job_manager.unsubscribe(job_id, queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+@app.post("/vector/search")
+async def vector_search(request: VectorSearchRequest):
+    """
+    批量检索知识库
+
+    供飞书机器人等其他进程使用，检索在线程池中执行，入库期间不会被阻塞
+    """
+    if request.search_type not in ("similarity", "mmr"):
+        raise HTTPException(status_code=400, detail=f"不支持的检索类型: {request.search_type}")
+    results = await run_in_threadpool(
+        doc_processor.store.search_batch,
+        request.queries,
+        k=request.k,
+        fetch_k=request.fetch_k,
+        search_type=request.search_type,
+        lambda_mult=request.lambda_mult,
+    )
+    return {
+        "results": [
+            [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs]
+            for docs in results
+        ]
+    }
+
+@app.post("/vector/upsert", dependencies=[Depends(require_ingest_access)])
+async def vector_upsert(request: VectorUpsertRequest):
+    """批量写入已分片的文档，来源为本地文件的文档同样只接受 INGEST_ALLOWED_DIRS 内的路径"""
+    if request.ids is not None and len(request.ids) != len(request.documents):
+        raise HTTPException(status_code=400, detail="ids 与 documents 数量不一致")
+    for doc in request.documents:
+        source = str(doc.metadata.get("source", ""))
+        if source and "://" not in source and resolve_allowed_path(source) is None:
+            raise HTTPException(status_code=403, detail=f"来源不在允许入库的目录内: {source}")
+    docs = [Document(page_content=doc.page_content, metadata=doc.metadata) for doc in request.documents]
+    # 与流水线入库一样经过闸门，重建索引切换别名期间等待
+    async with doc_processor.pipeline.gate.shared():
+        count = await run_in_threadpool(doc_processor.store.upsert, docs, request.ids)
+    return {"status": "success", "count": count}
+
 def main():
     uvicorn.run(app, host="0.0.0.0", port=8000)
     
@@ -1,9 +1,11 @@
 # storage.py
+from contextvars import ContextVar
+
 # 全局用户存储
 user_storage = {}
 
-# 当前处理的用户ID（简单全局状态）
-current_processing_user = None
+# 当前处理的用户ID，按上下文隔离，并发处理多个用户的消息时互不干扰
+current_processing_user = ContextVar("current_processing_user", default=None)
 
 # 可以添加一些辅助函数
 def add_user(user_id, user_data):
@@ -16,12 +18,11 @@ def get_user(user_id):
 
 def set_processing_user(user_id):
     """设置当前正在处理的用户ID"""
-    global current_processing_user
-    current_processing_user = user_id
+    current_processing_user.set(user_id)
 
 def get_processing_user():
     """获取当前正在处理的用户ID"""
-    return current_processing_user
+    return current_processing_user.get()
 
 def get_all_users():
     return user_storage
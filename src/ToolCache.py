@@ -0,0 +1,119 @@
+"""
+工具结果缓存
+
+一次对话中模型经常重复调用只读工具（查询日程、查询忙闲），ModifySchedule / DelSchedule 内部也会查询日程。
+只读工具的结果按 (工具, 用户, 规范化参数) 缓存一小段时间；每条结果登记依赖的标签（例如某个日历）和时间范围，
+写工具成功后按标签和时间范围精确失效，不影响其他日历或不相交时间段的缓存。
+"""
+import copy
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+Window = Optional[Tuple[int, int]]
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items() if v is not None and v != ""}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+@dataclass
+class _Entry:
+    value: Any
+    expires: float
+    # 标签 -> 依赖的时间范围，None 表示依赖整个标签
+    tags: Dict[str, Window]
+
+
+class ToolResultCache:
+    """带过期时间和标签失效的工具结果缓存，线程安全"""
+
+    def __init__(self, ttl: float = float(os.getenv("TOOL_CACHE_TTL", "60")),
+                 max_entries: int = int(os.getenv("TOOL_CACHE_SIZE", "1000"))) -> None:
+        """
+        Args:
+            ttl: 结果缓存秒数，<=0 表示不缓存
+            max_entries: 最多缓存的条数，超出时淘汰最久未用的
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str, str], _Entry]" = OrderedDict()
+        self.counters: Dict[str, Dict[str, int]] = defaultdict(lambda: {"hits": 0, "misses": 0, "invalidated": 0})
+
+    @staticmethod
+    def make_key(args: Dict[str, Any]) -> str:
+        """规范化参数：去掉空值和首尾空白，按键排序"""
+        return json.dumps(_normalize(args), ensure_ascii=False, sort_keys=True, default=str)
+
+    def get(self, tool: str, user: Optional[str], key: str) -> Any:
+        """命中返回结果副本，未命中或已过期返回 None"""
+        cache_key = (tool, user or "", key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None or entry.expires <= time.monotonic():
+                if entry is not None:
+                    del self._entries[cache_key]
+                self.counters[tool]["misses"] += 1
+                return None
+            self._entries.move_to_end(cache_key)
+            self.counters[tool]["hits"] += 1
+            return copy.deepcopy(entry.value)
+
+    def put(self, tool: str, user: Optional[str], key: str, value: Any,
+            tags: Optional[Dict[str, Window]] = None) -> None:
+        """
+        缓存一次工具结果
+
+        Args:
+            tags: 结果依赖的标签及时间范围，写工具按标签使之失效
+        """
+        if self.ttl <= 0:
+            return
+        cache_key = (tool, user or "", key)
+        with self._lock:
+            self._entries[cache_key] = _Entry(copy.deepcopy(value), time.monotonic() + self.ttl, tags or {})
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tag: str, window: Window = None) -> int:
+        """
+        使所有用户依赖该标签的缓存失效
+
+        Args:
+            window: 写入影响的时间范围，只失效与之相交的结果；None 表示全部失效
+
+        Returns:
+            失效的条数
+        """
+        with self._lock:
+            stale = []
+            for cache_key, entry in self._entries.items():
+                if tag not in entry.tags:
+                    continue
+                depends = entry.tags[tag]
+                if window is None or depends is None or (depends[0] < window[1] and window[0] < depends[1]):
+                    stale.append(cache_key)
+            for cache_key in stale:
+                del self._entries[cache_key]
+                self.counters[cache_key[0]]["invalidated"] += 1
+        return len(stale)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """每个工具的命中、未命中、失效次数与命中率"""
+        with self._lock:
+            return {
+                tool: {**counts, "hit_rate": round(counts["hits"] / max(1, counts["hits"] + counts["misses"]), 3)}
+                for tool, counts in self.counters.items()
+            }
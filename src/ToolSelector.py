@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+按消息选择工具子集
+
+九个工具的参数结构嵌套很深、字段描述很长，全部挂在 Agent 上时每次请求都要携带所有工具描述。
+这里对每个工具的名称、描述和字段说明建嵌入索引，按用户消息取最相关的几个工具，再加上常驻工具
+（TOOL_ALWAYS_ON）和配套工具（例如删除日程总是带上确认删除），其余工具不再发送给模型。
+
+"确认删除"、"改到下午四点" 这类追问依赖上下文，选择时会把上一条助手回复拼进查询，
+并沿用同一会话上一轮的工具，避免追问时丢掉 ConfirmDelSchedule、ModifySchedule 等工具。
+
+每次选择都会统计节省的工具描述token数；模型调用了未选中的工具时记为一次误选。
+
+用法（评测内置用例的召回率与节省的token）：
+    python -m src.ToolSelector
+    python -m src.ToolSelector --hashing   # 使用本地哈希嵌入，不调用嵌入接口
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from .Embedder import estimate_tokens
+
+logger = logging.getLogger("ToolSelector")
+
+# 选中某个工具时一并提供的工具
+COMPANIONS: Dict[str, List[str]] = {
+    "DelSchedule": ["ConfirmDelSchedule"],
+    "ConfirmDelSchedule": ["DelSchedule"],
+    "FindFreeSlots": ["SetSchedule"],
+}
+
+# 记录上一轮工具的会话数上限
+MAX_SESSIONS = 1000
+
+# 评测用例：消息 -> 必须被选中的工具
+CASES: List[Dict[str, Any]] = [
+    {"input": "帮我看看下周二下午张三和李四有没有空", "expected": ["checkSchedule"]},
+    {"input": "找个大家都有空的时间开一个小时的会", "expected": ["FindFreeSlots"]},
+    {"input": "明天上午十点提醒我参加周会，帮我建个日程", "expected": ["SetSchedule"]},
+    {"input": "我这周都有哪些安排", "expected": ["SearchSchedule"]},
+    {"input": "把周五的评审改到下午四点", "expected": ["ModifySchedule"]},
+    {"input": "删掉明天的牙医预约", "expected": ["DelSchedule"]},
+    {"input": "帮我记个待办，周五前提交报销单", "expected": ["create_todo"]},
+    {"input": "LangChain 里的检索器怎么用", "expected": ["get_info_from_local"]},
+    {"input": "今天上海天气怎么样", "expected": ["web_search"]},
+    {"input": "最新的比特币价格是多少", "expected": ["web_search"]},
+]
+
+
+def _descriptions(value: Any) -> List[str]:
+    """递归取出工具结构中的所有 description"""
+    if isinstance(value, dict):
+        found = [value["description"]] if isinstance(value.get("description"), str) else []
+        for child in value.values():
+            found.extend(_descriptions(child))
+        return found
+    if isinstance(value, list):
+        return [text for child in value for text in _descriptions(child)]
+    return []
+
+
+class ToolSelector:
+    """工具描述的嵌入索引，按消息选出最相关的工具"""
+
+    def __init__(self, tools: Sequence[Any], embeddings: Any = None,
+                 always_on: Optional[List[str]] = None,
+                 top_k: int = int(os.getenv("TOOL_SELECT_TOP_K", "3")),
+                 min_similarity: float = float(os.getenv("TOOL_SELECT_MIN_SIMILARITY", "0.3"))) -> None:
+        """
+        Args:
+            tools: 全部可用工具
+            embeddings: 嵌入模型，None 则使用 get_embeddings()
+            always_on: 总是提供的工具名，None 则读取 TOOL_ALWAYS_ON（逗号分隔，默认 web_search）
+            top_k: 按相似度最多选出的工具数（不含常驻与配套工具）
+            min_similarity: 相似度低于该值的工具不选
+        """
+        self.tools = {tool.name: tool for tool in tools}
+        self.embeddings = embeddings
+        if always_on is None:
+            always_on = [name.strip() for name in os.getenv("TOOL_ALWAYS_ON", "web_search").split(",") if name.strip()]
+        self.always_on = [name for name in always_on if name in self.tools]
+        self.top_k = top_k
+        self.min_similarity = min_similarity
+        self.schemas = {name: convert_to_openai_tool(tool) for name, tool in self.tools.items()}
+        # 每个工具描述占用的token数，用于统计节省量
+        self.tool_tokens = {name: estimate_tokens(json.dumps(schema, ensure_ascii=False))
+                            for name, schema in self.schemas.items()}
+        self._lock = threading.Lock()
+        self._matrix: Optional[np.ndarray] = None
+        self._names: List[str] = []
+        self.counters: Dict[str, float] = defaultdict(float)
+        # 会话 -> 上一轮按消息选出（或规则指定）的工具，不含更早沿用的工具
+        self._recent: "OrderedDict[str, List[str]]" = OrderedDict()
+
+    def _index(self) -> np.ndarray:
+        with self._lock:
+            if self._matrix is None:
+                if self.embeddings is None:
+                    from .VectorStore import get_embeddings
+                    self.embeddings = get_embeddings()
+                self._names = list(self.tools)
+                texts = [f"{name}\n" + "\n".join(_descriptions(self.schemas[name])) for name in self._names]
+                matrix = np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+                self._matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+            return self._matrix
+
+    def rank(self, message: str) -> List[tuple]:
+        """所有工具按与消息的余弦相似度从高到低排列"""
+        matrix = self._index()
+        query = np.asarray(self.embeddings.embed_query(message), dtype=np.float32)
+        scores = matrix @ (query / max(float(np.linalg.norm(query)), 1e-12))
+        return sorted(zip(self._names, scores.tolist()), key=lambda item: item[1], reverse=True)
+
+    def select(self, message: str, context: Optional[str] = None, session: Optional[str] = None) -> List[str]:
+        """
+        为消息选择工具
+
+        Args:
+            message: 用户消息
+            context: 上一条助手回复，追问时用来补全意图
+            session: 会话标识，提供时并入该会话上一轮的工具
+
+        Returns:
+            工具名，按原有工具顺序；嵌入失败时返回全部工具
+        """
+        query = f"{context}\n{message}" if context else message
+        try:
+            ranked = self.rank(query)
+        except Exception as e:
+            logger.warning(f"工具选择失败，使用全部工具: {e}")
+            self.counters["failures"] += 1
+            return list(self.tools)
+        chosen = set(self.always_on)
+        chosen.update(name for name, score in ranked[:self.top_k] if score >= self.min_similarity)
+        for name in list(chosen):
+            chosen.update(companion for companion in COMPANIONS.get(name, []) if companion in self.tools)
+        previous = self.remember(session, chosen) if session is not None else []
+        chosen.update(previous)
+        selected = [name for name in self.tools if name in chosen]
+
+        saved = sum(self.tool_tokens.values()) - sum(self.tool_tokens[name] for name in selected)
+        self.counters["selections"] += 1
+        self.counters["tools_selected"] += len(selected)
+        self.counters["tokens_saved"] += saved
+        logger.info(f"工具选择 {selected}（沿用上一轮 {sorted(previous)}），少发送约 {saved} 个token的工具描述")
+        return selected
+
+    def remember(self, session: str, names: Sequence[str]) -> List[str]:
+        """记录会话本轮的工具，返回该会话上一轮的工具"""
+        with self._lock:
+            previous = self._recent.pop(session, [])
+            self._recent[session] = [name for name in names if name in self.tools]
+            while len(self._recent) > MAX_SESSIONS:
+                self._recent.popitem(last=False)
+        return previous
+
+    def record(self, selected: List[str], steps: List[Any]) -> None:
+        """检查一轮对话中模型调用的工具，调用了未选中的工具记为误选"""
+        missing = sorted({action.tool for action, _ in steps or [] if action.tool not in selected})
+        if missing:
+            self.counters["misroutes"] += 1
+            logger.warning(f"工具选择误选：模型需要未提供的工具 {missing}，已提供 {selected}")
+
+    def stats(self) -> Dict[str, float]:
+        """选择次数、平均选出工具数、累计与平均节省token、误选次数与比例"""
+        counters = dict(self.counters)
+        selections = counters.get("selections", 0)
+        if selections:
+            counters["avg_tools"] = round(counters["tools_selected"] / selections, 2)
+            counters["avg_tokens_saved"] = round(counters["tokens_saved"] / selections, 1)
+            counters["misroute_rate"] = round(counters.get("misroutes", 0) / selections, 3)
+        return counters
+
+
+def evaluate(selector: ToolSelector) -> Dict[str, Any]:
+    """在内置用例上评测：期望工具全部被选中的比例和平均节省token"""
+    hits, failures = 0, []
+    for case in CASES:
+        selected = selector.select(case["input"])
+        if all(name in selected for name in case["expected"]):
+            hits += 1
+        else:
+            failures.append({"input": case["input"], "expected": case["expected"], "selected": selected})
+    return {"cases": len(CASES), "recall": round(hits / len(CASES), 3), **selector.stats(), "failures": failures}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="工具选择评测")
+    parser.add_argument("--hashing", action="store_true", help="使用本地哈希嵌入，不调用嵌入接口")
+    parser.add_argument("--top-k", type=int, default=None)
+    args = parser.parse_args()
+    from .Tools import (ConfirmDelSchedule, DelSchedule, FindFreeSlots, ModifySchedule, SearchSchedule, SetSchedule,
+                        checkSchedule, create_todo, get_info_from_local, web_search)
+    tools = [web_search, get_info_from_local, create_todo, checkSchedule, FindFreeSlots, SetSchedule,
+             SearchSchedule, ModifySchedule, DelSchedule, ConfirmDelSchedule]
+    embeddings = None
+    if args.hashing:
+        from .Benchmark import HashingEmbeddings
+        embeddings = HashingEmbeddings()
+    selector = ToolSelector(tools, embeddings=embeddings)
+    if args.top_k is not None:
+        selector.top_k = args.top_k
+    print(json.dumps(evaluate(selector), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
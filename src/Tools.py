@@ -1,22 +1,33 @@
-from typing import Optional
+from typing import List, Optional
+import logging
 import os
 import time
 import requests
 import json
+from itertools import islice
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from langchain.agents import tool
-from langchain_community.utilities import SerpAPIWrapper
-from langchain_qdrant import QdrantVectorStore
-from qdrant_client import QdrantClient
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain.chains import create_history_aware_retriever, create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from .Memory import MemoryClass
-from .Storage import get_user
+from .Storage import get_user, get_processing_user
+from .CalendarMirror import (
+    CALENDAR_NOT_FOUND_CODES, CalendarMirror, CalendarSyncError, MirroredEvent, PrimaryCalendarResolver, default_window,
+    event_from_feishu, format_range, format_timestamp, iter_events, to_timestamp
+)
+from .VectorStore import get_vector_store
+from .EventMatcher import EventMatcher, MatchQuery
+from .FreeBusy import fetch_busy, find_common_slots
+from .FeishuGateway import get_gateway
+from .ToolCache import ToolResultCache
+from .WebSearch import get_web_search
+from .ModelRouter import get_model
 from langchain_core.output_parsers import PydanticOutputParser
 
+logger = logging.getLogger("Tools")
+
 # 配置管理
 class Config:
     def __init__(self):
@@ -57,17 +68,73 @@ class FeishuClient:
         if not all([self.app_id, self.app_secret]):
             raise ValueError("飞书配置信息不完整")
             
-        # 初始化飞书客户端
-        self.client = lark.Client.builder() \
-            .app_id(self.app_id) \
-            .app_secret(self.app_secret) \
-            .log_level(lark.LogLevel.INFO) \
-            .build()
+        # 初始化飞书客户端：进程内共享，所有调用经由网关限流、重试并合并相同的只读请求
+        self.client = get_gateway(self.app_id, self.app_secret)
     
     def get_client(self):
         """获取飞书客户端实例"""
         return self.client
 
+_calendar_mirror = None
+
+def get_calendar_mirror() -> CalendarMirror:
+    """进程内共享的日历本地镜像，日程查询与匹配直接读取它"""
+    global _calendar_mirror
+    if _calendar_mirror is None:
+        _calendar_mirror = CalendarMirror(FeishuClient().get_client())
+    return _calendar_mirror
+
+_calendar_resolver = None
+
+def get_calendar_resolver() -> PrimaryCalendarResolver:
+    """进程内共享的主日历ID缓存"""
+    global _calendar_resolver
+    if _calendar_resolver is None:
+        _calendar_resolver = PrimaryCalendarResolver(FeishuClient().get_client())
+    return _calendar_resolver
+
+def _primary_calendar_id() -> str:
+    """获取主日历 ID：工具以应用身份调用飞书，所有用户共用应用（tenant）的主日历"""
+    return get_calendar_resolver().resolve()
+
+def _calendar_failed(calendar_id: str, code: int) -> None:
+    """日程接口失败时，若是日历不存在则清除主日历ID缓存"""
+    get_calendar_resolver().check(calendar_id, code)
+
+# 只读取数据的工具，Agent 同一步请求多个时可以并发执行；其余工具会创建、修改或删除数据，按顺序执行
+READ_ONLY_TOOLS = {"web_search", "get_info_from_local", "checkSchedule", "FindFreeSlots", "SearchSchedule"}
+
+# 只读工具（SearchSchedule、checkSchedule）的结果缓存，写工具成功后按日历和时间范围失效
+tool_cache = ToolResultCache()
+
+def _time_key(value):
+    """把时间参数规范化为时间戳，同一时刻的不同写法命中同一条缓存"""
+    try:
+        return to_timestamp(value)
+    except ValueError:
+        return value
+
+def _invalidate_written(calendar_id: str, *events: Optional[MirroredEvent]) -> None:
+    """
+    写工具成功后失效受影响的日程与忙闲查询结果
+
+    日程时间已知时只失效与其相交的结果，否则全部失效。参与者列表不在本地，
+    忙闲结果除当前用户外还按时间失效所有人的（tag "freebusy"）。
+    """
+    windows = [(e.start, e.end or e.start + 1) for e in events if e is not None and e.start is not None] or [None]
+    user_id = get_processing_user()
+    for window in windows:
+        tool_cache.invalidate(f"calendar:{calendar_id}", window)
+        tool_cache.invalidate(f"freebusy:{user_id}", window)
+        tool_cache.invalidate("freebusy", window)
+
+def on_calendar_changed(calendar_id: str, user_ids: Optional[List[str]] = None) -> None:
+    """日历在飞书侧发生变化：通知镜像同步，并使依赖它的工具结果失效"""
+    get_calendar_mirror().mark_changed(calendar_id)
+    tool_cache.invalidate(f"calendar:{calendar_id}")
+    for user_id in user_ids or []:
+        tool_cache.invalidate(f"freebusy:{user_id}")
+
 # 保持原有的 Pydantic 模型定义
 class TodoInput(BaseModel):
     subject: str = Field(description="待办事项标题")
@@ -76,10 +143,20 @@ class TodoInput(BaseModel):
     priority: int = Field(0, description="优先级 10：较低 20：普通 30：紧急 40：非常紧急")
 
 class ScheduleSchema(BaseModel):
-    userIds: str = Field(description=f"用户ID")
+    userIds: str = Field(description=f"用户ID，多个用户用英文逗号分隔")
     startTime: str = Field(None, description="查询开始时间，格式必须为:2020-01-01T10:15:30+08:00,当前时间为{}".format(time.strftime("%Y-%m-%dT%H:%M:%S+08:00", time.localtime())))
     endTime: str = Field(None, description="查询结束时间，格式必须为:2020-01-01T10:15:30+08:00,当前时间为{}".format(time.strftime("%Y-%m-%dT%H:%M:%S+08:00", time.localtime())))
 
+class FreeSlotSchema(BaseModel):
+    userIds: List[str] = Field(description="所有参与者的用户ID")
+    startTime: str = Field(description="查找范围开始时间，格式必须为:2020-01-01T10:15:30+08:00,当前时间为{}".format(time.strftime("%Y-%m-%dT%H:%M:%S+08:00", time.localtime())))
+    endTime: str = Field(description="查找范围结束时间，格式必须为:2020-01-01T10:15:30+08:00,当前时间为{}".format(time.strftime("%Y-%m-%dT%H:%M:%S+08:00", time.localtime())))
+    durationMinutes: int = Field(30, description="会议时长，单位分钟")
+    limit: int = Field(3, description="最多返回几个可选时段")
+    workdayStart: int = Field(9, description="每天可安排会议的开始小时")
+    workdayEnd: int = Field(18, description="每天可安排会议的结束小时")
+    includeWeekends: bool = Field(False, description="是否包含周末")
+
 class ScheduleSchemaSet_data(BaseModel):
     date: str = Field(description=f"日程开始日期，格式：yyyy-MM-dd,当前时间为{time.strftime('%Y-%m-%d')},说明(全天日程必须有值,非全天日程必须留空)")
     dateTime: str = Field(description=f"日程开始时间，格式为ISO-8601的date-time格式{time.strftime('%Y-%m-%dT%H:%M:%S+08:00', time.localtime())},说明(全天日程必须留空,非全天日程必须有值)")
@@ -100,6 +177,8 @@ class ScheduleSchemaSet(BaseModel):
 class ScheduleSearch(BaseModel):
     timeMin: Optional[str] = Field(None, description="日程开始时间的最小值，格式为ISO-8601的date-time格式，可不填,说明(timeMin和 timeMax最大差值为一年),当前时间为{}".format(time.strftime("%Y-%m-%dT%H:%M:%S+08:00", time.localtime())))
     timeMax: Optional[str] = Field(None, description="日程开始时间的最大值，格式为ISO-8601的date-time格式，可不填,说明(timeMin和 timeMax最大差值为一年),当前时间为{}".format(time.strftime("%Y-%m-%dT%H:%M:%S+08:00", time.localtime())))
+    keyword: Optional[str] = Field(None, description="只查询标题或描述包含该关键词的日程，可不填")
+    limit: int = Field(20, description="最多返回的日程数")
 
 class ScheduleModify(BaseModel):
     timeMin: Optional[str] = Field(None, description="日程开始时间的最小值，格式为ISO-8601的date-time格式，可不填,说明(timeMin和 timeMax最大差值为一年),当前时间为{}".format(time.strftime("%Y-%m-%dT%H:%M:%S+08:00", time.localtime())))
@@ -112,7 +191,9 @@ class ScheduleModify(BaseModel):
 # 删除模型
 class DeleteSchedule(BaseModel):
     summary: str = Field(description="日程标题")
-    description: Optional[str] = Field(description="日程描述")
+    description: Optional[str] = Field(None, description="日程描述")
+    timeMin: Optional[str] = Field(None, description="要删除的日程开始时间的最小值，格式为ISO-8601的date-time格式，可不填,当前时间为{}".format(time.strftime("%Y-%m-%dT%H:%M:%S+08:00", time.localtime())))
+    timeMax: Optional[str] = Field(None, description="要删除的日程开始时间的最大值，格式为ISO-8601的date-time格式，可不填,当前时间为{}".format(time.strftime("%Y-%m-%dT%H:%M:%S+08:00", time.localtime())))
 
 class EventsId(BaseModel):
     id: str = Field(description="日程id")
@@ -125,8 +206,8 @@ class ScheduleDel(BaseModel):
 @tool
 def web_search(query: str) -> str:
     """只有需要了解实时信息或不知道的事情的时候才会使用这个工具."""
-    serp = SerpAPIWrapper()
-    return serp.run(query)
+    # 带缓存、超时与请求合并，返回精简后的前几条结果
+    return get_web_search().run(query)
 
 @tool(parse_docstring=True)
 def get_info_from_local(query: str) -> str:
@@ -140,8 +221,7 @@ def get_info_from_local(query: str) -> str:
     """
     print("-------RAG-------------")
     # 简化：不使用用户特定的聊天历史，或使用默认session
-    llm = ChatOpenAI(model=os.getenv("BASE_MODEL"))
-    memory = MemoryClass(memorykey=os.getenv("MEMORY_KEY"),model=os.getenv("BASE_MODEL"))
+    memory = MemoryClass(memorykey=os.getenv("MEMORY_KEY"))
     chat_history = []  # 简化：不使用聊天历史，或使用默认session
     
     condense_question_prompt = ChatPromptTemplate.from_messages([
@@ -150,26 +230,16 @@ def get_info_from_local(query: str) -> str:
         ("human", "{input}"),
     ])
 
-    client = QdrantClient(path=os.getenv("PERSIST_DIR","./vector_store"))
-    vector_store = QdrantVectorStore(
-        client=client, 
-        collection_name=os.getenv("EMBEDDING_COLLECTION"), 
-        embedding=OpenAIEmbeddings(
-            model=os.getenv("EMBEDDING_MODEL", "Pro/BAAI/bge-m3"),
-            api_key=os.getenv("EMBEDDING_API_KEY"),
-            base_url=os.getenv("EMBEDDING_API_BASE")
-        )
-    )
-    
-    retriever = vector_store.as_retriever(
+    # 进程内共享的向量库：本地库被 Server.py 持有时自动通过其 /vector 接口访问
+    retriever = get_vector_store().as_retriever(
         search_type="mmr",
         search_kwargs={"k": 5, "fetch_k": 10}
     )
     
     qa_chain = create_retrieval_chain(
-        create_history_aware_retriever(llm, retriever, condense_question_prompt),
+        create_history_aware_retriever(get_model("rag_condense"), retriever, condense_question_prompt),
         create_stuff_documents_chain(
-            llm,
+            get_model("rag_answer"),
             ChatPromptTemplate.from_messages([
                 ("system", "你是回答问题的助手。使用下列检索到的上下文回答。这个问题。如果你不知道答案，就说你不知道。最多使用三句话，并保持回答简明扼要。\n\n{context}"),
                 ("placeholder", "{chat_history}"),
@@ -241,47 +311,73 @@ def checkSchedule(schedule: ScheduleSchema) -> str:
         str: 查询结果消息
     """
     try:
+        user_ids = sorted({u.strip() for u in schedule.userIds.split(",") if u.strip()})
+        cache_key = tool_cache.make_key({
+            "userIds": user_ids, "startTime": _time_key(schedule.startTime), "endTime": _time_key(schedule.endTime)
+        })
+        cached = tool_cache.get("checkSchedule", get_processing_user(), cache_key)
+        if cached is not None:
+            return cached
+        
         client = FeishuClient()
         feishu_client = client.get_client()
         
-        # 构建忙闲查询请求
-        request_body = GetFreebusyListRequest.builder() \
-            .request_body(GetFreebusyListRequestBody.builder()
-                         .time_min(schedule.startTime)
-                         .time_max(schedule.endTime)
-                         .user_id_type("open_id")
-                         .user_ids([schedule.userIds])
-                         .build()) \
-            .build()
-        
-        # 调用API查询忙闲状态
-        response = feishu_client.calendar.v4.freebusy.list(request_body)
+        # 批量查询忙闲，并在本地合并每个用户的忙碌区间
+        busy, errors = fetch_busy(feishu_client, user_ids, schedule.startTime, schedule.endTime)
+        if errors and not busy:
+            return f"查询忙闲状态失败: {next(iter(errors.values()))}"
         
-        if response.success():
-            # 格式化返回数据，保持与钉钉格式兼容
-            freebusy_list = response.data.freebusy_list if response.data else []
-            
-            schedule_items = []
-            for freebusy in freebusy_list:
-                if hasattr(freebusy, 'busy_details'):
-                    for busy_detail in freebusy.busy_details:
-                        schedule_items.append({
-                            "start": {"dateTime": busy_detail.start_time},
-                            "end": {"dateTime": busy_detail.end_time},
-                            "status": "BUSY"
-                        })
-            
-            return {
-                "scheduleInformation": [{
-                    "scheduleItems": schedule_items
-                }]
+        result = {
+            "busy": {
+                user_id: [format_range(start, end) for start, end in intervals] or "空闲"
+                for user_id, intervals in busy.items()
             }
-        else:
-            return f"查询忙闲状态失败: {response.code}: {response.msg}"
+        }
+        if errors:
+            # 部分失败的结果不缓存
+            result["failed"] = list(errors)
+            return result
+        window = (to_timestamp(schedule.startTime), to_timestamp(schedule.endTime))
+        tags = {f"freebusy:{user_id}": window for user_id in user_ids}
+        tags["freebusy"] = window
+        tool_cache.put("checkSchedule", get_processing_user(), cache_key, result, tags=tags)
+        return result
             
     except Exception as e:
         return f"查询忙闲状态失败: {str(e)}"
 
+@tool
+def FindFreeSlots(query: FreeSlotSchema) -> str:
+    """为多位参与者查找共同空闲的会议时段
+    Args:
+        query: 参与者、查找范围与会议时长
+    Returns:
+        str: 所有人都空闲、且能容纳会议的时段
+    """
+    try:
+        client = FeishuClient()
+        feishu_client = client.get_client()
+        
+        busy, errors = fetch_busy(feishu_client, query.userIds, query.startTime, query.endTime)
+        if errors:
+            # 缺少任何一人的忙闲都无法保证时段可用
+            return f"查询忙闲状态失败: {', '.join(errors)}: {next(iter(errors.values()))}"
+        
+        # 区间扫描在本地完成，只把结论交给模型
+        slots = find_common_slots(
+            [interval for intervals in busy.values() for interval in intervals],
+            to_timestamp(query.startTime), to_timestamp(query.endTime),
+            duration=query.durationMinutes * 60, limit=query.limit,
+            day_start=query.workdayStart, day_end=query.workdayEnd,
+            skip_weekends=not query.includeWeekends,
+        )
+        if not slots:
+            return f"该时间范围内没有所有人都空闲的 {query.durationMinutes} 分钟时段"
+        return {"slots": [format_range(start, end) for start, end in slots], "durationMinutes": query.durationMinutes}
+            
+    except Exception as e:
+        return f"查找空闲时段失败: {str(e)}"
+
 @tool
 def SetSchedule(sets: ScheduleSchemaSet) -> str:
     """创建日程
@@ -295,19 +391,7 @@ def SetSchedule(sets: ScheduleSchemaSet) -> str:
         feishu_client = client.get_client()
         
         # 获取主日历 ID
-        list_request = ListCalendarRequest.builder().build()
-        list_response = feishu_client.calendar.v4.calendar.list(list_request)
-        
-        if not list_response.success():
-            return f"获取日历列表失败: {list_response.code}: {list_response.msg}"
-            
-        # 使用第一个日历作为主日历
-        calendar_id = "primary"
-        if list_response.data and list_response.data.calendar_list:
-            for cal in list_response.data.calendar_list:
-                if cal.type == "primary":
-                    calendar_id = cal.calendar_id
-                    break
+        calendar_id = _primary_calendar_id()
         
         # 构建飞书日程事件数据
         event_builder = CreateCalendarEventRequestBody.builder() \
@@ -342,9 +426,13 @@ def SetSchedule(sets: ScheduleSchemaSet) -> str:
         response = feishu_client.calendar.v4.calendar_event.create(request_body)
         
         if response.success():
-            event = response.data.event
+            # 写回本地镜像，随后的查询立即可见；只失效与新日程时间相交的日程与忙闲查询结果
+            get_calendar_mirror().apply(calendar_id, response.data.event)
+            created = event_from_feishu(calendar_id, response.data.event) if response.data.event else None
+            _invalidate_written(calendar_id, created)
             return f"成功创建日程: {sets.summary}"
         else:
+            _calendar_failed(calendar_id, response.code)
             return f"创建日程失败: {response.code}: {response.msg}"
             
     except Exception as e:
@@ -359,100 +447,60 @@ def SearchSchedule(search: ScheduleSearch) -> str:
         str: 查询结果消息
     """
     try:
+        cache_key = tool_cache.make_key({
+            **search.model_dump(), "timeMin": _time_key(search.timeMin), "timeMax": _time_key(search.timeMax)
+        })
+        cached = tool_cache.get("SearchSchedule", get_processing_user(), cache_key)
+        if cached is not None:
+            return cached
+        
         client = FeishuClient()
         feishu_client = client.get_client()
         
         # 获取主日历 ID
-        list_request = ListCalendarRequest.builder().build()
-        list_response = feishu_client.calendar.v4.calendar.list(list_request)
-        
-        if not list_response.success():
-            return f"获取日历列表失败: {list_response.code}: {list_response.msg}"
-            
-        calendar_id = "primary"
-        if list_response.data and list_response.data.calendar_list:
-            for cal in list_response.data.calendar_list:
-                if cal.type == "primary":
-                    calendar_id = cal.calendar_id
-                    break
-        
-        # 构建查询请求
-        request_builder = ListCalendarEventRequest.builder() \
-            .calendar_id(calendar_id)
-        
-        if search.timeMin:
-            request_builder.start_time(search.timeMin)
-        if search.timeMax:
-            request_builder.end_time(search.timeMax)
-            
-        request_body = request_builder.build()
-        
-        # 调用API查询日程
-        response = feishu_client.calendar.v4.calendar_event.list(request_body)
-        
-        if response.success():
-            events = response.data.items if response.data and response.data.items else []
-            if not events:
-                return "您的日程空空如也"
-            
-            # 格式化返回数据，保持与原来兼容的格式
-            events_data = []
-            for event in events:
-                event_dict = {
-                    'id': event.event_id,
-                    'summary': event.summary,
-                    'description': event.description or "",
-                    'start': {},
-                    'end': {},
-                    'isAllDay': False,
-                    'status': event.status
-                }
-                
-                # 处理开始时间
-                if event.start_time:
-                    if hasattr(event.start_time, 'date') and event.start_time.date:
-                        event_dict['start']['date'] = event.start_time.date
-                        event_dict['isAllDay'] = True
-                    elif hasattr(event.start_time, 'timestamp') and event.start_time.timestamp:
-                        event_dict['start']['dateTime'] = event.start_time.timestamp
-                
-                # 处理结束时间
-                if event.end_time:
-                    if hasattr(event.end_time, 'date') and event.end_time.date:
-                        event_dict['end']['date'] = event.end_time.date
-                    elif hasattr(event.end_time, 'timestamp') and event.end_time.timestamp:
-                        event_dict['end']['dateTime'] = event.end_time.timestamp
-                
-                events_data.append(event_dict)
-            
-            return {"events": events_data}
+        calendar_id = _primary_calendar_id()
+        
+        # 未指定时间范围时只看当前时间前后一段，不再拉取全部历史
+        time_min, time_max = default_window(search.timeMin, search.timeMax)
+        
+        # 从本地镜像查询，镜像通过增量同步和变更订阅与飞书保持一致；多取一条用于判断是否还有更多
+        try:
+            events = get_calendar_mirror().query(
+                calendar_id, time_min, time_max, keyword=search.keyword, limit=search.limit + 1
+            )
+        except CalendarSyncError as e:
+            _calendar_failed(calendar_id, e.code)
+            if e.code in CALENDAR_NOT_FOUND_CODES:
+                raise
+            # 镜像同步失败时退回实时查询：服务端按时间过滤，分页惰性读取，够数即停
+            logger.warning(f"日历镜像不可用，改为实时查询: {e}")
+            matches = (event for event in iter_events(feishu_client, calendar_id, time_min, time_max)
+                       if event.matches(search.keyword))
+            events = list(islice(matches, search.limit + 1))
+        if not events:
+            result = "您的日程空空如也"
         else:
-            return f"查询日程失败: {response.code}: {response.msg}"
+            result = {"events": [event.to_compact() for event in events[:search.limit]]}
+            if len(events) > search.limit:
+                result["more"] = "还有更多日程，请缩小时间范围或提供关键词"
+        tool_cache.put("SearchSchedule", get_processing_user(), cache_key, result,
+                       tags={f"calendar:{calendar_id}": (time_min, time_max)})
+        return result
             
     except Exception as e:
         return f"查询日程失败: {str(e)}"
 
 def FindPreciseOrder(orginrder: str, events: object) -> str:
     """查找精确的指令"""
-    llm = ChatOpenAI(model=os.getenv("BASE_MODEL"))
+    llm = get_model("event_match")
     prompt = ChatPromptTemplate.from_messages([
-        ("system", """请根据用户的输入和查询到的日程信息，提取出与用户输入最匹配的1个日程id以及是否为全天事件。注意查询到的数据结构为：{{'events':[{{
-            'attendees': [],
-            'categories': [],
-            'createTime': '2023-09-26T08: 24: 18Z',
-            'description': '',
-            'end': '',
-            'extendedProperties': '',
+        ("system", """请根据用户的输入和查询到的日程信息，提取出与用户输入最匹配的1个日程id以及是否为全天事件。注意查询到的数据结构为：[{{
             'id': '',
-            'isAllDay': False,
-            'organizer': '',
-            'reminders': [
-            ],
-            'start': '',
-            'status': '',
-            'summary': 'xxxxxx,
-            'updateTime': ''
-        }}]}} 日程id为events中的id字段，例如events[0]['id']，是否为全天事件字段为events中的isAllDay，例如events[0]['isAllDay']，有可能存在多个events项，你需要根据用户输入来匹配筛选，输出结构化数据,不要有其他输出。查询到的日程信息为：{events}"""),
+            'summary': 'xxxxxx',
+            'time': '2023-09-26 10:00~11:00',
+            'isAllDay': True,
+            'description': ''
+        }}] 日程id为每一项中的id字段，例如events[0]['id']，是否为全天事件字段为isAllDay，缺省表示不是全天事件，description缺省表示没有描述，有可能存在多个日程项，你需要根据用户输入来匹配筛选，输出结构化数据,不要有其他输出。如果没有日程与用户所说的是同一件事（例如只是有几个字相同），id 输出空字符串。查询到的日程信息为：{events}"""),
         ("human", "{input}"),
     ])
     try:
@@ -464,6 +512,48 @@ def FindPreciseOrder(orginrder: str, events: object) -> str:
         print(e)
         return None
 
+# 本地日程匹配，只有多个候选分数接近时才调用 FindPreciseOrder
+event_matcher = EventMatcher()
+
+def _pick_event(query: MatchQuery, orginOder: str, events: list) -> Optional[dict]:
+    """从查询到的日程中找出用户所指的那一个，找不到返回 None"""
+    result = event_matcher.match(query, events)
+    if result.event is not None:
+        return result.event
+    if not result.candidates:
+        return None
+    returnID = FindPreciseOrder(orginOder, result.candidates)
+    if returnID is None:
+        return None
+    return next((event for event in result.candidates if event['id'] == returnID.id), None)
+
+# 修改、删除日程未指定时间范围时，查找目标日程的范围为当前时间前后多少天（飞书限制总跨度不超过一年）
+TARGET_SEARCH_DAYS = int(os.getenv("SCHEDULE_TARGET_DAYS", "180"))
+
+# 候选日程超过一次查询上限且无法确定目标时的提示
+TOO_MANY_EVENTS = "符合条件的日程太多，请提供日程的大致时间或更准确的标题"
+
+def _search_targets(summary: Optional[str], time_min: Optional[str], time_max: Optional[str]):
+    """
+    查找要修改或删除的候选日程
+
+    先按标题关键词查询，没有命中（标题说法不同或正在改名）时再去掉关键词；
+    未指定时间范围时比 SearchSchedule 的默认范围更宽，查看前后 TARGET_SEARCH_DAYS 天
+
+    Returns:
+        SearchSchedule 的结果，查询失败时为错误信息字符串
+    """
+    if time_min is None and time_max is None:
+        now = int(time.time())
+        time_min = format_timestamp(now - TARGET_SEARCH_DAYS * 86400)
+        time_max = format_timestamp(now + TARGET_SEARCH_DAYS * 86400)
+    for keyword in dict.fromkeys([summary or None, None]):
+        search_params = ScheduleSearch(timeMin=time_min, timeMax=time_max, keyword=keyword, limit=100)
+        searchResult = SearchSchedule.invoke({"search": search_params.model_dump()})
+        if searchResult != "您的日程空空如也":
+            break
+    return searchResult
+
 @tool
 def ModifySchedule(search: ScheduleModify) -> str:
     """修改日程
@@ -473,40 +563,33 @@ def ModifySchedule(search: ScheduleModify) -> str:
         str: 修改结果消息
     """
     try:
-        # 创建 ScheduleSearch 对象并转换为字典
-        search_params = ScheduleSearch(
-            timeMin=search.timeMin,
-            timeMax=search.timeMax
-        )
-        
-        # 包装成正确的格式：添加 search 字段
-        search_dict = {
-            "search": search_params.model_dump()
-        }
-        
-        # 使用 invoke 方法调用 SearchSchedule
-        searchResult = SearchSchedule.invoke(search_dict)
+        # 按标题查找要修改的日程
+        searchResult = _search_targets(search.summary, search.timeMin, search.timeMax)
         if isinstance(searchResult, str):
-            return "查询日程失败"
+            return searchResult if searchResult == "您的日程空空如也" else "查询日程失败"
             
         events = searchResult.get('events', [])
-        if not events:
-            return "您的日程空空如也"
             
         # 查找要修改的日程
         eventid = None
         isAllDay = False
-        calendar_id = "primary"
         
-        if len(events) > 1:
+        # 只查到一个日程时也要核对标题和描述，去掉关键词重查得到的可能是另一件事
+        if len(events) > 1 or searchResult.get('more') or search.summary or search.description:
             orginOder = f"description: {search.description}, start: {search.start}, end: {search.end}, summary: {search.summary}"
-            returnID = FindPreciseOrder(orginOder, events)
-            if returnID:
-                eventid = returnID.id
-                isAllDay = returnID.isAllDay
+            # start/end 是修改后的时间，用查询范围的开始时间衡量时间接近程度
+            event = _pick_event(
+                MatchQuery(summary=search.summary, description=search.description, start=search.timeMin),
+                orginOder, events
+            )
+            if event:
+                eventid = event['id']
+                isAllDay = event.get('isAllDay', False)
+            elif searchResult.get('more'):
+                return TOO_MANY_EVENTS
         else:
             eventid = events[0]['id']
-            isAllDay = events[0]['isAllDay']
+            isAllDay = events[0].get('isAllDay', False)
         
         if not eventid:
             return "您的日程似乎不存在，是否输入有误？"
@@ -516,14 +599,7 @@ def ModifySchedule(search: ScheduleModify) -> str:
         feishu_client = client.get_client()
         
         # 获取主日历 ID
-        list_request = ListCalendarRequest.builder().build()
-        list_response = feishu_client.calendar.v4.calendar.list(list_request)
-        
-        if list_response.data and list_response.data.calendar_list:
-            for cal in list_response.data.calendar_list:
-                if cal.type == "primary":
-                    calendar_id = cal.calendar_id
-                    break
+        calendar_id = _primary_calendar_id()
         
         # 构建修改请求
         update_builder = PatchCalendarEventRequestBody.builder()
@@ -560,12 +636,19 @@ def ModifySchedule(search: ScheduleModify) -> str:
             .request_body(update_builder.build()) \
             .build()
         
+        # 修改前的时间取自镜像，修改前后两个时间段的查询结果都要失效
+        before = get_calendar_mirror().get(calendar_id, eventid)
+        
         # 调用API修改日程
         response = feishu_client.calendar.v4.calendar_event.patch(request_body)
         
         if response.success():
+            get_calendar_mirror().apply(calendar_id, response.data.event)
+            after = event_from_feishu(calendar_id, response.data.event) if response.data.event else None
+            _invalidate_written(calendar_id, *([before, after] if before and after else [None]))
             return "成功修改日程"
         else:
+            _calendar_failed(calendar_id, response.code)
             return f"修改日程失败: {response.code}: {response.msg}"
             
     except Exception as e:
@@ -579,24 +662,21 @@ def DelSchedule(query: DeleteSchedule) -> str:
     Returns:
         str: 返回给用户确认要具体删除的日程信息
     """
-    # 创建 ScheduleSearch 对象并转换为字典
-    search_params = ScheduleSearch()
-    # 包装成正确的格式：添加 search 字段
-    search_dict = {
-        "search": search_params.model_dump()
-    }
-    # 使用 invoke 方法调用 SearchSchedule
-    searchResult = SearchSchedule.invoke(search_dict)
+    # 按标题查找要删除的日程
+    searchResult = _search_targets(query.summary, query.timeMin, query.timeMax)
+    if isinstance(searchResult, str):
+        return searchResult
     events = searchResult.get('events', [])
-    if not events:
-        return "您的日程空空如也"
-    if len(events) > 1:
+    # 只查到一个日程时也要核对标题和描述，去掉关键词重查得到的可能是另一件事
+    if len(events) > 1 or searchResult.get('more') or query.summary or query.description:
         orginOder = f"description: {query.description}, summary: {query.summary}"
-        returnID = FindPreciseOrder(orginOder,events)
-        print(returnID)
-        eventid = returnID.id
+        event = _pick_event(
+            MatchQuery(summary=query.summary, description=query.description, start=query.timeMin),
+            orginOder, events
+        )
+        eventid = event['id'] if event else None
         if not eventid:
-            return "您的日程似乎不存在，是否输入有误？"
+            return TOO_MANY_EVENTS if searchResult.get('more') else "您的日程似乎不存在，是否输入有误？"
     else:
         eventid = events[0]['id']
     print("要删除的日程ID：",eventid)
@@ -618,15 +698,7 @@ def ConfirmDelSchedule(query: ScheduleDel) -> str:
         feishu_client = client.get_client()
         
         # 获取主日历 ID
-        list_request = ListCalendarRequest.builder().build()
-        list_response = feishu_client.calendar.v4.calendar.list(list_request)
-        
-        calendar_id = "primary"
-        if list_response.data and list_response.data.calendar_list:
-            for cal in list_response.data.calendar_list:
-                if cal.type == "primary":
-                    calendar_id = cal.calendar_id
-                    break
+        calendar_id = _primary_calendar_id()
         
         # 构建删除请求
         request_body = DeleteCalendarEventRequest.builder() \
@@ -638,8 +710,12 @@ def ConfirmDelSchedule(query: ScheduleDel) -> str:
         response = feishu_client.calendar.v4.calendar_event.delete(request_body)
         
         if response.success():
+            removed = get_calendar_mirror().get(calendar_id, query.eventid)
+            get_calendar_mirror().remove(calendar_id, query.eventid)
+            _invalidate_written(calendar_id, removed)
             return "成功删除日程"
         else:
+            _calendar_failed(calendar_id, response.code)
             return f"删除日程失败: {response.code}: {response.msg}"
             
     except Exception as e:
@@ -0,0 +1,625 @@
+"""
+向量库访问层
+
+嵌入式 Qdrant（QdrantClient(path=...)）会对存储目录加独占文件锁，同一时刻只能有一个进程打开。
+本模块保证每个进程只持有一个客户端，并提供三种模式：
+
+- server: 配置了 QDRANT_URL 时连接 Qdrant 服务端，所有进程都可以直接读写
+- local:  本进程以嵌入模式独占 PERSIST_DIR，其他进程通过 Server.py 暴露的 /vector 接口访问
+- remote: 通过 HTTP 调用持有本地库的进程（VECTOR_STORE_ENDPOINT）
+
+三种模式对外都提供批量的 search_batch / upsert 接口以及 LangChain 检索器。
+
+知识库集合名（EMBEDDING_COLLECTION）可以是Qdrant别名：重建索引时在新的版本集合中构建，
+校验通过后切换别名，IndexRegistry 记录每个版本的嵌入模型与分片参数。
+检索时每次解析别名，并按解析出的版本集合选择嵌入模型，别名切换后不会用旧模型查询新集合。
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import httpx
+import numpy as np
+from dotenv import load_dotenv as _load_dotenv
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores.utils import maximal_marginal_relevance
+from langchain_openai import OpenAIEmbeddings
+from qdrant_client import QdrantClient
+from qdrant_client.http import models as rest
+from qdrant_client.local.qdrant_local import QdrantLocal
+
+from .HttpPool import http_clients
+from .Manifest import get_state_dir
+
+_load_dotenv()
+
+logger = logging.getLogger("VectorStore")
+
+CONTENT_KEY = "page_content"
+METADATA_KEY = "metadata"
+
+_client: Optional[QdrantClient] = None
+_embeddings: Dict[str, Embeddings] = {}
+_registry: Optional["IndexRegistry"] = None
+_store: Optional[Any] = None
+_lock = threading.Lock()
+# 嵌入式Qdrant不是线程安全的，同一客户端上的读写需要串行；服务端模式由Qdrant自行处理并发
+_client_locks: "weakref.WeakKeyDictionary[QdrantClient, threading.Lock]" = weakref.WeakKeyDictionary()
+
+
+def get_collection_name() -> str:
+    """知识库集合名，兼容历史上的 EMBEDDING_COLLECTION / COLLECTION_NAME 两种配置"""
+    return os.getenv("EMBEDDING_COLLECTION") or os.getenv("COLLECTION_NAME", "xiaolang_documents")
+
+
+def get_persist_dir() -> str:
+    return os.getenv("PERSIST_DIR", "./vector_store")
+
+
+def get_mode() -> str:
+    """解析向量库访问模式，未显式配置时按 QDRANT_URL / VECTOR_STORE_ENDPOINT 推断"""
+    mode = os.getenv("VECTOR_STORE_MODE")
+    if mode:
+        return mode
+    if os.getenv("QDRANT_URL"):
+        return "server"
+    if os.getenv("VECTOR_STORE_ENDPOINT"):
+        return "remote"
+    return "local"
+
+
+@dataclass
+class IndexVersion:
+    collection: str
+    alias: str
+    version: int
+    embedding_model: str
+    chunk_size: int
+    chunk_overlap: int
+    vector_size: int
+    status: str
+    created_at: float = 0.0
+    activated_at: Optional[float] = None
+    stats: Optional[str] = None
+
+
+class IndexRegistry:
+    """知识库集合版本登记，状态为 building / active / retired / failed"""
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path or os.path.join(get_state_dir(), "index_versions.sqlite3")
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS versions ("
+                "collection TEXT PRIMARY KEY, alias TEXT NOT NULL, version INTEGER NOT NULL, "
+                "embedding_model TEXT NOT NULL, chunk_size INTEGER NOT NULL, chunk_overlap INTEGER NOT NULL, "
+                "vector_size INTEGER NOT NULL, status TEXT NOT NULL, created_at REAL, activated_at REAL, stats TEXT)"
+            )
+
+    def next_collection(self, alias: str) -> str:
+        """下一个版本的物理集合名；未经版本管理的原集合视为第1版"""
+        with self._lock:
+            row = self.conn.execute("SELECT MAX(version) FROM versions WHERE alias = ?", (alias,)).fetchone()
+        return f"{alias}_v{(row[0] or 1) + 1}"
+
+    def add(self, version: IndexVersion) -> None:
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (version.collection, version.alias, version.version, version.embedding_model,
+                 version.chunk_size, version.chunk_overlap, version.vector_size, version.status,
+                 version.created_at or time.time(), version.activated_at, version.stats),
+            )
+
+    def set_status(self, collection: str, status: str, stats: Optional[dict] = None) -> None:
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE versions SET status = ?, activated_at = CASE WHEN ? = 'active' THEN ? ELSE activated_at END, "
+                "stats = COALESCE(?, stats) WHERE collection = ?",
+                (status, status, time.time(), json.dumps(stats, ensure_ascii=False) if stats else None, collection),
+            )
+
+    def active(self, alias: str) -> Optional[IndexVersion]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT * FROM versions WHERE alias = ? AND status = 'active' ORDER BY version DESC LIMIT 1",
+                (alias,),
+            ).fetchone()
+        return IndexVersion(*row) if row else None
+
+    def get(self, collection: str) -> Optional[IndexVersion]:
+        with self._lock:
+            row = self.conn.execute("SELECT * FROM versions WHERE collection = ?", (collection,)).fetchone()
+        return IndexVersion(*row) if row else None
+
+    def versions(self, alias: str) -> List[IndexVersion]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT * FROM versions WHERE alias = ? ORDER BY version", (alias,)
+            ).fetchall()
+        return [IndexVersion(*row) for row in rows]
+
+
+def get_registry() -> IndexRegistry:
+    global _registry
+    if _registry is None:
+        with _lock:
+            if _registry is None:
+                _registry = IndexRegistry()
+    return _registry
+
+
+def get_active_index(alias: Optional[str] = None) -> Optional[IndexVersion]:
+    """当前生效的索引版本，从未重建过索引时返回None（使用环境变量中的配置）"""
+    path = os.path.join(os.getenv("INGEST_STATE_DIR", "./ingest_state"), "index_versions.sqlite3")
+    if _registry is None and not os.path.exists(path):
+        return None
+    return get_registry().active(alias or get_collection_name())
+
+
+def get_index_version(collection: str) -> Optional[IndexVersion]:
+    """物理集合对应的索引版本，未经版本管理的集合返回None"""
+    path = os.path.join(os.getenv("INGEST_STATE_DIR", "./ingest_state"), "index_versions.sqlite3")
+    if _registry is None and not os.path.exists(path):
+        return None
+    return get_registry().get(collection)
+
+
+def get_embeddings(model: Optional[str] = None) -> Embeddings:
+    """
+    进程内共享的嵌入模型客户端
+
+    Args:
+        model: 模型名，None则使用当前生效索引版本的模型，未重建过索引时使用 EMBEDDING_MODEL
+    """
+    if model is None:
+        active = get_active_index()
+        model = active.embedding_model if active else os.getenv("EMBEDDING_MODEL", "Pro/BAAI/bge-m3")
+    if model not in _embeddings:
+        with _lock:
+            if model not in _embeddings:
+                _embeddings[model] = OpenAIEmbeddings(
+                    model=model,
+                    api_key=os.getenv("EMBEDDING_API_KEY"),
+                    base_url=os.getenv("EMBEDDING_API_BASE"),
+                    **http_clients()
+                )
+    return _embeddings[model]
+
+
+def get_qdrant_client(path: Optional[str] = None) -> QdrantClient:
+    """
+    获取进程内唯一的Qdrant客户端
+
+    Args:
+        path: 嵌入模式的存储目录，None则使用 PERSIST_DIR；服务端模式下忽略
+
+    Returns:
+        QdrantClient 实例
+    """
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                if get_mode() == "server":
+                    _client = QdrantClient(
+                        url=os.getenv("QDRANT_URL"),
+                        api_key=os.getenv("QDRANT_API_KEY"),
+                        prefer_grpc=os.getenv("QDRANT_PREFER_GRPC", "false").lower() == "true",
+                    )
+                    logger.info(f"连接Qdrant服务端: {os.getenv('QDRANT_URL')}")
+                else:
+                    _client = QdrantClient(path=path or get_persist_dir())
+                    logger.info(f"以嵌入模式打开本地向量库: {path or get_persist_dir()}")
+    return _client
+
+
+def _lock_for(client: QdrantClient) -> Optional[threading.Lock]:
+    if not isinstance(getattr(client, "_client", None), QdrantLocal):
+        return None
+    with _lock:
+        if client not in _client_locks:
+            _client_locks[client] = threading.Lock()
+        return _client_locks[client]
+
+
+def resolve_collection(client: QdrantClient, name: str) -> Optional[str]:
+    """别名或集合名对应的物理集合，不存在时返回None"""
+    lock = _lock_for(client)
+    with lock or nullcontext():
+        aliases = client.get_aliases().aliases
+        collections = client.get_collections().collections
+    for alias in aliases:
+        if alias.alias_name == name:
+            return alias.collection_name
+    return name if any(collection.name == name for collection in collections) else None
+
+
+def copy_collection(client: QdrantClient, source: str, target: str, batch_size: int = 256) -> int:
+    """
+    按原集合的向量与索引配置新建 target，并复制全部点（含向量与载荷）
+
+    Returns:
+        复制的点数
+    """
+    lock = _lock_for(client)
+    with lock or nullcontext():
+        config = client.get_collection(source).config
+        client.create_collection(
+            collection_name=target,
+            vectors_config=config.params.vectors,
+            hnsw_config=rest.HnswConfigDiff(**config.hnsw_config.model_dump()),
+            quantization_config=config.quantization_config,
+        )
+    copied, offset = 0, None
+    while True:
+        with lock or nullcontext():
+            points, offset = client.scroll(collection_name=source, limit=batch_size, offset=offset,
+                                           with_payload=True, with_vectors=True)
+            if points:
+                client.upsert(collection_name=target, wait=True, points=[
+                    rest.PointStruct(id=point.id, vector=point.vector, payload=point.payload) for point in points
+                ])
+        copied += len(points)
+        if offset is None:
+            return copied
+
+
+def replace_with_alias(client: QdrantClient, alias: str, target: str, attempts: int = 3) -> None:
+    """
+    首次版本化：原来同名的物理集合已复制到 target 后，删除原集合并创建指向 target 的别名
+
+    别名与集合不能同名，删除与创建之间有极短的窗口；窗口内启用 follow_active_index 的检索按版本登记
+    改读 target，调用前需先把 target 登记为 active。创建别名失败时重试，数据始终保留在 target 中。
+    """
+    lock = _lock_for(client)
+    with lock or nullcontext():
+        client.delete_collection(alias)
+    for attempt in range(1, attempts + 1):
+        try:
+            with lock or nullcontext():
+                client.update_collection_aliases(change_aliases_operations=[rest.CreateAliasOperation(
+                    create_alias=rest.CreateAlias(collection_name=target, alias_name=alias)
+                )])
+            break
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            logger.warning(f"创建别名 {alias} 失败，重试: {e}")
+            time.sleep(attempt)
+    logger.info(f"集合 {alias} 已迁移为指向 {target} 的别名")
+
+
+def switch_alias(client: QdrantClient, alias: str, target: str) -> str:
+    """
+    把别名切换到新集合，删除旧别名与创建新别名在同一个请求中原子完成
+
+    Returns:
+        切换前的物理集合名
+    """
+    previous = resolve_collection(client, alias)
+    if previous is None or previous == alias:
+        raise ValueError(f"{alias} 还不是别名，需先用 copy_collection 与 replace_with_alias 迁移")
+    lock = _lock_for(client)
+    with lock or nullcontext():
+        client.update_collection_aliases(change_aliases_operations=[
+            rest.DeleteAliasOperation(delete_alias=rest.DeleteAlias(alias_name=alias)),
+            rest.CreateAliasOperation(create_alias=rest.CreateAlias(collection_name=target, alias_name=alias)),
+        ])
+    logger.info(f"别名 {alias} 已切换到 {target}")
+    return previous
+
+
+def _payload_to_document(point: Any, collection_name: str) -> Document:
+    payload = point.payload or {}
+    metadata = dict(payload.get(METADATA_KEY) or {})
+    metadata["_id"] = point.id
+    metadata["_collection_name"] = collection_name
+    return Document(page_content=payload.get(CONTENT_KEY, ""), metadata=metadata)
+
+
+def _document_to_dict(doc: Document) -> Dict[str, Any]:
+    return {"page_content": doc.page_content, "metadata": doc.metadata}
+
+
+class VectorStoreService:
+    """直接持有Qdrant客户端的向量库服务，供 owner 进程或服务端模式使用"""
+
+    def __init__(self,
+                 client: QdrantClient,
+                 collection_name: str,
+                 embeddings: Embeddings,
+                 write_batch_size: int = int(os.getenv("VECTOR_WRITE_BATCH_SIZE", "64")),
+                 follow_active_index: bool = False) -> None:
+        """
+        Args:
+            client: Qdrant客户端
+            collection_name: 集合名称
+            embeddings: 嵌入模型
+            write_batch_size: 单次写入的点数，写入分批进行以便读请求穿插执行
+            follow_active_index: 每次检索时解析别名，并使用解析出的版本集合登记的嵌入模型，
+                重建索引切换别名后立即改用新版本的集合与模型
+        """
+        self.client = client
+        self.collection_name = collection_name
+        self.embeddings = embeddings
+        self.write_batch_size = write_batch_size
+        self.follow_active_index = follow_active_index
+        self._client_lock = _lock_for(client)
+        # 物理集合 -> 查询它使用的嵌入模型；构造时传入的模型对应当前解析到的集合
+        self._collection_embeddings: Dict[str, Embeddings] = {}
+        if follow_active_index:
+            self._collection_embeddings[resolve_collection(client, collection_name) or collection_name] = embeddings
+        # 进行中的检索数，入库时据此给检索让路
+        self._active_searches = 0
+        self._counter_lock = threading.Lock()
+
+    def _locked(self, fn, *args, **kwargs):
+        if self._client_lock is None:
+            return fn(*args, **kwargs)
+        with self._client_lock:
+            return fn(*args, **kwargs)
+
+    def search_batch(self,
+                     queries: List[str],
+                     k: int = 5,
+                     fetch_k: int = 20,
+                     search_type: str = "similarity",
+                     lambda_mult: float = 0.5) -> List[List[Document]]:
+        """
+        批量检索，一次嵌入所有查询并一次请求Qdrant
+
+        Args:
+            queries: 查询文本列表
+            k: 每个查询返回的文档数
+            fetch_k: MMR模式下先召回的候选数
+            search_type: similarity 或 mmr
+            lambda_mult: MMR多样性参数
+
+        Returns:
+            与 queries 一一对应的文档列表
+        """
+        if not queries:
+            return []
+        with self._counter_lock:
+            self._active_searches += 1
+        try:
+            return self._search_batch(queries, k, fetch_k, search_type, lambda_mult)
+        finally:
+            with self._counter_lock:
+                self._active_searches -= 1
+
+    def use_embeddings(self, collection: str, embeddings: Embeddings) -> None:
+        """指定查询某个物理集合时使用的嵌入模型，重建索引切换后由 DocumentProcessor.use_index 调用"""
+        self._collection_embeddings[collection] = embeddings
+        self.embeddings = embeddings
+
+    def resolve(self) -> tuple:
+        """
+        本次检索使用的物理集合与嵌入模型
+
+        Returns:
+            (集合名, 嵌入模型)；未启用 follow_active_index 时直接使用构造参数
+        """
+        if not self.follow_active_index:
+            return self.collection_name, self.embeddings
+        collection = resolve_collection(self.client, self.collection_name)
+        if collection is None:
+            # 首次版本化迁移时别名尚未创建的瞬间，按版本登记读取已复制的集合
+            active = get_active_index(self.collection_name)
+            collection = active.collection if active else self.collection_name
+        embeddings = self._collection_embeddings.get(collection)
+        if embeddings is None:
+            version = get_index_version(collection)
+            embeddings = get_embeddings(version.embedding_model) if version else self.embeddings
+            if version:
+                logger.info(f"{self.collection_name} 当前指向 {collection}，使用嵌入模型 {version.embedding_model}")
+            self._collection_embeddings[collection] = embeddings
+        return collection, embeddings
+
+    def _search_batch(self, queries: List[str], k: int, fetch_k: int,
+                      search_type: str, lambda_mult: float) -> List[List[Document]]:
+        # 集合与模型一起解析，查询向量总是由该集合的嵌入模型生成
+        collection, embeddings = self.resolve()
+        vectors = embeddings.embed_documents(queries)
+        is_mmr = search_type == "mmr"
+        requests = [
+            rest.QueryRequest(
+                query=vector,
+                limit=fetch_k if is_mmr else k,
+                with_payload=True,
+                with_vector=is_mmr,
+            )
+            for vector in vectors
+        ]
+        responses = self._locked(
+            self.client.query_batch_points, collection_name=collection, requests=requests
+        )
+        results = []
+        for vector, response in zip(vectors, responses):
+            points = response.points
+            if is_mmr and points:
+                selected = maximal_marginal_relevance(
+                    np.array(vector), [point.vector for point in points], k=k, lambda_mult=lambda_mult
+                )
+                points = [points[i] for i in selected]
+            results.append([_payload_to_document(point, collection) for point in points])
+        return results
+
+    @property
+    def active_searches(self) -> int:
+        return self._active_searches
+
+    def wait_for_reads(self, max_wait: float = 1.0, interval: float = 0.02) -> float:
+        """
+        入库写入前调用：有检索在进行时最多等待 max_wait 秒，让检索优先使用客户端
+
+        Returns:
+            实际等待的秒数
+        """
+        started = time.monotonic()
+        while self._active_searches > 0 and time.monotonic() - started < max_wait:
+            time.sleep(interval)
+        return time.monotonic() - started
+
+    def upsert(self, documents: List[Document], ids: Optional[List[str]] = None) -> int:
+        """
+        嵌入并分批写入文档
+
+        嵌入在锁外完成，每批写入只短暂占用客户端，入库期间检索不会被长时间阻塞。
+
+        Args:
+            documents: 文档列表
+            ids: 与文档对应的点ID，None则随机生成
+
+        Returns:
+            写入的文档数量
+        """
+        ids = ids or [str(uuid.uuid4()) for _ in documents]
+        collection, embeddings = self.resolve()
+        written = 0
+        for start in range(0, len(documents), self.write_batch_size):
+            batch = documents[start:start + self.write_batch_size]
+            vectors = embeddings.embed_documents([doc.page_content for doc in batch])
+            written += self.upsert_vectors(batch, ids[start:start + self.write_batch_size], vectors, collection)
+        return written
+
+    def upsert_vectors(self, documents: List[Document], ids: List[str], vectors: List[List[float]],
+                       collection: Optional[str] = None) -> int:
+        """
+        写入已经嵌入好的文档，不再调用嵌入模型
+
+        Args:
+            documents: 文档列表
+            ids: 与文档对应的点ID
+            vectors: 与文档对应的向量
+            collection: 写入的物理集合，None则写入 collection_name（可以是别名）
+
+        Returns:
+            写入的文档数量
+        """
+        points = [
+            rest.PointStruct(
+                id=point_id,
+                vector=vector,
+                payload={CONTENT_KEY: doc.page_content, METADATA_KEY: doc.metadata},
+            )
+            for point_id, vector, doc in zip(ids, vectors, documents)
+        ]
+        self._locked(self.client.upsert, collection_name=collection or self.collection_name, points=points, wait=True)
+        return len(points)
+
+    def delete(self, ids: List[str]) -> int:
+        """按点ID分批删除"""
+        for start in range(0, len(ids), self.write_batch_size):
+            batch = ids[start:start + self.write_batch_size]
+            self._locked(
+                self.client.delete,
+                collection_name=self.collection_name,
+                points_selector=rest.PointIdsList(points=batch),
+                wait=True,
+            )
+        return len(ids)
+
+    def as_retriever(self, search_type: str = "similarity", search_kwargs: Optional[dict] = None) -> BaseRetriever:
+        return VectorStoreRetriever(store=self, search_type=search_type, search_kwargs=search_kwargs or {})
+
+
+class RemoteVectorStore:
+    """通过HTTP访问 owner 进程（Server.py）中的向量库"""
+
+    def __init__(self, endpoint: str, timeout: float = float(os.getenv("VECTOR_STORE_TIMEOUT", "30"))) -> None:
+        self.endpoint = endpoint.rstrip("/")
+        # 写入接口需要与 Server.py 相同的 INGEST_TOKEN
+        token = os.getenv("INGEST_TOKEN")
+        self.http = httpx.Client(timeout=timeout, headers={"X-Ingest-Token": token} if token else None)
+
+    def search_batch(self,
+                     queries: List[str],
+                     k: int = 5,
+                     fetch_k: int = 20,
+                     search_type: str = "similarity",
+                     lambda_mult: float = 0.5) -> List[List[Document]]:
+        response = self.http.post(f"{self.endpoint}/search", json={
+            "queries": queries,
+            "k": k,
+            "fetch_k": fetch_k,
+            "search_type": search_type,
+            "lambda_mult": lambda_mult,
+        })
+        response.raise_for_status()
+        return [
+            [Document(page_content=doc["page_content"], metadata=doc["metadata"]) for doc in docs]
+            for docs in response.json()["results"]
+        ]
+
+    def upsert(self, documents: List[Document], ids: Optional[List[str]] = None) -> int:
+        response = self.http.post(f"{self.endpoint}/upsert", json={
+            "documents": [_document_to_dict(doc) for doc in documents],
+            "ids": ids,
+        })
+        response.raise_for_status()
+        return response.json()["count"]
+
+    def as_retriever(self, search_type: str = "similarity", search_kwargs: Optional[dict] = None) -> BaseRetriever:
+        return VectorStoreRetriever(store=self, search_type=search_type, search_kwargs=search_kwargs or {})
+
+
+class VectorStoreRetriever(BaseRetriever):
+    """基于 search_batch 的检索器，本地与远程模式通用"""
+
+    store: Any
+    search_type: str = "similarity"
+    search_kwargs: dict = {}
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.store.search_batch([query], search_type=self.search_type, **self.search_kwargs)[0]
+
+
+def get_vector_store():
+    """
+    获取当前进程使用的向量库
+
+    local 模式下如果存储目录已被其他进程（通常是 Server.py）占用，
+    自动退回 remote 模式访问该进程，而不是每次调用都重新打开本地库。
+    """
+    global _store
+    if _store is not None:
+        return _store
+    mode = get_mode()
+    endpoint = os.getenv("VECTOR_STORE_ENDPOINT", "http://127.0.0.1:8000/vector")
+    store = None
+    if mode in ("server", "local"):
+        try:
+            store = VectorStoreService(
+                get_qdrant_client(), get_collection_name(), get_embeddings(), follow_active_index=True
+            )
+        except RuntimeError as e:
+            if mode == "server":
+                raise
+            logger.warning(f"本地向量库已被其他进程占用，改为通过 {endpoint} 访问: {e}")
+    if store is None:
+        store = RemoteVectorStore(endpoint)
+    with _lock:
+        if _store is None:
+            _store = store
+    return _store
+
+
+def get_local_store() -> Optional[VectorStoreService]:
+    """返回本进程直接持有的向量库服务，remote模式下返回None"""
+    store = get_vector_store()
+    return store if isinstance(store, VectorStoreService) else None
@@ -0,0 +1,316 @@
+"""
+联网搜索
+
+web_search 工具的搜索层：
+- 规范化查询后按 (后端, 条数, 查询) 缓存到本地 sqlite，过期时间 WEB_SEARCH_CACHE_TTL；
+- 每次搜索有硬超时 WEB_SEARCH_TIMEOUT，超时立即返回，后台请求完成后结果仍会写入缓存；
+- 完全相同的查询在途时合并为一次后端请求；
+- 返回给大模型的是前几条结果的精简摘要，总长度受 WEB_SEARCH_MAX_TOKENS 约束，不再把原始结果整段塞进上下文。
+
+后端可替换：WEB_SEARCH_BACKEND=serpapi（默认）或 stub（本地桩，不联网，用于测试和离线调试）。
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from .Embedder import CJK_RE, estimate_tokens
+
+logger = logging.getLogger("WebSearch")
+
+# 单条搜索结果：{"title": str, "snippet": str, "link": str}
+SearchResult = Dict[str, str]
+
+
+def get_search_cache_dir() -> str:
+    """搜索缓存所在目录"""
+    path = os.getenv("WEB_SEARCH_CACHE_DIR", "./search_cache")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def normalize_query(query: str) -> str:
+    """全半角统一、小写、合并空白，同一问题的不同写法命中同一条缓存"""
+    return " ".join(unicodedata.normalize("NFKC", query).lower().split())
+
+
+def _truncate(text: str, budget: int) -> str:
+    """截取不超过 budget 个token的前缀，计数方式与 estimate_tokens 一致"""
+    cost = 0.0
+    for i, char in enumerate(text):
+        cost += 1 if CJK_RE.match(char) else 0.25
+        if cost > budget:
+            return text[:i].rstrip() + "…"
+    return text
+
+
+def compact_results(results: List[SearchResult], max_tokens: int, top_k: int) -> str:
+    """
+    把搜索结果压缩为编号摘要
+
+    Args:
+        results: 按相关度排序的搜索结果
+        max_tokens: 摘要的token上限，超出时截断最后一条的摘要并丢弃其余结果
+        top_k: 最多保留的结果条数
+
+    Returns:
+        每条形如 "1. 标题\\n摘要\\n链接" 的文本
+    """
+    blocks: List[str] = []
+    used = 0
+    for i, result in enumerate(results[:top_k], 1):
+        title = " ".join((result.get("title") or "").split())
+        snippet = " ".join((result.get("snippet") or "").split())
+        link = result.get("link") or ""
+        head = f"{i}. {title}"
+        remaining = max_tokens - used - estimate_tokens(head) - estimate_tokens(link) - 2
+        if remaining <= 0:
+            break
+        block = "\n".join(part for part in (head, _truncate(snippet, remaining), link) if part)
+        blocks.append(block)
+        used += estimate_tokens(block) + 1
+        if used >= max_tokens:
+            break
+    return "\n\n".join(blocks)
+
+
+class SearchTimeout(TimeoutError):
+    """搜索在超时时间内没有返回"""
+
+
+# ---- 后端 ----
+
+class SerpAPIBackend:
+    """通过 SerpAPI 调用 Google 搜索，参数与 SerpAPIWrapper 的默认值一致"""
+
+    name = "serpapi"
+    endpoint = "https://serpapi.com/search"
+
+    def __init__(self, api_key: Optional[str] = None,
+                 timeout: float = float(os.getenv("WEB_SEARCH_TIMEOUT", "8"))) -> None:
+        self.api_key = api_key or os.getenv("SERPAPI_API_KEY")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def search(self, query: str, num: int) -> List[SearchResult]:
+        params = {
+            "engine": "google", "google_domain": "google.com", "gl": "us", "hl": "en",
+            "q": query, "num": num, "api_key": self.api_key,
+        }
+        response = self.session.get(self.endpoint, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+        if data.get("error"):
+            raise RuntimeError(data["error"])
+        return self.parse(data)
+
+    @staticmethod
+    def parse(data: Dict[str, Any]) -> List[SearchResult]:
+        """直接答案和知识卡片排在最前，其后是自然搜索结果"""
+        results: List[SearchResult] = []
+        answer = data.get("answer_box") or {}
+        answer_text = answer.get("answer") or answer.get("snippet") or answer.get("result")
+        if answer_text:
+            results.append({"title": answer.get("title") or "直接答案", "snippet": str(answer_text),
+                            "link": answer.get("link") or ""})
+        graph = data.get("knowledge_graph") or {}
+        if graph.get("description"):
+            results.append({"title": graph.get("title") or "", "snippet": graph["description"],
+                            "link": graph.get("website") or graph.get("source", {}).get("link", "")})
+        for item in data.get("organic_results") or []:
+            results.append({"title": item.get("title") or "", "snippet": item.get("snippet") or "",
+                            "link": item.get("link") or ""})
+        return results
+
+
+class StubBackend:
+    """
+    本地桩后端，不发起网络请求
+
+    fixtures 按规范化查询给出固定结果，未登记的查询返回按查询生成的确定性结果。
+    """
+
+    name = "stub"
+
+    def __init__(self, fixtures: Optional[Dict[str, List[SearchResult]]] = None,
+                 path: Optional[str] = os.getenv("WEB_SEARCH_STUB_FILE"), delay: float = 0.0) -> None:
+        """
+        Args:
+            fixtures: 查询 -> 结果列表
+            path: JSON 格式的 fixtures 文件，与 fixtures 合并
+            delay: 每次搜索的模拟耗时（秒）
+        """
+        self.fixtures: Dict[str, List[SearchResult]] = {}
+        if path:
+            with open(path, encoding="utf-8") as f:
+                self.fixtures.update({normalize_query(q): r for q, r in json.load(f).items()})
+        self.fixtures.update({normalize_query(q): r for q, r in (fixtures or {}).items()})
+        self.delay = delay
+        self.calls = 0
+
+    def search(self, query: str, num: int) -> List[SearchResult]:
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if query in self.fixtures:
+            return self.fixtures[query][:num]
+        return [
+            {"title": f"{query} - 结果{i}", "snippet": f"关于“{query}”的第{i}条模拟结果。",
+             "link": f"https://example.com/search/{i}"}
+            for i in range(1, num + 1)
+        ]
+
+
+def create_backend(name: Optional[str] = None) -> Any:
+    """按名称创建搜索后端，默认读取 WEB_SEARCH_BACKEND"""
+    name = (name or os.getenv("WEB_SEARCH_BACKEND", "serpapi")).lower()
+    if name == "serpapi":
+        return SerpAPIBackend()
+    if name == "stub":
+        return StubBackend()
+    raise ValueError(f"未知的搜索后端: {name}")
+
+
+# ---- 搜索层 ----
+
+class WebSearch:
+    """带磁盘缓存、硬超时和请求合并的联网搜索"""
+
+    def __init__(self, backend: Any = None, path: Optional[str] = None,
+                 ttl: float = float(os.getenv("WEB_SEARCH_CACHE_TTL", "3600")),
+                 timeout: float = float(os.getenv("WEB_SEARCH_TIMEOUT", "8")),
+                 top_k: int = int(os.getenv("WEB_SEARCH_TOP_K", "5")),
+                 max_tokens: int = int(os.getenv("WEB_SEARCH_MAX_TOKENS", "600"))) -> None:
+        """
+        Args:
+            backend: 搜索后端，需提供 name 属性和 search(query, num) 方法；None 则按 WEB_SEARCH_BACKEND 创建
+            path: sqlite 缓存文件路径，None 则使用 WEB_SEARCH_CACHE_DIR/search.sqlite3
+            ttl: 结果缓存秒数，<=0 表示不缓存
+            timeout: 单次搜索的硬超时（秒），包括排队等待合并请求的时间
+            top_k: 返回给大模型的结果条数
+            max_tokens: 返回给大模型的摘要token上限
+        """
+        self.backend = backend or create_backend()
+        self.ttl = ttl
+        self.timeout = timeout
+        self.top_k = top_k
+        self.max_tokens = max_tokens
+        self.path = path or os.path.join(get_search_cache_dir(), "search.sqlite3")
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, Future] = {}
+        # 超时后请求仍在后台完成并写入缓存，因此不能占用调用方线程
+        self._pool = ThreadPoolExecutor(max_workers=int(os.getenv("WEB_SEARCH_WORKERS", "4")),
+                                        thread_name_prefix="web-search")
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, query TEXT, results TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def _key(self, query: str) -> str:
+        return f"{self.backend.name}:{self.top_k}:{query}"
+
+    def _load(self, key: str) -> Optional[List[SearchResult]]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT results FROM results WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _store(self, key: str, query: str, results: List[SearchResult]) -> None:
+        if self.ttl <= 0:
+            return
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results (key, query, results, expires_at) VALUES (?, ?, ?, ?)",
+                (key, query, json.dumps(results, ensure_ascii=False), now + self.ttl),
+            )
+            self.conn.execute("DELETE FROM results WHERE expires_at <= ?", (now,))
+
+    def _fetch(self, key: str, query: str) -> List[SearchResult]:
+        started = time.perf_counter()
+        try:
+            results = self.backend.search(query, self.top_k)
+            self._store(key, query, results)
+            return results
+        except Exception:
+            self.counters["errors"] += 1
+            raise
+        finally:
+            self.counters["backend_calls"] += 1
+            self.counters["backend_seconds"] += time.perf_counter() - started
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def search(self, query: str) -> List[SearchResult]:
+        """
+        返回搜索结果，优先读缓存
+
+        Raises:
+            SearchTimeout: 超时时间内后端没有返回
+        """
+        query = normalize_query(query)
+        key = self._key(query)
+        cached = self._load(key)
+        if cached is not None:
+            self.counters["hits"] += 1
+            return cached
+        self.counters["misses"] += 1
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._inflight[key] = self._pool.submit(self._fetch, key, query)
+            else:
+                self.counters["coalesced"] += 1
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            self.counters["timeouts"] += 1
+            raise SearchTimeout(f"搜索超过 {self.timeout:g}s 未返回") from None
+
+    def run(self, query: str) -> str:
+        """web_search 工具的入口：返回精简后的结果摘要，失败时返回说明文字"""
+        try:
+            results = self.search(query)
+        except SearchTimeout as e:
+            logger.warning(f"搜索超时: {query}")
+            return f"搜索超时，请稍后重试或换个说法（{e}）"
+        except Exception as e:
+            logger.error(f"搜索失败: {query}: {e}")
+            return f"搜索失败: {str(e)}"
+        if not results:
+            return "没有找到相关结果"
+        return compact_results(results, self.max_tokens, self.top_k)
+
+    def stats(self) -> Dict[str, float]:
+        """缓存命中、合并、超时、后端调用次数与平均耗时"""
+        counters = dict(self.counters)
+        lookups = counters.get("hits", 0) + counters.get("misses", 0)
+        counters["hit_rate"] = counters.get("hits", 0) / lookups if lookups else 0.0
+        calls = counters.get("backend_calls", 0)
+        counters["backend_avg_seconds"] = counters.get("backend_seconds", 0) / calls if calls else 0.0
+        return {name: round(value, 3) for name, value in counters.items()}
+
+
+_web_search: Optional[WebSearch] = None
+_web_search_lock = threading.Lock()
+
+
+def get_web_search() -> WebSearch:
+    """进程内共享的搜索层"""
+    global _web_search
+    with _web_search_lock:
+        if _web_search is None:
+            _web_search = WebSearch()
+        return _web_search
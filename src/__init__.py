@@ -1,8 +1,22 @@
-from .Emotion import EmotionClass
-from .Prompt import PromptClass
-from .Memory import MemoryClass
-from  .Tools import web_search,get_info_from_local
-from .Agents import AgentClass
-from .AddDoc import DocumentProcessor
-
-__all__ = ["EmotionClass","PromptClass","MemoryClass","AgentClass","web_search","get_info_from_local","DocumentProcessor"]
\ No newline at end of file
+import importlib
+
+# 延迟导入：Tools 在导入时会校验飞书/SerpAPI 等环境变量，
+# 按需加载可以让 AddDoc、Benchmark 等模块在没有这些配置时单独使用
+_EXPORTS = {
+    "EmotionClass": ".Emotion",
+    "PromptClass": ".Prompt",
+    "MemoryClass": ".Memory",
+    "web_search": ".Tools",
+    "get_info_from_local": ".Tools",
+    "AgentClass": ".Agents",
+    "DocumentProcessor": ".AddDoc",
+}
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        return getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = ["EmotionClass","PromptClass","MemoryClass","AgentClass","web_search","get_info_from_local","DocumentProcessor"]